@@ -49,14 +49,26 @@ import time
 import math
 import zstandard
 import platform
-from base64 import b64encode, urlsafe_b64encode
+import stat
+import struct
+import threading
+import mmap
+from base64 import b64encode, b64decode, urlsafe_b64encode
 from joblib import Parallel, delayed
 from multiprocessing import Manager
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from urllib.error import HTTPError
 from botocore.exceptions import ClientError
+try:
+    import lz4.frame
+except ImportError:  # lz4 is optional, the lz4 codec is only offered when it is installed
+    lz4 = None
 
 # Import project scoped vars
 from singleton import SingletonClass #Project Scoped Global Vars
+import metrics
 
 singleton = SingletonClass()
 
@@ -65,6 +77,15 @@ CHUNK_SIZE = 1024 * 512
 MEGABYTE = 1024 * 1024
 GIGABYTE = MEGABYTE * 1024
 KNOWN_SPARSE_CHECKSUM = "B4VNL+8pega6gWheZgwzLeNtXRjVRpJ9MNqtbX/aFUE="
+PART_SIZE = 64 * MEGABYTE  # Multipart upload part size for packed S3 exports
+PACK_MAGIC = b"FSPPACK1"  # Last 8 bytes of every pack object
+INDEX_ENTRY_SIZE = 420  # Measured memory per block index entry, including dict overhead. See Memory.md
+ZERO_BLOCK = bytes(CHUNK_SIZE)
+STREAM_WORKERS = 64  # Concurrent GetSnapshotBlock calls when streaming to a pipe
+STREAM_WINDOW = STREAM_WORKERS * 4  # Max blocks held in the reorder buffer, 128 MiB
+VERIFY_READ_SIZE = 16 * CHUNK_SIZE  # Sequential read size when hashing a local image, 8 MiB
+VERIFY_WORKERS = os.cpu_count() or 4  # Threads hashing fetched blocks in the VerifyStage, one per core
+MERKLE_FANOUT = 64  # Children per Merkle tree node, so a tree over 16 TiB of blocks is 5 levels deep
 
 # Source for Atomic Counter: http://eli.thegreenplace.net/2012/01/04/shared-counter-with-pythons-multiprocessing
 class Counter(object):
@@ -81,6 +102,168 @@ class Counter(object):
             return self.val.value
 
 
+# Byte-granular semaphore that enforces the --max_memory budget across all transfer paths.
+# Block and segment buffers reserve their size before they are filled and give it back once written,
+# so concurrency adapts to the budget instead of the process running out of memory.
+# The block index is charged permanently with charge(), since it lives for the whole command, but never into the
+# `floor` the workers need to make progress (see minimum_memory() in main.py). Without a budget, every call is a no-op.
+class MemoryBudget(object):
+    def __init__(self, limit=None, floor=None):
+        self.limit = limit
+        self.floor = CHUNK_SIZE if floor is None else floor
+        self.used = 0
+        self.cond = threading.Condition()
+
+    # A single request larger than the whole budget could never be granted, so it exits instead of waiting forever.
+    def check(self, nbytes):
+        if nbytes > self.limit:
+            print("ERROR: a single", nbytes, "byte buffer doesn't fit in the --max_memory budget of", self.limit, "bytes. Increase --max_memory.")
+            raise SystemExit
+
+    # Blocks until nbytes are available. Returns the amount reserved.
+    def acquire(self, nbytes):
+        if self.limit is None:
+            return 0
+        self.check(nbytes)
+        with self.cond:
+            while self.used + nbytes > self.limit:
+                self.cond.wait()
+            self.used += nbytes
+        return nbytes
+
+    # Like acquire(), but returns None instead of waiting when the budget is exhausted.
+    def try_acquire(self, nbytes):
+        if self.limit is None:
+            return 0
+        self.check(nbytes)
+        with self.cond:
+            if self.used + nbytes > self.limit:
+                return None
+            self.used += nbytes
+        return nbytes
+
+    def release(self, nbytes):
+        if self.limit is None or nbytes == 0:
+            return
+        with self.cond:
+            self.used -= nbytes
+            self.cond.notify_all()
+
+    @contextmanager
+    def reserve(self, nbytes):
+        reserved = self.acquire(nbytes)
+        try:
+            yield
+        finally:
+            self.release(reserved)
+
+    # Non-blocking reservation for data that is never released, such as the block index. Exits if it can't fit,
+    # since nothing else is running yet that could give memory back.
+    def charge(self, nbytes, what):
+        if self.limit is None:
+            return
+        with self.cond:
+            if self.used + nbytes > self.limit - self.floor:  # Leave room for the workers' buffers
+                print("ERROR:", what, "needs more than the --max_memory budget of", self.limit, "bytes. Increase --max_memory or transfer a smaller range with --start/--end.")
+                raise SystemExit
+            self.used += nbytes
+
+memory_budget = MemoryBudget(singleton.MAX_MEMORY, singleton.MIN_MEMORY)
+
+
+# Pool of reusable CHUNK_SIZE bytearrays for the per-block hot loops. Response bodies and file reads go straight
+# into a pooled buffer that is then hashed, written and PUT without further copies, and handed back afterwards.
+# A new buffer is only allocated when the pool is empty and the memory budget has room for it; pooled buffers stay
+# charged to the budget, so they are never counted twice.
+class BlockBufferPool(object):
+    def __init__(self, budget):
+        self.budget = budget
+        self.free = []  # LIFO, so recently used (cache-warm) buffers are reused first
+        self.cond = threading.Condition()
+
+    def acquire(self):
+        with self.cond:
+            while True:
+                if len(self.free) > 0:
+                    return self.free.pop()
+                if self.budget.try_acquire(CHUNK_SIZE) is not None:
+                    return bytearray(CHUNK_SIZE)
+                self.cond.wait(0.1)  # Wake up for returned buffers, or for budget released elsewhere
+
+    # Like acquire(), but returns None instead of waiting when the pool is empty and the budget is exhausted.
+    def try_acquire(self):
+        with self.cond:
+            if len(self.free) > 0:
+                return self.free.pop()
+            if self.budget.try_acquire(CHUNK_SIZE) is not None:
+                return bytearray(CHUNK_SIZE)
+        return None
+
+    def release(self, buf):
+        with self.cond:
+            self.free.append(buf)
+            self.cond.notify()
+
+    @contextmanager
+    def buffer(self):
+        buf = self.acquire()
+        try:
+            yield buf
+        finally:
+            self.release(buf)
+
+block_pool = BlockBufferPool(memory_budget)
+
+
+# Read a response body or stream into a pooled buffer, with readinto() where the body offers it and read() otherwise.
+# Returns a memoryview over the bytes received, which is shorter than buf if the body ended early.
+# Data Path: EBS Direct API -> Local Memory
+def read_body_into(body, buf):
+    view = memoryview(buf)
+    readinto = getattr(body, "readinto", None)
+    received = 0
+    while received < len(view):
+        if readinto is not None:
+            n = readinto(view[received:])
+        else:
+            chunk = body.read(len(view) - received)
+            n = len(chunk)
+            view[received:received + n] = chunk
+        if not n:
+            break
+        received += n
+    return view[:received]
+
+
+# GetSnapshotBlock always returns a whole block, so a short body means the connection was cut. Raise instead of
+# passing on a partial block with stale data from the buffer's previous use behind it.
+# Data Path: EBS Direct API -> Local Memory
+def read_block_into(resp, buf):
+    data = read_body_into(resp["BlockData"], buf)
+    if len(data) < CHUNK_SIZE:
+        raise IOError("short read of a snapshot block, {} of {} bytes".format(len(data), CHUNK_SIZE))
+    return data
+
+
+# Read one block of a file or stream into a pooled buffer, zero-filling a short final block in place instead of
+# ljust(). Pipes return short reads, so keep reading until the block is full or the stream ends.
+# Returns False at end of file.
+# Data Path: Local File / Block Device / Stream -> Local Memory
+def read_file_block_into(f, buf):
+    view = memoryview(buf)
+    n = 0
+    while n < CHUNK_SIZE:
+        received = f.readinto(view[n:])
+        if not received:
+            break
+        n += received
+    if not n:
+        return False
+    if n < CHUNK_SIZE:
+        buf[n:] = memoryview(ZERO_BLOCK)[n:]
+    return True
+
+
 # Description:      Wrapper around ebs.get_snapshot_block() with retry logic.
 # Data path:        EBS Snapshot -> EBS Direct API -> Local Memory
 # Input worker:     EBS Client
@@ -93,9 +276,11 @@ def try_get_block(ebs, snapshot_id, block_index, block_token):
     retry_count = 0
     while response is None:
         try:
-            response = ebs.get_snapshot_block(
-                SnapshotId=snapshot_id, BlockIndex=block_index, BlockToken=block_token
-            )
+            with metrics.timer("ebs.GetSnapshotBlock"):
+                response = ebs.get_snapshot_block(
+                    SnapshotId=snapshot_id, BlockIndex=block_index, BlockToken=block_token
+                )
+            metrics.transferred("ebs_get", response.get("DataLength", CHUNK_SIZE))
             continue
         except Exception as e:
             # We catch all errors here, but mostly it'll be API throttle events. 
@@ -104,6 +289,7 @@ def try_get_block(ebs, snapshot_id, block_index, block_token):
             # TODO: Implement abort according to API best practices.
             error_code = e.response['Error']['Code']
             retry_count += 1  
+            count_snapshot_block_exception(error_code, "Get")
             if (retry_count > 1): 
                 log_snapshot_block_exception(block_token, retry_count, error_code, "Get")
             pass
@@ -114,31 +300,36 @@ def try_get_block(ebs, snapshot_id, block_index, block_token):
 # Data path:        Local Memory -> EBS Direct API -> EBS Snapshot
 # Input worker:     EBS Client
 # Input data:       CHUNK_SIZE worth of bytes
-# Input metadata:   Snapshot ID (string), BlockIndex, calculated SHA256 Checksum of data, atomic counter that we increment on success
+# Input metadata:   Snapshot ID (string), BlockIndex, calculated SHA256 Checksum of data, atomic counter that we increment on success (or None),
+#                   skip_sparse=False to PUT zero blocks too, e.g. to overwrite data inherited from a parent snapshot
 # Output:           EBS Direct API Response
 #
-def try_put_block(ebs, block, snap_id, data, checksum, count):
+def try_put_block(ebs, block, snap_id, data, checksum, count, skip_sparse=True):
     response = None
     retry_count = 0
-    if checksum != KNOWN_SPARSE_CHECKSUM or singleton.FULL_COPY:  # Known sparse block checksum we can skip
+    if checksum != KNOWN_SPARSE_CHECKSUM or singleton.FULL_COPY or not skip_sparse:  # Known sparse block checksum we can skip
         while response is None:
             try:
-                response = ebs.put_snapshot_block(
-                    SnapshotId=snap_id,
-                    BlockIndex=block,
-                    BlockData=data,
-                    DataLength=CHUNK_SIZE,
-                    Checksum=checksum,
-                    ChecksumAlgorithm='SHA256'
-                )
+                with metrics.timer("ebs.PutSnapshotBlock"):
+                    response = ebs.put_snapshot_block(
+                        SnapshotId=snap_id,
+                        BlockIndex=block,
+                        BlockData=data,
+                        DataLength=CHUNK_SIZE,
+                        Checksum=checksum,
+                        ChecksumAlgorithm='SHA256'
+                    )
+                metrics.transferred("ebs_put", CHUNK_SIZE)
                 continue
             except Exception as e:
                 error_code = e.response['Error']['Code']
                 retry_count += 1
+                count_snapshot_block_exception(error_code, "Put")
                 if retry_count > 1:
                     log_snapshot_block_exception(block, retry_count, error_code, "Put")
                 pass
-        count.increment()
+        if not count is None:
+            count.increment()
     return response
 
 
@@ -165,6 +356,21 @@ def log_snapshot_block_exception(block, retry_count, error_code, operation):
     print (block, "failed", operation, retry_count, "times, retrying.", error_code)
 
 
+# Quota codes of the GetSnapshotBlock and PutSnapshotBlock throttles, see log_snapshot_block_exception()
+QUOTA_CODES = {
+    ("Get", "ThrottlingException"): "L-C125AE42",
+    ("Get", "RequestThrottledException"): "L-028ACFB9",
+    ("Put", "ThrottlingException"): "L-AFAE1BE8",
+    ("Put", "RequestThrottledException"): "L-1774F84A"
+}
+
+# Count every failed GetSnapshotBlock or PutSnapshotBlock attempt, and throttles per quota code, for --metrics.
+def count_snapshot_block_exception(error_code, operation):
+    metrics.count("retries", operation=operation + "SnapshotBlock", error=error_code)
+    if (operation, error_code) in QUOTA_CODES:
+        metrics.count("throttles", operation=operation + "SnapshotBlock", quota=QUOTA_CODES[(operation, error_code)])
+
+
 # Description:      Helper function to write a block to a file at the right offset.
 # Data path:        Local Memory -> File
 # Input worker:     N/A
@@ -173,11 +379,12 @@ def log_snapshot_block_exception(block, retry_count, error_code, operation):
 # Output:           N/A
 #
 def write_block_to_file(file, block, data):
-    with os.fdopen(os.open(file, os.O_WRONLY), "rb+") as f: # On Windows, we can write to a raw disk, but can't create or read.
+    with metrics.timer("disk_write"), os.fdopen(os.open(file, os.O_WRONLY), "rb+") as f: # On Windows, we can write to a raw disk, but can't create or read.
         f.seek(block["BlockIndex"]*CHUNK_SIZE)
         f.write(data)
         f.flush()
         f.close()
+    metrics.transferred("disk_write", len(data))
 
 # Description:      Helper function to verify received checksum with received data.
 # Data path:        N/A
@@ -187,9 +394,7 @@ def write_block_to_file(file, block, data):
 # Output:           Bool
 #
 def verify_checksum(received_checksum, block, data):
-    h = hashlib.sha256()
-    h.update(data)
-    calculated_checksum = b64encode(h.digest()).decode()
+    calculated_checksum = block_checksum(data)
     if received_checksum == calculated_checksum:
         return True
     else:
@@ -197,64 +402,179 @@ def verify_checksum(received_checksum, block, data):
         return False
 
 
-# Get a Snapshot Block, verify Checksum and write it to a file.
+# Base64 SHA-256 of a block, the checksum format of the EBS Direct APIs.
+# Data path:        N/A
+def block_checksum(data):
+    with metrics.timer("checksum"):
+        return b64encode(hashlib.sha256(data).digest()).decode()
+
+
+# CPU stage behind the GetSnapshotBlock workers of download and multiclone. A network worker hands the fetched block
+# over and goes straight back to fetching, while `workers` threads verify its checksum and deliver it, e.g. write it
+# to every target. hashlib releases the GIL, so the threads hash on separate cores without copying blocks into other
+# processes. A block that fails verification is released and fetched again by refetch() on a retry worker, then goes
+# through the stage once more, as often as needed like the inline path. submit() blocks once `window` blocks are
+# waiting or being verified, which bounds memory. close() waits for every block, retries included.
+# Data Path: Local Memory -> deliver(), e.g. File / Block Device
+class VerifyStage(object):
+    def __init__(self, workers, window):
+        self.verifiers = ThreadPoolExecutor(max_workers=workers)
+        self.fetchers = ThreadPoolExecutor(max_workers=workers)
+        self.in_flight = threading.BoundedSemaphore(window)
+        self.cond = threading.Condition()
+        self.outstanding = 0
+        self.errors = []
+
+    # fetched and refetch() are (data, checksum, release), release() hands the buffer back once data is delivered.
+    def submit(self, block, fetched, refetch, deliver):
+        self.in_flight.acquire()
+        with self.cond:
+            self.outstanding += 1
+        self.verifiers.submit(self.verify, block, fetched, refetch, deliver)
+
+    def verify(self, block, fetched, refetch, deliver):
+        data, checksum, release = fetched
+        try:
+            if not verify_checksum(checksum, block, data):
+                release()
+                self.fetchers.submit(self.retry, block, refetch, deliver)
+                return
+            deliver(data)
+            release()
+        except Exception as e:
+            release()
+            self.finish(block, e)
+            return
+        self.finish(block)
+
+    def retry(self, block, refetch, deliver):
+        try:
+            fetched = refetch()
+        except Exception as e:
+            self.finish(block, e)
+            return
+        self.verifiers.submit(self.verify, block, fetched, refetch, deliver)
+
+    def finish(self, block, error=None):
+        if not error is None:
+            print(block, "failed:", error)
+            self.errors.append(error)
+        self.in_flight.release()
+        with self.cond:
+            self.outstanding -= 1
+            self.cond.notify_all()
+
+    # Waits for all submitted blocks. Exits instead of letting the caller report a transfer with missing blocks.
+    def close(self):
+        with self.cond:
+            while self.outstanding > 0:
+                self.cond.wait()
+        self.verifiers.shutdown(wait=True)
+        self.fetchers.shutdown(wait=True)
+        if len(self.errors) > 0:
+            print("ERROR:", len(self.errors), "blocks could not be written.")
+            raise SystemExit
+
+
+# Fetch a Snapshot Block into a buffer taken from block_pool. Returns (data, checksum, release) for the VerifyStage.
+# Data Path: EBS Snapshot -> Direct API -> Local Memory
+def fetch_block_into_pool(ebs, snapshot_id, block):
+    buf = block_pool.acquire()
+    try:
+        resp = try_get_block(ebs, snapshot_id, block["BlockIndex"], block["BlockToken"])
+        data = read_body_into(resp["BlockData"], buf)
+    except BaseException:
+        block_pool.release(buf)
+        raise
+    return data, resp["Checksum"], lambda: block_pool.release(buf)
+
+
+# Get a Snapshot Block and hand it to the VerifyStage, which verifies the Checksum and writes it to the files.
+# Known sparse blocks are skipped right away if allowed. Without a stage, the block is verified and written inline.
+# Data Path: EBS Snapshot -> Direct API -> Local Memory -> VerifyStage -> File / Block Device
+def get_block(block, ebs, files, snapshot_id, journal=None, checksums=None, skip_sparse=True, verify_stage=None):
+    if verify_stage is None:
+        get_block_inline(block, ebs, files, snapshot_id, journal, checksums, skip_sparse)
+        return
+    fetched = fetch_block_into_pool(ebs, snapshot_id, block)
+    checksum = fetched[1]
+    if not checksums is None and checksum != KNOWN_SPARSE_CHECKSUM:  # Zero blocks are implied in a manifest
+        checksums[block["BlockIndex"]] = checksum
+    if checksum == KNOWN_SPARSE_CHECKSUM and not singleton.FULL_COPY and skip_sparse:
+        fetched[2]()
+        if not journal is None:
+            journal.mark(block["BlockIndex"])
+        return
+    def deliver(data):
+        for file in files:
+            write_block_to_file(file, block, data)
+        if not journal is None:
+            journal.mark(block["BlockIndex"])
+    verify_stage.submit(block, fetched, lambda: fetch_block_into_pool(ebs, snapshot_id, block), deliver)
+
+
+# Get a Snapshot Block, verify Checksum and write it to a file, all on the calling thread.
 # Data Path: Local Memory (from try_get_block()) -> File / Block Device
-def get_block(block, ebs, files, snapshot_id):
-    resp = try_get_block(ebs, snapshot_id, block["BlockIndex"], block["BlockToken"])
-    data = resp["BlockData"].read()
-    if (
-        resp["Checksum"] != KNOWN_SPARSE_CHECKSUM or singleton.FULL_COPY
-    ): ## Known sparse block checksum we can skip if allowed
-        if verify_checksum(resp["Checksum"], block, data):
-            for file in files:
-                write_block_to_file(file, block, data)
-        else:
-            get_block(block, ebs, files, snapshot_id)  # We retry indefinitely on checksum failure.
+def get_block_inline(block, ebs, files, snapshot_id, journal=None, checksums=None, skip_sparse=True):
+    with block_pool.buffer() as buf:
+        while True:  # We retry indefinitely on checksum failure.
+            resp = try_get_block(ebs, snapshot_id, block["BlockIndex"], block["BlockToken"])
+            data = read_body_into(resp["BlockData"], buf)
+            if not checksums is None and resp["Checksum"] != KNOWN_SPARSE_CHECKSUM:  # Zero blocks are implied in a manifest
+                checksums[block["BlockIndex"]] = resp["Checksum"]
+            if resp["Checksum"] == KNOWN_SPARSE_CHECKSUM and not singleton.FULL_COPY and skip_sparse:
+                break  ## Known sparse block checksum we can skip if allowed
+            if verify_checksum(resp["Checksum"], block, data):
+                for file in files:
+                    write_block_to_file(file, block, data)
+                break
+    if not journal is None:
+        journal.mark(block["BlockIndex"])
 
 
 # Get a Changed Block, verify Checksum and write it at the right offset.
 # Data Path: Local Memory (from try_get_block()) -> File / Block Device
 def get_changed_block(block, ebs, files, snapshot_id_one, snapshot_id_two):
-    resp = None
-    if "SecondBlockToken" in block:
-        resp = try_get_block(ebs, snapshot_id_two, block["BlockIndex"], block["SecondBlockToken"])
-    else:
-        resp = try_get_block(ebs, snapshot_id_one, block["BlockIndex"], block["FirstBlockToken"])
-    data = resp["BlockData"].read()
-    # For a changed block, we **don't** want to skip sparse blocks, since we want to overwrite non-sparse with sparse if that happens.
-    if verify_checksum(resp["Checksum"], block, data):
-        for file in files:
-            write_block_to_file(file, block, data)
-    else:
-        get_changed_block(block, ebs, files, snapshot_id_two)  # We retry indefinitely on checksum failure.
+    with block_pool.buffer() as buf:
+        while True:  # We retry indefinitely on checksum failure.
+            if "SecondBlockToken" in block:
+                resp = try_get_block(ebs, snapshot_id_two, block["BlockIndex"], block["SecondBlockToken"])
+            else:
+                resp = try_get_block(ebs, snapshot_id_one, block["BlockIndex"], block["FirstBlockToken"])
+            data = read_body_into(resp["BlockData"], buf)
+            # For a changed block, we **don't** want to skip sparse blocks, since we want to overwrite non-sparse with sparse if that happens.
+            if verify_checksum(resp["Checksum"], block, data):
+                for file in files:
+                    write_block_to_file(file, block, data)
+                return
 
 # Read a Block locally, try to upload it.
 # Data Path: Local File / Block Device -> Memory -> EBS Direct API (via try_put_block()) -> EBS Snapshot
-def put_block_from_file(block, ebs, snap_id, OUTFILE, count):
+def put_block_from_file(block, ebs, snap_id, OUTFILE, count, journal=None, checksums=None, skip_sparse=True):
     block = int(block)
-    with os.fdopen(os.open(OUTFILE, os.O_RDONLY | os.O_NONBLOCK), "rb+") as f:
+    with block_pool.buffer() as data, os.fdopen(os.open(OUTFILE, os.O_RDONLY | os.O_NONBLOCK), "rb+") as f:
         f.seek((block) * CHUNK_SIZE)
-        data = f.read(CHUNK_SIZE)
-        if not data:
+        if not read_file_block_into(f, data):
             return
-        data = data.ljust(CHUNK_SIZE, b"\0")
-        checksum = b64encode(hashlib.sha256(data).digest()).decode()
-        try_put_block(ebs, block, snap_id, data, checksum, count)
+        checksum = block_checksum(data)
+        if not checksums is None and checksum != KNOWN_SPARSE_CHECKSUM:  # Zero blocks are implied in a manifest
+            checksums[block] = checksum
+        response = try_put_block(ebs, block, snap_id, data, checksum, count, skip_sparse)
+    if not journal is None:
+        journal.mark(block, not response is None)
 
 
 # Read a Block locally, try to upload it to multiple destinations in parallel.
 # Data Path: Local File / Block Device -> Memory -> EBS Direct APIs (via try_put_block()) -> EBS Snapshots
-def put_block_from_file_fanout(block, source, f, ebsclient_snaps):
+def put_block_from_file_fanout(block, source, f, ebsclient_snaps, journal=None):
     block = int(block)
-    with os.fdopen(os.open(source, os.O_RDONLY | os.O_NONBLOCK), "rb+") as f:
+    with block_pool.buffer() as data, os.fdopen(os.open(source, os.O_RDONLY | os.O_NONBLOCK), "rb+") as f:
         f.seek((block) * CHUNK_SIZE)
-        data = f.read(CHUNK_SIZE)
-        if not data:
+        if not read_file_block_into(f, data):
             return
-        data = data.ljust(CHUNK_SIZE, b"\0")
-        checksum = b64encode(hashlib.sha256(data).digest()).decode()
+        checksum = block_checksum(data)
         with Parallel(n_jobs=singleton.NUM_JOBS, require="sharedmem") as parallel3:
-            parallel3(delayed(try_put_block)(
+            responses = parallel3(delayed(try_put_block)(
                 ebsclient_snaps[ebsclient_snap]["client"],
                 block,
                 ebsclient_snaps[ebsclient_snap]["snapshot"]["SnapshotId"],
@@ -264,6 +584,256 @@ def put_block_from_file_fanout(block, source, f, ebsclient_snaps):
             ) 
             for ebsclient_snap in ebsclient_snaps
         )
+    if not journal is None:  # Only once every region has the block
+        journal.mark(block, any(not response is None for response in responses))
+
+
+# Shared pool of PutSnapshotBlock workers fed by producers that run ahead of it, such as stream readers and
+# getfroms3 segment readers. submit() blocks once `window` blocks are queued or in flight, which bounds memory.
+# Every destination in ebsclient_snaps gets its own lane of `workers` threads, so a slow region doesn't hold up
+# the others. The block is hashed once, by the first lane to reach it, and its data is shared by all lanes.
+# release(data) is called once the block has been PUT to every snapshot, e.g. to hand a buffer back to block_pool.
+# submit() returns an Event that is set at the same time, so a producer can wait for the PUTs of blocks it submitted.
+# Snapshots with a parent need skip_sparse=False, since a zero block may replace data inherited from the parent.
+# Data Path: Local Memory -> EBS Direct APIs (via try_put_block()) -> EBS Snapshots
+class PutStage(object):
+    def __init__(self, workers, window, skip_sparse=True):
+        self.workers = workers
+        self.lanes = {}
+        self.lock = threading.Lock()
+        self.in_flight = threading.BoundedSemaphore(window)
+        self.skip_sparse = skip_sparse
+        self.errors = []
+
+    def lane(self, destination):
+        with self.lock:
+            if not destination in self.lanes:
+                self.lanes[destination] = ThreadPoolExecutor(max_workers=self.workers)
+            return self.lanes[destination]
+
+    def submit(self, block, data, ebsclient_snaps, counted=True, release=None):
+        self.in_flight.acquire()
+        lock = threading.Lock()
+        checksum = []
+        pending = [len(ebsclient_snaps)]
+        finished = threading.Event()
+        def put(destination):
+            with lock:
+                if len(checksum) == 0:
+                    checksum.append(block_checksum(data))
+            try_put_block(
+                ebsclient_snaps[destination]["client"],
+                block,
+                ebsclient_snaps[destination]["snapshot"]["SnapshotId"],
+                data,
+                checksum[0],
+                ebsclient_snaps[destination]["count"] if counted else None,
+                self.skip_sparse
+            )
+        def done(future):
+            if not future.exception() is None:
+                print(block, "failed Put:", future.exception())
+                self.errors.append(future.exception())
+            with lock:
+                pending[0] -= 1
+                last = pending[0] == 0
+            if last:
+                if not release is None:
+                    release(data)
+                self.in_flight.release()
+                finished.set()
+        for destination in ebsclient_snaps:
+            self.lane(destination).submit(put, destination).add_done_callback(done)
+        return finished
+
+    # Waits for all submitted blocks. Exits instead of letting the caller complete a snapshot with missing blocks.
+    def close(self):
+        for lane in self.lanes.values():
+            lane.shutdown(wait=True)
+        if len(self.errors) > 0:
+            print("ERROR:", len(self.errors), "blocks could not be uploaded. The snapshot was not completed.")
+            raise SystemExit
+
+
+# Writes restored Blocks into a file or block device instead of PUTting them, with the same interface as PutStage,
+# so getfroms3 can restore an export locally in a single transfer. Segment workers write with pwrite() at the
+# block offset, so writes run in parallel without a shared file position. Writes are synchronous, so submit()
+# returns an Event that is already set.
+# Data Path: Local Memory -> File / Block Device
+WRITTEN = threading.Event()
+WRITTEN.set()
+
+class FileSink(object):
+    def __init__(self, file_path, size):
+        validate_file_paths([file_path])
+        if platform.system() == "Windows":
+            self.fd = os.open(file_path, os.O_WRONLY | os.O_BINARY)  # Windows doesn't allow O_CREAT on a PhysicalDrive
+        else:
+            self.fd = os.open(file_path, os.O_WRONLY | os.O_CREAT)
+        status = os.fstat(self.fd)
+        if stat.S_ISREG(status.st_mode) and status.st_size < size:
+            os.ftruncate(self.fd, size)  # Image files get the full volume size, unwritten blocks stay sparse
+        self.lock = threading.Lock()
+        self.written = 0
+
+    def submit(self, block, data, ebsclient_snaps=None, counted=True, release=None):
+        try:
+            view = memoryview(data)
+            offset = block * CHUNK_SIZE
+            start = time.perf_counter()
+            while len(view) > 0:
+                if hasattr(os, "pwrite"):
+                    n = os.pwrite(self.fd, view, offset)
+                else:  # No pwrite() on Windows, fall back to a locked seek and write
+                    with self.lock:
+                        os.lseek(self.fd, offset, os.SEEK_SET)
+                        n = os.write(self.fd, view)
+                view = view[n:]
+                offset += n
+            metrics.observe("disk_write", time.perf_counter() - start)
+            metrics.transferred("disk_write", len(data))
+            if counted:
+                with self.lock:
+                    self.written += 1
+        finally:
+            if not release is None:
+                release(data)
+        return WRITTEN
+
+    def close(self):
+        os.fsync(self.fd)
+        os.close(self.fd)
+
+
+# Read a non-seekable source sequentially and upload its blocks to one or more snapshots concurrently.
+# All-zero blocks are skipped unless FULL_COPY is set. At most STREAM_WINDOW blocks are read ahead of the
+# uploads, so memory stays bounded however long the stream is. Blocks are read into block_pool buffers, which
+# the PUT stage hands back once every snapshot has them. Returns the number of blocks read.
+# Data Path: Stream -> Local Memory -> EBS Direct APIs (via try_put_block()) -> EBS Snapshots
+def stream_put_blocks(source, ebsclient_snaps, volume_blocks, start_block=None, end_block=None):
+    first_block = 0 if start_block is None else start_block
+    last_block = volume_blocks if end_block is None else min(end_block, volume_blocks)
+    with block_pool.buffer() as buf:
+        for _ in range(first_block):  # A stream can't seek, so blocks before the range are read and discarded
+            if not read_file_block_into(source, buf):
+                return 0
+    put_stage = PutStage(STREAM_WORKERS, STREAM_WINDOW)
+    block = first_block
+    while block < last_block:
+        buf = block_pool.acquire()
+        if not read_file_block_into(source, buf):
+            block_pool.release(buf)
+            break
+        if buf != ZERO_BLOCK or singleton.FULL_COPY:
+            put_stage.submit(block, buf, ebsclient_snaps, release=block_pool.release)
+        else:
+            block_pool.release(buf)
+        block += 1
+    put_stage.close()
+    if block == volume_blocks and end_block is None and source.read(1):
+        print("ERROR: the input stream is larger than --size. The snapshot was not completed.")
+        raise SystemExit
+    return block - first_block
+
+
+# Start one snapshot per region, each with its own EBS client and block counter.
+# Metadata Path: EBS Direct API(s)
+def start_snapshots(destination_regions, gbsize, description, parent_snapshot_id=None, timeout=None):
+    ebsclient_snaps = {}
+    params = {} if timeout is None else {"Timeout": timeout}
+    for region in destination_regions:
+        ebs = boto3.client("ebs", region_name=region)
+        if parent_snapshot_id is None:
+            snap = ebs.start_snapshot(VolumeSize=gbsize, Description=description, **params)
+        else:
+            snap = ebs.start_snapshot(VolumeSize=gbsize, Description=description, ParentSnapshotId=parent_snapshot_id, **params)
+        ebsclient_snaps[region] = {
+            "client": ebs,
+            "snapshot": snap,
+            "count": Counter(Manager(), 0)
+        }
+    return ebsclient_snaps
+
+
+# Complete the snapshots started by start_snapshots() with their own block counts. Returns {region: snapshot_id}.
+# Metadata Path: EBS Direct API(s)
+def complete_snapshots(ebsclient_snaps):
+    output = {}
+    for region in ebsclient_snaps:
+        ebs = ebsclient_snaps[region]["client"]
+        snapshot_id = ebsclient_snaps[region]["snapshot"]["SnapshotId"]
+        count = ebsclient_snaps[region]["count"]
+        ebs.complete_snapshot(SnapshotId=snapshot_id, ChangedBlocksCount=count.value())
+        output[region] = snapshot_id
+    return output
+
+
+# Sources that can't seek (stdin, pipes, FIFOs, sockets) are uploaded with stream_put_blocks().
+# Data Path: N/A
+def is_stream_source(path):
+    if path == "-":
+        return True
+    mode = os.stat(path).st_mode
+    return stat.S_ISFIFO(mode) or stat.S_ISSOCK(mode)
+
+
+# Opens stdin or a pipe for sequential binary reads.
+# Data Path: N/A
+def open_stream_source(path, size):
+    if size is None:
+        print("ERROR: --size is required when reading from stdin or a pipe, because the snapshot VolumeSize must be known before the upload starts.")
+        raise SystemExit
+    if path == "-":
+        return sys.stdin.buffer
+    return open(path, "rb")
+
+
+# Raw images in S3 can be uploaded straight into a snapshot. Sources are given as s3://bucket/key.
+# Data Path: N/A
+S3_RANGE_BLOCKS = 32  # Blocks per ranged GET, 16 MiB
+def is_s3_source(path):
+    return path.startswith("s3://")
+
+def parse_s3_url(url):
+    bucket, _, key = url[len("s3://"):].partition("/")
+    if bucket == "" or key == "":
+        print("ERROR:", url, "is not a valid S3 object URL, expected s3://bucket/key.")
+        raise SystemExit
+    return bucket, key
+
+
+# Read blocks [first, last) of a raw image in S3 with one ranged GET and hand them to the PUT stage as they arrive.
+# Zero blocks are skipped unless FULL_COPY is set. If the GET fails midway, it resumes at the first block
+# that was not submitted yet, so no block is counted twice.
+# Data Path: S3 -> Local Memory -> PUT stage -> EBS Snapshot(s) (via try_put_block())
+def get_range_from_s3(s3, bucket, key, size, first, last, put_stage, ebsclient_snaps):
+    block = first
+    retry_count = 0
+    while block < last:
+        try:
+            end = min(last * CHUNK_SIZE, size) - 1
+            response = s3.get_object(Bucket=bucket, Key=key, Range="bytes={}-{}".format(block * CHUNK_SIZE, end))
+            while block < last:
+                buf = block_pool.acquire()
+                try:
+                    data = read_body_into(response["Body"], buf)
+                    if len(data) < CHUNK_SIZE and block * CHUNK_SIZE + len(data) < size:  # Connection closed before the range was complete
+                        raise IOError("short read at block {}".format(block))
+                except BaseException:
+                    block_pool.release(buf)
+                    raise
+                if len(data) < CHUNK_SIZE:
+                    buf[len(data):] = memoryview(ZERO_BLOCK)[len(data):]  # Zero-fill the final partial block
+                if buf == ZERO_BLOCK and not singleton.FULL_COPY:
+                    block_pool.release(buf)
+                else:
+                    put_stage.submit(block, buf, ebsclient_snaps, release=block_pool.release)
+                block += 1
+        except Exception as e:
+            retry_count += 1
+            if retry_count > singleton.RETRY_BLOCK_COUNT:
+                raise
+            print("GET of s3://" + bucket + "/" + key, "failed at block", block, "retrying:", e)
 
 
 # Read a Snapshot from S3 in parallel.
@@ -271,74 +841,783 @@ def put_block_from_file_fanout(block, source, f, ebsclient_snaps):
 def get_blocks_s3(array, snapshot_prefix):
     ebs = boto3.client("ebs", region_name=singleton.AWS_ORIGIN_REGION)  # we spawn a client per snapshot segment
     session=boto3.Session(profile_name=singleton.AWS_S3_PROFILE)
-    s3 = session.client(
+    s3 = metrics.instrument(session.client(
         "s3",
         region_name=singleton.AWS_ORIGIN_REGION,
         endpoint_url=singleton.AWS_S3_ENDPOINT_URL
-    )
+    ))
     with Parallel(n_jobs=singleton.NUM_JOBS) as parallel2:
         parallel2(
             delayed(get_block_s3)(block, ebs, s3, snapshot_prefix) for block in array
         )
 
 
+# S3 exports live under "snapshot_id.volsize/". Each segment object is named "offset.checksum.length.compressalgo",
+# and the manifest stores the same four fields per segment, so a key can be rebuilt without listing the bucket.
+# Packed exports store many segments per "pack.N" object instead, and add pack, pack_offset and pack_length.
+# Deduplicated exports only store the manifest (the recipe) and add the chunk digest of every block of the segment.
+MANIFEST_NAME = "manifest.json.zstd"
+
+def export_prefix(snapshot_id, volume_size):
+    return "{}.{}".format(snapshot_id, volume_size)
+
+def segment_key(prefix, segment):
+    return "{}/{}".format(prefix, ".".join(segment[:4]))
+
+
+# Write the manifest of an S3 export: volume size, codec and the offset, checksum, length and codec of every segment.
+# Delta exports also name the export prefix of their base and the [first block, count] runs they removed from it.
+# It is written last, so its presence also marks the export as complete.
+# Data Path: Local Memory -> S3
+def put_manifest(s3, prefix, snapshot_id, volume_size, segments, layout="segments", base=None, zeroed=None, codec="zstd"):
+    manifest = {
+        "version": 1,
+        "snapshot_id": snapshot_id,
+        "volume_size": volume_size,
+        "chunk_size": CHUNK_SIZE,
+        "codec": codec,  # Codec setting of the export, each segment records the codec it was actually stored with
+        "layout": layout,
+        "segments": sorted(segments, key=lambda segment: int(segment[0]))
+    }
+    if not base is None:
+        manifest["base"] = base
+        manifest["zeroed"] = zeroed
+    s3.put_object(
+        Body=zstandard.compress(json.dumps(manifest, separators=(",", ":")).encode(), 3),
+        Bucket=singleton.S3_BUCKET,
+        Key="{}/{}".format(prefix, MANIFEST_NAME)
+    )
+
+
+# Load the manifest of an S3 export, or None for exports written before manifests existed.
+# Data Path: S3 -> Local Memory
+def get_manifest(s3, prefix):
+    try:
+        response = s3.get_object(Bucket=singleton.S3_BUCKET, Key="{}/{}".format(prefix, MANIFEST_NAME))
+    except ClientError as e:
+        if e.response["Error"]["Code"] in ("NoSuchKey", "404"):
+            return None
+        raise
+    return json.loads(zstandard.decompress(response["Body"].read()))
+
+
+# Resolve a user supplied prefix such as "snap-0123" to the "snap-0123.volsize" directory of its export.
+# A delimited listing returns one entry per export, not one per segment. A prefix that already reaches into the
+# export directory, such as "snap-0123.8/" or "snap-0123.8/0.", is cut back to the directory name first.
+# Data Path: N/A
+def find_export_prefix(s3, snapshot_prefix):
+    snapshot_prefix = snapshot_prefix.split("/")[0]
+    response = s3.list_objects_v2(Bucket=singleton.S3_BUCKET, Prefix=snapshot_prefix, Delimiter="/")
+    for common_prefix in response.get("CommonPrefixes", []):
+        return common_prefix["Prefix"].rstrip("/")
+    return None
+
+
+# Load the segments and volume size of an export, from its manifest or by listing it. manifest is None when listed.
+# Data Path: S3 -> Local Memory
+def load_export(s3, prefix):
+    manifest = get_manifest(s3, prefix)
+    if manifest is None:
+        print("No manifest found for", prefix, "- listing segments instead.")
+        return list_segments(s3, prefix), int(prefix.split(".")[1]), None
+    return manifest["segments"], manifest["volume_size"], manifest
+
+
+# Resolve the layers of a delta export, newest first, down to its full base export.
+# Data Path: S3 -> Local Memory
+def load_layers(s3, prefix):
+    segments, volume_size, manifest = load_export(s3, prefix)
+    layers = [(prefix, segments, manifest)]
+    while not manifest is None and "base" in manifest:
+        prefix = manifest["base"]
+        manifest = get_manifest(s3, prefix)
+        if manifest is None:
+            print("ERROR: base export", prefix, "of", layers[-1][0], "is missing or incomplete.")
+            raise SystemExit
+        layers.append((prefix, manifest["segments"], manifest))
+    return layers, volume_size
+
+
+# Decide which blocks of which segment to restore when overlaying delta layers: a block comes from the newest layer
+# that wrote or removed it. Returns (segment, prefix, needed) per segment with anything left to restore, where
+# needed is None if the whole segment is used, or else a list of booleans per block.
+# Data Path: N/A, operates on a block map and doesn't touch data.
+def overlay_layers(layers, volume_blocks):
+    if len(layers) == 1:
+        return [(segment, layers[0][0], None) for segment in layers[0][1]]
+    memory_budget.charge(volume_blocks, "the layer mask")
+    covered = bytearray(volume_blocks)
+    plan = []
+    for prefix, segments, manifest in layers:
+        for segment in segments:
+            offset = int(segment[0])
+            needed = [offset + i < volume_blocks and not covered[offset + i] for i in range(int(segment[2]))]
+            covered[offset:offset + len(needed)] = b"\x01" * len(needed)
+            if all(needed):
+                plan.append((segment, prefix, None))
+            elif any(needed):
+                plan.append((segment, prefix, needed))
+        for first, count in manifest.get("zeroed", []) if not manifest is None else []:
+            covered[first:first + count] = b"\x01" * count
+    del covered[volume_blocks:]  # Slice assignment past the end extends the mask
+    return plan
+
+
+# Segments a previous, interrupted movetos3 run already stored under the export prefix, keyed by (offset, length).
+# Snapshots are immutable and objects only appear once fully uploaded, so a listed segment is complete and valid.
+# Data Path: S3 -> Local Memory
+def stored_segments(s3, prefix):
+    return {(segment[0], segment[2]): segment for segment in list_segments(s3, prefix)}
+
+def resume_key(array):
+    return (str(array[0]["BlockIndex"]), str(len(array)))
+
+
+# Restoring onto a parent snapshot that already holds the base export: drop the plan entries whose segment the
+# base restores identically (same offset, length and checksum), and find the blocks that hold data in the parent
+# but not in the target, which must be overwritten with zeros. Returns (plan, zero_blocks).
+# Data Path: N/A, operates on a block map and doesn't touch data.
+def diff_plan(plan, base_plan, volume_blocks):
+    unchanged = set((segment[0], segment[1], segment[2]) for segment, prefix, needed in base_plan if needed is None)
+    memory_budget.charge(volume_blocks, "the parent block mask")
+    stale = bytearray(volume_blocks)  # 1 where the parent holds data the target doesn't
+    for entries, value in ((base_plan, 1), (plan, 0)):
+        for segment, prefix, needed in entries:
+            offset = int(segment[0])
+            for i in range(int(segment[2])):
+                if (needed is None or needed[i]) and offset + i < volume_blocks:
+                    stale[offset + i] = value
+    zero_blocks = []
+    index = stale.find(1)
+    while index >= 0:
+        zero_blocks.append(index)
+        index = stale.find(1, index + 1)
+    changed = [entry for entry in plan if not (entry[2] is None and (entry[0][0], entry[0][1], entry[0][2]) in unchanged)]
+    return changed, zero_blocks
+
+
+# Compress a sorted list of block indices into [first block, count] runs.
+# Data Path: N/A
+def block_runs(indices):
+    runs = []
+    for index in indices:
+        if len(runs) > 0 and runs[-1][0] + runs[-1][1] == index:
+            runs[-1][1] += 1
+        else:
+            runs.append([index, 1])
+    return runs
+
+
+# Fallback for exports without a manifest: enumerate segments by listing every object under the export prefix.
+# Data Path: S3 -> Local Memory
+def list_segments(s3, prefix):
+    segments = []
+    params = {"Bucket": singleton.S3_BUCKET, "Prefix": prefix + "/"}
+    while True:
+        response = s3.list_objects_v2(**params)
+        for object in response.get("Contents", []):
+            name = object["Key"].split("/")[1].split(".")
+            if len(name) == 4:  # Skip the manifest and anything else that isn't a segment
+                segments.append(name)
+            elif len(name) == 2 and name[0] == "pack":
+                segments.extend(get_pack_index(s3, object["Key"], object["Size"]))
+        if not "NextContinuationToken" in response:
+            return segments
+        params["ContinuationToken"] = response["NextContinuationToken"]
+
+
+# Setting up a zstd context costs more than compressing a small block, so each worker thread keeps reusable
+# compressors per level, dictionary and thread count, and decompressors per dictionary. Contexts aren't thread-safe.
+# Data Path: N/A
+zstd_contexts = threading.local()
+
+def zstd_compressor(level=1, dictionary=None, threads=0):
+    if not hasattr(zstd_contexts, "compressors"):
+        zstd_contexts.compressors = {}
+    key = (level, 0 if dictionary is None else dictionary.dict_id(), threads)
+    if not key in zstd_contexts.compressors:
+        zstd_contexts.compressors[key] = zstandard.ZstdCompressor(level=level, dict_data=dictionary, threads=threads)
+    return zstd_contexts.compressors[key]
+
+def zstd_decompressor(dictionary=None):
+    if not hasattr(zstd_contexts, "decompressors"):
+        zstd_contexts.decompressors = {}
+    key = 0 if dictionary is None else dictionary.dict_id()
+    if not key in zstd_contexts.decompressors:
+        zstd_contexts.decompressors[key] = zstandard.ZstdDecompressor(dict_data=dictionary)
+    return zstd_contexts.decompressors[key]
+
+
+# Optional zstd dictionary of an export, trained on a sample of the snapshot's blocks. It is stored next to the
+# segments as "dictionary", and segments compressed with it use the codec name "zstddict".
+# Data Path: EBS Snapshot -> EBS Direct API -> Local Memory
+DICTIONARY_NAME = "dictionary"
+DICTIONARY_SIZE = 112 * 1024
+DICTIONARY_SAMPLE_BLOCKS = 64
+DICTIONARY_SAMPLE_SIZE = 16 * 1024
+
+def train_dictionary(snapshot_id, blocks):
+    ebs = boto3.client("ebs", region_name=singleton.AWS_ORIGIN_REGION)
+    samples = []
+    step = max(1, len(blocks) // DICTIONARY_SAMPLE_BLOCKS)
+    with block_pool.buffer() as buf:
+        for block in blocks[::step][:DICTIONARY_SAMPLE_BLOCKS]:
+            resp = try_get_block(ebs, snapshot_id, block["BlockIndex"], block["BlockToken"])
+            data = read_body_into(resp["BlockData"], buf)
+            samples.extend(bytes(data[i:i + DICTIONARY_SAMPLE_SIZE]) for i in range(0, len(data), DICTIONARY_SAMPLE_SIZE))
+    try:
+        return zstandard.train_dictionary(DICTIONARY_SIZE, samples)
+    except zstandard.ZstdError as e:
+        print("Could not train a compression dictionary, continuing without one:", e)
+        return None
+
+def put_dictionary(s3, prefix, dictionary):
+    s3.put_object(Body=dictionary.as_bytes(), Bucket=singleton.S3_BUCKET, Key="{}/{}".format(prefix, DICTIONARY_NAME))
+    with dictionaries_lock:
+        dictionaries[prefix] = dictionary
+
+# Dictionaries are loaded once per export and shared by all segment readers.
+dictionaries = {}
+dictionaries_lock = threading.Lock()
+
+def get_dictionary(s3, prefix):
+    with dictionaries_lock:
+        if not prefix in dictionaries:
+            try:
+                response = s3.get_object(Bucket=singleton.S3_BUCKET, Key="{}/{}".format(prefix, DICTIONARY_NAME))
+                dictionaries[prefix] = zstandard.ZstdCompressionDict(response["Body"].read())
+            except ClientError as e:
+                if not e.response["Error"]["Code"] in ("NoSuchKey", "404"):
+                    raise
+                dictionaries[prefix] = None
+        return dictionaries[prefix]
+
+
+# Codecs for S3 exports. The codec name is the last field of a segment key and of its manifest entry, so
+# getfroms3 can pick the decoder per segment. To add a codec, implement encoder/finish/decoder and register it.
+# Data Path: N/A
+class StoreCodec(object):
+    name = "none"
+    def encoder(self, out, size):
+        return out
+    def finish(self, writer):
+        pass
+    def decoder(self, body):
+        return body
+
+class ZstdCodec(object):
+    def __init__(self, level=1, dictionary=None, threads=0):
+        self.name = "zstd" if dictionary is None else "zstddict"
+        self.level = level
+        self.dictionary = dictionary
+        self.threads = threads
+    def encoder(self, out, size):
+        return zstd_compressor(self.level, self.dictionary, self.threads).stream_writer(out, size=size)
+    def finish(self, writer):
+        writer.flush(zstandard.FLUSH_FRAME)
+    def decoder(self, body):
+        return zstd_decompressor(self.dictionary).stream_reader(body)
+
+class Lz4Codec(object):
+    name = "lz4"
+    def __init__(self, level=0):
+        self.level = level
+    def encoder(self, out, size):
+        return lz4.frame.LZ4FrameFile(out, mode="wb", compression_level=self.level)
+    def finish(self, writer):
+        writer.close()  # Finishes the frame, doesn't close the output it was given
+    def decoder(self, body):
+        return lz4.frame.LZ4FrameFile(body, mode="rb")
+
+CODECS = {"none": StoreCodec, "zstd": ZstdCodec, "zstddict": ZstdCodec, "lz4": Lz4Codec}
+
+def get_codec(name, level=None, dictionary=None):
+    if not name in CODECS:
+        print("ERROR: unknown codec", name, "- this export needs a newer fsp.py.")
+        raise SystemExit
+    if name == "lz4" and lz4 is None:
+        print("ERROR: the lz4 codec needs the lz4 package. Install it with: pip3 install lz4")
+        raise SystemExit
+    if name == "zstddict":
+        if dictionary is None:
+            print("ERROR: the compression dictionary of this export is missing.")
+            raise SystemExit
+        return ZstdCodec(1 if level is None else level, dictionary)
+    return CODECS[name]() if level is None else CODECS[name](level)
+
+
+# Picks the codec of each segment. "auto" compresses a 64 KiB sample of the first block: data that doesn't compress
+# (encrypted or already compressed) is stored as is, and highly compressible data can afford a higher zstd level.
+# It never picks lz4, which is optional, so an export made with the defaults restores on any install.
+# Any other setting uses that codec for every segment.
+# zstd uses the export's dictionary if there is one, and `threads` compression threads for segments of at least
+# MT_SEGMENT_SIZE, which helps when there are fewer segments in flight than cores.
+# Data Path: N/A
+SAMPLE_SIZE = 64 * 1024
+INCOMPRESSIBLE_RATIO = 0.95
+COMPRESSIBLE_RATIO = 0.25
+MT_SEGMENT_SIZE = 8 * MEGABYTE
+
+class CodecPolicy(object):
+    def __init__(self, setting="auto", level=None, dictionary=None, threads=0):
+        self.setting = setting
+        self.level = level
+        self.dictionary = dictionary
+        self.threads = threads
+        if setting != "auto":
+            get_codec(setting, level)  # Fail before reading any data if the codec isn't available
+        self.lock = threading.Lock()
+        self.used = {}
+
+    def zstd(self, level, size):
+        return ZstdCodec(level, self.dictionary, self.threads if size >= MT_SEGMENT_SIZE else 0)
+
+    def choose(self, sample, size):
+        if self.setting == "zstd":
+            codec = self.zstd(1 if self.level is None else self.level, size)
+        elif self.setting != "auto":
+            codec = get_codec(self.setting, self.level)
+        else:
+            step = len(sample) // 4  # Four slices spread over the block, so a header or a partly filled block doesn't skew it
+            sample = b"".join(bytes(sample[i:i + SAMPLE_SIZE // 4]) for i in range(0, 4 * step, step))
+            ratio = len(zstd_compressor(1).compress(sample)) / len(sample)
+            if ratio >= INCOMPRESSIBLE_RATIO:
+                codec = StoreCodec()
+            elif ratio <= COMPRESSIBLE_RATIO:
+                codec = self.zstd(3 if self.level is None else self.level, size)
+            else:
+                codec = self.zstd(1 if self.level is None else self.level, size)
+        with self.lock:
+            self.used[codec.name] = self.used.get(codec.name, 0) + 1
+        return codec
+
+
+# Read the Blocks of a Segment and compress them as they arrive, so only compressed output accumulates.
+# The codec is chosen from the first block. Yields the segment fields [offset, checksum, length, codec] and the
+# compressed data, ready to be uploaded.
+# The checksum covers the whole segment, so it is only known, and the object can only be named, after the last block.
+# Data Path: EBS Snapshot -> EBS Direct API -> Local Memory
+@contextmanager
+def compressed_segment(ebs, snapshot_id, array, policy):
+    h = hashlib.sha256()
+    offset = array[0]["BlockIndex"]
+    length = len(array)
+    compressed = io.BytesIO()
+    # The pooled buffer comes first: the pool allocates from the same budget, so a worker holding a reservation
+    # while it waits for a buffer could starve every other worker, and with them itself.
+    with block_pool.buffer() as buf:
+        with memory_budget.reserve(length * CHUNK_SIZE):  # Compressed output is at most ~ the raw size
+            codec = None
+            for block in array:
+                resp = try_get_block(ebs, snapshot_id, block["BlockIndex"], block["BlockToken"])
+                data = read_block_into(resp, buf)
+                h.update(data)
+                if codec is None:
+                    codec = policy.choose(data, length * CHUNK_SIZE)
+                    writer = codec.encoder(compressed, length * CHUNK_SIZE)
+                with metrics.timer("compress"):
+                    writer.write(data)
+            with metrics.timer("compress"):
+                codec.finish(writer)
+            compressed.seek(0)
+            yield [str(offset), urlsafe_b64encode(h.digest()).decode(), str(length), codec.name], compressed
+
+
 # Copy Segments to S3 in parallel.
 # Data Path:  -> S3
-def put_segments_to_s3(snapshot_id, array, volume_size, s3bucket):
+def put_segments_to_s3(snapshot_id, array, volume_size, s3bucket, policy):
     ebs = boto3.client("ebs", region_name=singleton.AWS_ORIGIN_REGION)  # we spawn a client per snapshot segment
     session=boto3.Session(profile_name=singleton.AWS_S3_PROFILE)
-    s3 = session.client(
+    s3 = metrics.instrument(session.client(
         "s3",
         region_name=singleton.AWS_DEST_REGION,
         endpoint_url=singleton.AWS_S3_ENDPOINT_URL
-    )
+    ))
+    with compressed_segment(ebs, snapshot_id, array, policy) as (segment, compressed):
+        s3.put_object(
+            Body=compressed,
+            Bucket=s3bucket, Key=segment_key(export_prefix(snapshot_id, volume_size), segment)
+        )
+    return segment
+
+
+# Appends compressed Segments to one large S3 object ("pack") through a multipart upload.
+# Segments arrive in any order from the movetos3 workers. Their position in the pack is recorded in an index that is
+# appended as a footer with the last expected segment, so the pack can be restored with ranged GETs even without
+# the manifest. Parts are uploaded by whichever worker fills them, outside the lock, so a pack uploads in parallel.
+# If the export fails, abort() discards the parts already uploaded, which S3 would otherwise keep, and bill, forever.
+# Data Path: Local Memory -> S3 (multipart)
+class PackWriter(object):
+    def __init__(self, s3, prefix, name, expected):
+        self.s3 = s3
+        self.key = "{}/{}".format(prefix, name)
+        self.name = name
+        self.expected = expected  # Number of segments in this pack
+        self.cond = threading.Condition()
+        self.upload_id = None
+        self.buffer = bytearray()
+        self.size = 0
+        self.next_part = 1
+        self.parts = []
+        self.uploading = 0
+        self.failed = False
+        self.completed = False
+        self.index = []
+
+    # Returns the manifest entry of the segment: [offset, checksum, length, codec, pack, pack_offset, pack_length]
+    def append(self, segment, data):
+        with self.cond:
+            entry = segment + [self.name, str(self.size), str(len(data))]
+            self.index.append(entry)
+            self.buffer += data
+            self.size += len(data)
+            last = len(self.index) == self.expected
+            if last:
+                self.buffer += pack_footer(self.index)
+            if self.upload_id is None:
+                self.upload_id = self.s3.create_multipart_upload(Bucket=singleton.S3_BUCKET, Key=self.key)["UploadId"]
+            part = self.take_part(last)
+        if not part is None:
+            self.upload_part(*part)
+        if last:
+            self.complete()
+        return entry
+
+    # Called with the lock held. Every part but the last must be at least 5 MiB, so buffer up to PART_SIZE.
+    def take_part(self, last):
+        if len(self.buffer) < PART_SIZE and not last:
+            return None
+        part = (self.next_part, self.buffer)
+        self.next_part += 1
+        self.buffer = bytearray()
+        self.uploading += 1
+        return part
+
+    def upload_part(self, part_number, body):
+        try:
+            response = self.s3.upload_part(Bucket=singleton.S3_BUCKET, Key=self.key, UploadId=self.upload_id, PartNumber=part_number, Body=body)
+        except BaseException:
+            with self.cond:
+                self.failed = True
+                self.uploading -= 1
+                self.cond.notify_all()
+            raise
+        with self.cond:
+            self.parts.append({"PartNumber": part_number, "ETag": response["ETag"]})
+            self.uploading -= 1
+            self.cond.notify_all()
+
+    def complete(self):
+        with self.cond:
+            while self.uploading > 0:
+                self.cond.wait()
+            if self.failed:
+                raise IOError("a part of " + self.key + " could not be uploaded")
+            parts = sorted(self.parts, key=lambda part: part["PartNumber"])
+        self.s3.complete_multipart_upload(Bucket=singleton.S3_BUCKET, Key=self.key, UploadId=self.upload_id, MultipartUpload={"Parts": parts})
+        self.completed = True
+
+    # Waits for parts still uploading, since S3 may keep a part that finishes after the abort.
+    def abort(self):
+        with self.cond:
+            while self.uploading > 0:
+                self.cond.wait()
+            if self.upload_id is None or self.completed:
+                return
+        self.s3.abort_multipart_upload(Bucket=singleton.S3_BUCKET, Key=self.key, UploadId=self.upload_id)
+
+
+# Pack footer: zstd-compressed JSON index, then its length as a little-endian uint64, then PACK_MAGIC.
+# Data Path: N/A
+def pack_footer(index):
+    data = zstandard.compress(json.dumps(index, separators=(",", ":")).encode(), 3)
+    return data + struct.pack("<Q", len(data)) + PACK_MAGIC
+
+
+# Read the footer index of a pack with two ranged GETs, for packed exports without a manifest.
+# Data Path: S3 -> Local Memory
+def get_pack_index(s3, key, size):
+    tail = s3.get_object(Bucket=singleton.S3_BUCKET, Key=key, Range="bytes={}-{}".format(size - 16, size - 1))["Body"].read()
+    if tail[8:] != PACK_MAGIC:
+        print("ERROR:", key, "is not a valid pack, the footer is missing.")
+        raise SystemExit
+    length = struct.unpack("<Q", tail[:8])[0]
+    start = size - 16 - length
+    data = s3.get_object(Bucket=singleton.S3_BUCKET, Key=key, Range="bytes={}-{}".format(start, start + length - 1))["Body"].read()
+    return json.loads(zstandard.decompress(data))
+
+
+# Compress a Segment and append it to its pack.
+# Data Path: EBS Snapshot -> EBS Direct API -> Local Memory -> S3 (via PackWriter)
+def put_segment_to_pack(snapshot_id, array, pack, policy):
+    ebs = boto3.client("ebs", region_name=singleton.AWS_ORIGIN_REGION)  # we spawn a client per snapshot segment
+    with compressed_segment(ebs, snapshot_id, array, policy) as (segment, compressed):
+        return pack.append(segment, compressed.getbuffer())
+
+
+# Content-addressed store of unique compressed blocks shared by all deduplicated exports in a bucket.
+# Chunks are named by the SHA-256 of their uncompressed data, so a chunk that already exists, from this or any
+# earlier export, never has to be uploaded again. The existing chunks are listed once per export. A chunk only
+# counts as stored once its upload succeeded, so no segment can refer to a chunk that never made it to the bucket.
+# Data Path: N/A, tracks which chunks exist and doesn't touch data.
+CHUNK_PREFIX = "chunks"
+
+def chunk_key(digest):
+    return "{}/{}.zstd".format(CHUNK_PREFIX, digest)
+
+class ChunkStore(object):
+    def __init__(self, s3):
+        self.lock = threading.Lock()
+        self.known = set()
+        self.uploading = {}  # Digest of each chunk being uploaded -> Event set once its upload has finished
+        self.uploaded = 0
+        self.skipped = 0
+        params = {"Bucket": singleton.S3_BUCKET, "Prefix": CHUNK_PREFIX + "/"}
+        while True:
+            response = s3.list_objects_v2(**params)
+            for object in response.get("Contents", []):
+                self.known.add(object["Key"].split("/")[1].split(".")[0])
+            if not "NextContinuationToken" in response:
+                break
+            params["ContinuationToken"] = response["NextContinuationToken"]
+        memory_budget.charge(len(self.known) * 128, "the chunk index")
+
+    # Returns True if the caller must upload the chunk, and must then call stored(). Claims it, so concurrent
+    # duplicates are uploaded once: they wait for the upload and only skip the chunk if it succeeded.
+    def claim(self, digest):
+        while True:
+            with self.lock:
+                if digest in self.known:
+                    self.skipped += 1
+                    return False
+                uploading = self.uploading.get(digest)
+                if uploading is None:
+                    self.uploading[digest] = threading.Event()
+                    return True
+            uploading.wait()
+
+    def stored(self, digest, success):
+        with self.lock:
+            if success:
+                self.known.add(digest)
+                self.uploaded += 1
+            self.uploading.pop(digest).set()
+
+
+# Store the Blocks of a Segment as content-addressed chunks, uploading only chunks not in the store yet.
+# Returns the recipe entry of the segment: [offset, checksum, length, codec, [chunk digest per block]]
+# Data Path: EBS Snapshot -> EBS Direct API -> Local Memory -> S3
+def put_segment_dedup(snapshot_id, array, chunk_store):
+    ebs = boto3.client("ebs", region_name=singleton.AWS_ORIGIN_REGION)  # we spawn a client per snapshot segment
+    session=boto3.Session(profile_name=singleton.AWS_S3_PROFILE)
+    s3 = metrics.instrument(session.client(
+        "s3",
+        region_name=singleton.AWS_DEST_REGION,
+        endpoint_url=singleton.AWS_S3_ENDPOINT_URL
+    ))
+    compressor = zstd_compressor(1)
     h = hashlib.sha256()
-    data = bytearray()
-    offset = array[0]["BlockIndex"]
-    for block in array:
+    digests = []
+    with block_pool.buffer() as buf:
+        for block in array:
+            resp = try_get_block(ebs, snapshot_id, block["BlockIndex"], block["BlockToken"])
+            data = read_block_into(resp, buf)
+            h.update(data)
+            digest = hashlib.sha256(data).hexdigest()
+            digests.append(digest)
+            if chunk_store.claim(digest):
+                success = False
+                try:
+                    s3.put_object(Body=compressor.compress(data), Bucket=singleton.S3_BUCKET, Key=chunk_key(digest))
+                    success = True
+                finally:
+                    chunk_store.stored(digest, success)
+    return [str(array[0]["BlockIndex"]), urlsafe_b64encode(h.digest()).decode(), str(len(array)), "zstd", digests]
+
+
+# Get the chunks of a deduplicated Segment from the content-addressed store and hand them to the PUT stage.
+# Each chunk is verified against its name before it is PUT, and fetched again if the transfer garbled it.
+# Chunks are immutable, so one that still doesn't match after RETRY_BLOCK_COUNT reads is corrupt in the bucket.
+# Data Path: S3 -> Local Memory -> PUT stage -> EBS Snapshot(s) (via try_put_block())
+def get_chunks_from_s3(s3, segment, put_stage, ebsclient_snaps, needed=None):
+    offset = int(segment[0])
+    for i, digest in enumerate(segment[4]):
+        if not needed is None and not needed[i]:
+            continue
+        buf = block_pool.acquire()
+        try:
+            for attempt in range(singleton.RETRY_BLOCK_COUNT):
+                response = s3.get_object(Bucket=singleton.S3_BUCKET, Key=chunk_key(digest))
+                data = read_body_into(zstd_decompressor().stream_reader(response["Body"]), buf)
+                if hashlib.sha256(data).hexdigest() == digest:
+                    break
+                print(f'Checksum verify for chunk {digest} at block {offset + i} failed, retrying.')
+            else:
+                print("ERROR: chunk", chunk_key(digest), "at block", offset + i, "is corrupt in the bucket. The snapshot was not completed.")
+                raise SystemExit
+        except BaseException:
+            block_pool.release(buf)
+            raise
+        put_stage.submit(offset + i, buf, ebsclient_snaps, release=block_pool.release)
+
+
+# Raw image exports map the volume, or the requested block range, onto the parts of a single multipart upload.
+# Each part is assembled in memory from GetSnapshotBlock responses, with zeros left in place for unallocated
+# blocks, and uploaded as soon as it is complete. Parts are at least PART_SIZE, and larger for volumes that
+# wouldn't fit in 10000 parts, up to 1.6 GiB for 16 TiB. Each part is charged to the memory budget, and without
+# a budget at most RAW_PARTS_MEMORY of parts are in flight, with more GETs per part when fewer parts fit.
+# Data Path: N/A, operates on a block map and doesn't touch data.
+RAW_PARTS_MEMORY = 16 * PART_SIZE  # 1 GiB
+
+def raw_part_blocks(image_blocks):
+    return max(PART_SIZE // CHUNK_SIZE, -(-image_blocks // 10000))
+
+def raw_image_key(snapshot_id, volume_size):
+    return "{}.img".format(export_prefix(snapshot_id, volume_size))
+
+
+# Get a Snapshot Block into part of a larger buffer, verifying its Checksum.
+# Data Path: EBS Snapshot -> EBS Direct API -> Local Memory
+def get_block_into(block, ebs, snapshot_id, view):
+    while True:  # We retry indefinitely on checksum failure.
         resp = try_get_block(ebs, snapshot_id, block["BlockIndex"], block["BlockToken"])
-        data += resp["BlockData"].read()
-    h.update(data)
-    s3.put_object(
-        Body=zstandard.compress(data, 1),
-        Bucket=s3bucket, Key="{}.{}/{}.{}.{}.zstd".format(snapshot_id,
-            volume_size,
-            offset,
-            urlsafe_b64encode(h.digest()).decode(), len(data) // CHUNK_SIZE
-        )
-    )
+        data = read_body_into(resp["BlockData"], view)
+        if verify_checksum(resp["Checksum"], block, data):
+            return
+
+
+# Assemble and upload one part of a raw image.
+# Data Path: EBS Snapshot -> EBS Direct API -> Local Memory -> S3 (multipart)
+def put_raw_part(s3, key, upload_id, part_number, first_block, count, blocks, snapshot_id, jobs):
+    ebs = boto3.client("ebs", region_name=singleton.AWS_ORIGIN_REGION)  # we spawn a client per part
+    with memory_budget.reserve(count * CHUNK_SIZE):
+        part = bytearray(count * CHUNK_SIZE)  # Zero filled, so unallocated blocks need no work
+        view = memoryview(part)
+        with Parallel(n_jobs=jobs, require="sharedmem") as parallel2:
+            parallel2(
+                delayed(get_block_into)(block, ebs, snapshot_id, view[(block["BlockIndex"] - first_block) * CHUNK_SIZE:][:CHUNK_SIZE])
+                for block in blocks
+            )
+        response = s3.upload_part(Bucket=singleton.S3_BUCKET, Key=key, UploadId=upload_id, PartNumber=part_number, Body=part)
+    return {"PartNumber": part_number, "ETag": response["ETag"]}
+
+
+# Export a Snapshot, or a block range of it, as one raw disk image object.
+# Data Path: EBS Snapshot -> EBS Direct API -> Local Memory -> S3 (multipart)
+def put_raw_image(s3, snapshot_id, blocks, volume_size, first_block, last_block):
+    key = raw_image_key(snapshot_id, volume_size)
+    part_blocks = raw_part_blocks(last_block - first_block)
+    parts = []
+    for start in range(first_block, last_block, part_blocks):
+        parts.append((len(parts) + 1, start, min(part_blocks, last_block - start), []))
+    for block in blocks:
+        parts[(block["BlockIndex"] - first_block) // part_blocks][3].append(block)
+    if memory_budget.limit is None:
+        part_jobs = max(1, min(singleton.NUM_JOBS, RAW_PARTS_MEMORY // (part_blocks * CHUNK_SIZE)))
+    else:
+        memory_budget.check(part_blocks * CHUNK_SIZE)  # Fail before the upload starts if a part can't fit
+        part_jobs = singleton.NUM_JOBS
+    block_jobs = singleton.NUM_JOBS * singleton.NUM_JOBS // part_jobs  # Same number of GETs in flight as NUM_JOBS parts
+    print("Writing", CHUNK_SIZE * (last_block - first_block), "byte raw image to s3://" + singleton.S3_BUCKET + "/" + key, "in", len(parts), "parts.")
+    upload_id = s3.create_multipart_upload(Bucket=singleton.S3_BUCKET, Key=key)["UploadId"]
+    try:
+        with Parallel(n_jobs=part_jobs, require="sharedmem") as parallel:
+            etags = parallel(
+                delayed(put_raw_part)(s3, key, upload_id, part_number, start, count, part, snapshot_id, block_jobs)
+                for part_number, start, count, part in parts
+            )
+    except BaseException:
+        s3.abort_multipart_upload(Bucket=singleton.S3_BUCKET, Key=key, UploadId=upload_id)
+        raise
+    s3.complete_multipart_upload(Bucket=singleton.S3_BUCKET, Key=key, UploadId=upload_id, MultipartUpload={"Parts": etags})
+
+
+# Group consecutive Segments into packs of about pack_size bytes of uncompressed data.
+# Data Path: N/A, operates on a block map and doesn't touch data.
+def group_segments(segments, pack_size):
+    packs = []
+    pack = []
+    size = 0
+    for segment in segments:
+        if len(pack) > 0 and size + len(segment) * CHUNK_SIZE > pack_size:
+            packs.append(pack)
+            pack = []
+            size = 0
+        pack.append(segment)
+        size += len(segment) * CHUNK_SIZE
+    if len(pack) > 0:
+        packs.append(pack)
+    return packs
+
 
 # Copy Segments to S3 in parallel.
 # Data Path: -> S3
-def put_segments_fanout(array, source, f, ebsclient_snaps):
+def put_segments_fanout(array, source, f, ebsclient_snaps, journal=None):
     with Parallel(n_jobs=singleton.NUM_JOBS, require="sharedmem") as parallel2:
         parallel2(
-            delayed(put_block_from_file_fanout)(block, source, f, ebsclient_snaps) 
+            delayed(put_block_from_file_fanout)(block, source, f, ebsclient_snaps, journal) 
             for block in array
         )
 
-# Get a Segment from S3, uncompress, disassemble into Blocks, copy to EBS Snapshot.
-# Data Path: S3 -> Local Memory -> EBS Snapshot (via try_put_block())
-def get_segment_from_s3(object, snap, count):
-    ebs = boto3.client("ebs", region_name=singleton.AWS_ORIGIN_REGION) # we spawn a client per snapshot segment
+# Get a Segment from S3, stream-decompress it and hand each Block to the shared PUT stage as soon as it is decoded,
+# so S3 GETs and decompression run ahead of the PutSnapshotBlock calls instead of waiting for them.
+# The segment checksum is only known once the last block is decoded. On a mismatch the segment is read and
+# PUT again, overwriting the blocks without counting them twice. The retry waits for the PUTs of the bad pass
+# first, so none of them can land after, and overwrite, a good block. A segment that ends early is retried the
+# same way, without PUTting the partial block. Segments are immutable, so one that still doesn't match after
+# RETRY_BLOCK_COUNT reads is corrupt in the bucket. put_stage may also be a FileSink.
+# Data Path: S3 -> Local Memory -> PUT stage -> EBS Snapshot(s) (via try_put_block()) or File / Block Device
+def get_segment_from_s3(segment, prefix, put_stage, ebsclient_snaps, needed=None):
     session=boto3.Session(profile_name=singleton.AWS_S3_PROFILE)
-    s3 = session.client(
+    s3 = metrics.instrument(session.client(
         "s3",
         region_name=singleton.AWS_ORIGIN_REGION,
         endpoint_url=singleton.AWS_S3_ENDPOINT_URL
-    )
-    h = hashlib.sha256()
-    response = s3.get_object(Bucket=singleton.S3_BUCKET, Key=object["Key"])
-    name = object["Key"].split("/")[1].split(".") # Name format: snapshot_id.volsize/offset.checksum.length.compressalgo
-    if name[3] == "zstd":
-        data = zstandard.decompress(response["body"].read())
-        h.update(data)
-        if urlsafe_b64encode(h.digest()).decode() == name[1]:
-            for i in range(int(name[2])):
-                chunk = data[CHUNK_SIZE * i : CHUNK_SIZE * (i + 1)]
-                h.update(chunk)
-                checksum = b64encode(hashlib.sha256(chunk).digest()).decode()
-                try_put_block(ebs, int(name[0]) + i, snap, chunk, checksum, count)
+    ))
+    # Segment format: offset.checksum.length.compressalgo, followed by pack, pack_offset, pack_length for packed exports
+    codec = get_codec(segment[3], dictionary=get_dictionary(s3, prefix) if segment[3] == "zstddict" else None)
+    if len(segment) == 5:  # Deduplicated export: [offset, checksum, length, codec, chunk digests]
+        return get_chunks_from_s3(s3, segment, put_stage, ebsclient_snaps, needed)
+    request = {"Bucket": singleton.S3_BUCKET, "Key": segment_key(prefix, segment)}
+    if len(segment) == 7:
+        request["Key"] = "{}/{}".format(prefix, segment[4])
+        request["Range"] = "bytes={}-{}".format(int(segment[5]), int(segment[5]) + int(segment[6]) - 1)
+    offset = int(segment[0])
+    counted = True
+    for attempt in range(singleton.RETRY_BLOCK_COUNT):
+        h = hashlib.sha256()
+        submitted = []
+        complete = True
+        response = s3.get_object(**request)
+        reader = codec.decoder(response["Body"])
+        for i in range(int(segment[2])):
+            buf = block_pool.acquire()
+            try:
+                with metrics.timer("decompress"):  # Includes reading the compressed stream from S3
+                    data = read_body_into(reader, buf)
+            except BaseException:
+                block_pool.release(buf)
+                raise
+            if len(data) < CHUNK_SIZE:  # Truncated segment, the rest of buf still holds its previous block
+                block_pool.release(buf)
+                complete = False
+                break
+            h.update(data)
+            if needed is None or needed[i]:
+                submitted.append(put_stage.submit(offset + i, buf, ebsclient_snaps, counted, release=block_pool.release))
+            else:  # Overridden by a newer delta layer, only read for the checksum
+                block_pool.release(buf)
+        if complete and urlsafe_b64encode(h.digest()).decode() == segment[1]:
+            return
+        if complete:
+            print(f'Checksum verify for segment {request["Key"]} at block {offset} failed, retrying.')
+        else:
+            print(f'Segment {request["Key"]} at block {offset} ended early, retrying.')
+        for finished in submitted:
+            finished.wait()
+        counted = False
+    print("ERROR: segment", request["Key"], "at block", offset, "is corrupt in the bucket. The snapshot was not completed.")
+    raise SystemExit
 
 # Put a single Block to S3.
 # Data Path: -> S3
@@ -368,14 +1647,388 @@ def get_block_s3(block, ebs, s3, snapshot_prefix):
             Key="{}/{}.{}".format(snapshot_prefix, block["BlockIndex"], h.hexdigest())
         )
 
+# Get a Snapshot Block into buf and verify its Checksum, returning the data to the caller instead of writing it.
+# Data Path: EBS Snapshot -> EBS Direct API -> Local Memory
+def fetch_block_into(block, ebs, snapshot_id, buf):
+    while True:  # We retry indefinitely on checksum failure.
+        resp = try_get_block(ebs, snapshot_id, block["BlockIndex"], block["BlockToken"])
+        data = read_block_into(resp, buf)
+        if verify_checksum(resp["Checksum"], block, data):
+            return data
+
+
+# Write count zeroed blocks to a sequential stream, used for unallocated ranges of a snapshot.
+# Data Path: Local Memory -> Stream
+ZERO_RUN = bytes(CHUNK_SIZE * 64)
+def write_zero_blocks(out, count):
+    zeros = memoryview(ZERO_RUN)
+    while count > 0:
+        run = min(count, len(ZERO_RUN) // CHUNK_SIZE)
+        out.write(zeros[:run * CHUNK_SIZE])
+        count -= run
+
+
+# Fetch blocks concurrently and emit them strictly in BlockIndex order to a non-seekable stream.
+# Blocks finish out of order, so completed blocks wait in a reorder buffer of at most STREAM_WINDOW
+# blocks until everything before them has been written. Memory is bounded by the window, not the volume size.
+# Every block is fetched into a block_pool buffer, which goes back to the pool once it has been written.
+# Data Path: EBS Snapshot -> EBS Direct API -> Reorder Buffer -> Stream
+def stream_blocks(pages, out, snapshot_id, first_block, last_block):
+    ebs = boto3.client("ebs", region_name=singleton.AWS_ORIGIN_REGION)
+    pending = deque()  # (BlockIndex, Future) in BlockIndex order
+    position = first_block
+    num_blocks = 0
+
+    def drain(limit):
+        nonlocal position
+        while len(pending) > limit:
+            index, future, buf = pending.popleft()
+            try:
+                write_zero_blocks(out, index - position)
+                out.write(future.result())
+            finally:
+                block_pool.release(buf)
+            position = index + 1
+
+    with ThreadPoolExecutor(max_workers=STREAM_WORKERS) as executor:
+        for page in pages:
+            for block in page:
+                buf = block_pool.try_acquire()
+                while buf is None:  # Only this thread frees reorder buffer memory, so write out the oldest block instead of waiting
+                    if len(pending) == 0:
+                        buf = block_pool.acquire()
+                    else:
+                        drain(len(pending) - 1)
+                        buf = block_pool.try_acquire()
+                pending.append((block["BlockIndex"], executor.submit(fetch_block_into, block, ebs, snapshot_id, buf), buf))
+                num_blocks += 1
+                drain(STREAM_WINDOW)
+        drain(0)
+    write_zero_blocks(out, last_block - position)
+    out.flush()
+    return num_blocks
+
+
+# Checkpoint journal for resumable transfers: a memory-mapped file holding one bit per block index, set once the
+# block is durable in every target. Workers mark blocks as they are written. Every JOURNAL_INTERVAL seconds the
+# targets are fsync()ed first and only then are the bits marked before the fsync() set and flushed, so the journal
+# never claims a block that could still be lost. Snapshot targets have no files: a PUT is durable once it returns,
+# and the header keeps the number of blocks PUT so far for ChangedBlocksCount. The header also ties the journal to
+# one transfer, its source and its targets.
+# Data Path: N/A, tracks progress and doesn't touch data.
+JOURNAL_MAGIC = b"FSPJRNL1"
+JOURNAL_HEADER = struct.Struct("<8s32sQQ")  # magic, SHA-256 of the transfer identity, number of blocks, blocks PUT
+JOURNAL_INTERVAL = 10
+JOURNAL_SNAPSHOT_TIMEOUT = 4320  # Minutes a journaled pending snapshot waits for blocks before EBS cancels it (the API maximum)
+
+class BlockJournal(object):
+    def __init__(self, path, identity, volume_blocks, files):
+        self.path = path
+        self.files = files
+        digest = hashlib.sha256(identity.encode()).digest()
+        size = JOURNAL_HEADER.size + (volume_blocks + 7) // 8
+        fd = os.open(path, os.O_RDWR | os.O_CREAT)
+        new = os.fstat(fd).st_size == 0
+        if new:
+            os.ftruncate(fd, size)
+        elif os.fstat(fd).st_size != size:
+            os.close(fd)
+            print("ERROR: journal", path, "belongs to a different snapshot or set of targets. Remove it or pick another --journal path.")
+            raise SystemExit
+        self.map = mmap.mmap(fd, size)
+        os.close(fd)
+        if new:
+            self.map[:JOURNAL_HEADER.size] = JOURNAL_HEADER.pack(JOURNAL_MAGIC, digest, volume_blocks, 0)
+            self.map.flush()
+        if JOURNAL_HEADER.unpack(self.map[:JOURNAL_HEADER.size])[:3] != (JOURNAL_MAGIC, digest, volume_blocks):
+            print("ERROR: journal", path, "belongs to a different snapshot or set of targets. Remove it or pick another --journal path.")
+            raise SystemExit
+        self.lock = threading.Lock()
+        self.checkpoint_lock = threading.Lock()
+        self.marked = []
+        self.last_checkpoint = time.perf_counter()
+
+    def is_done(self, block):
+        return self.map[JOURNAL_HEADER.size + block // 8] & (1 << (block % 8)) != 0
+
+    def pending(self, blocks, key=lambda block: block["BlockIndex"]):
+        return [block for block in blocks if not self.is_done(key(block))]
+
+    def put_count(self):
+        return JOURNAL_HEADER.unpack(self.map[:JOURNAL_HEADER.size])[3]
+
+    def mark(self, block, put=False):
+        with self.lock:
+            self.marked.append((block, put))
+            due = time.perf_counter() - self.last_checkpoint >= JOURNAL_INTERVAL
+        if due:
+            self.checkpoint()
+
+    def checkpoint(self):
+        with self.checkpoint_lock:  # One worker checkpoints at a time, the others keep transferring
+            with self.lock:
+                marked = self.marked
+                self.marked = []
+                self.last_checkpoint = time.perf_counter()
+            for file in self.files:
+                fd = os.open(file, os.O_WRONLY)
+                os.fsync(fd)
+                os.close(fd)
+            for block, put in marked:
+                self.map[JOURNAL_HEADER.size + block // 8] |= 1 << (block % 8)
+            magic, digest, volume_blocks, puts = JOURNAL_HEADER.unpack(self.map[:JOURNAL_HEADER.size])
+            puts += sum(1 for block, put in marked if put)
+            self.map[:JOURNAL_HEADER.size] = JOURNAL_HEADER.pack(magic, digest, volume_blocks, puts)
+            self.map.flush()
+
+    # Checkpoint what is left. A completed transfer removes its journal, index cache and snapshot record.
+    def close(self, complete):
+        self.checkpoint()
+        self.map.close()
+        if complete:
+            os.remove(self.path)
+            for sidecar in [self.path + ".index", self.path + ".snapshots"]:
+                if os.path.exists(sidecar):
+                    os.remove(sidecar)
+
+
+# Block index cache kept next to a journal, so a resumed transfer doesn't list the snapshot again while its block
+# tokens are still valid. The expiry is taken from a ListSnapshotBlocks call made before the listing.
+# Metadata Path: EBS Snapshot -> Direct API -> Local Memory -> Local File
+def retrieve_snapshot_blocks_cached(snapshot_id, start_block, end_block, cache_path):
+    identity = [snapshot_id, start_block, end_block]
+    if os.path.exists(cache_path):
+        with open(cache_path, "rb") as f:
+            cache = json.loads(zstandard.decompress(f.read()))
+        if cache["identity"] == identity and time.time() < cache["expiry"] - 3600:  # Leave an hour to finish with them
+            memory_budget.charge(len(cache["blocks"]) * INDEX_ENTRY_SIZE, "the snapshot block index")
+            print("Reusing the cached block index from", cache_path)
+            return [{"BlockIndex": index, "BlockToken": token} for index, token in cache["blocks"]]
+    ebs = boto3.client("ebs", region_name=singleton.AWS_ORIGIN_REGION)
+    expiry = ebs.list_snapshot_blocks(SnapshotId=snapshot_id, MaxResults=100).get("ExpiryTime")
+    blocks = retrieve_snapshot_blocks(snapshot_id, start_block, end_block)
+    if not expiry is None:
+        cache = {"identity": identity, "expiry": expiry.timestamp(), "blocks": [[block["BlockIndex"], block["BlockToken"]] for block in blocks]}
+        with open(cache_path, "wb") as f:
+            f.write(zstandard.compress(json.dumps(cache, separators=(",", ":")).encode(), 3))
+    return blocks
+
+
+# Open the journal of a download or multiclone, and get the blocks still to transfer, from the index cache if valid.
+# Returns (journal, blocks). Without a journal path, it's just the block index.
+# Metadata Path: EBS Snapshot -> Direct API -> Local Memory
+def open_journal(journal_path, snapshot_id, files, start_block=None, end_block=None):
+    if journal_path is None:
+        return None, retrieve_snapshot_blocks(snapshot_id, start_block, end_block)
+    ec2 = boto3.client("ec2", region_name=singleton.AWS_ORIGIN_REGION)
+    gbsize = ec2.describe_snapshots(SnapshotIds=[snapshot_id,],)["Snapshots"][0]["VolumeSize"]
+    journal = BlockJournal(journal_path, "\0".join(["download", snapshot_id] + files), gbsize * GIGABYTE // CHUNK_SIZE, files)
+    blocks = retrieve_snapshot_blocks_cached(snapshot_id, start_block, end_block, journal_path + ".index")
+    pending = journal.pending(blocks)
+    if len(pending) < len(blocks):
+        print("Resuming from journal", journal_path + ":", len(blocks) - len(pending), "of", len(blocks), "blocks are already written.")
+    return journal, pending
+
+
+# Start the snapshots of an upload, copy, sync or fanout, or reattach to the pending snapshots recorded with its
+# journal. The snapshot IDs are written next to the journal (<journal>.snapshots) before any block is PUT, and the
+# block counters restart from the blocks the journal already counted. Returns (journal, ebsclient_snaps) like
+# start_snapshots(), and the journal is None without a journal path.
+# Metadata Path: EBS Direct API(s) -> Local File
+def start_snapshots_journaled(journal_path, identity, destination_regions, gbsize, description, parent_snapshot_id=None):
+    if journal_path is None:
+        return None, start_snapshots(destination_regions, gbsize, description, parent_snapshot_id)
+    identity = "\0".join(identity + destination_regions)
+    journal = BlockJournal(journal_path, identity, gbsize * GIGABYTE // CHUNK_SIZE, [])
+    record = journal_path + ".snapshots"
+    if not os.path.exists(record):
+        ebsclient_snaps = start_snapshots(destination_regions, gbsize, description, parent_snapshot_id, JOURNAL_SNAPSHOT_TIMEOUT)
+        with open(record + ".tmp", "w") as f:
+            json.dump({region: ebsclient_snaps[region]["snapshot"]["SnapshotId"] for region in ebsclient_snaps}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(record + ".tmp", record)
+        return journal, ebsclient_snaps
+    with open(record, "r") as f:
+        snapshots = json.load(f)
+    ebsclient_snaps = {}
+    for region in destination_regions:
+        ec2 = boto3.client("ec2", region_name=region)
+        state = ec2.describe_snapshots(SnapshotIds=[snapshots[region],],)["Snapshots"][0]["State"]
+        if state != "pending":
+            print("ERROR: snapshot", snapshots[region], "in", region, "recorded by journal", journal_path, "is", state, "and can't be resumed. Remove the journal to start over.")
+            raise SystemExit
+        ebsclient_snaps[region] = {
+            "client": boto3.client("ebs", region_name=region),
+            "snapshot": {"SnapshotId": snapshots[region]},
+            "count": Counter(Manager(), journal.put_count())
+        }
+    print("Resuming from journal", journal_path + ":", "reattached to", ", ".join(snapshots[region] for region in destination_regions) + ",", journal.put_count(), "blocks already PUT.")
+    return journal, ebsclient_snaps
+
+
+# Complete the snapshots of a journaled transfer, then remove the journal. Without a journal it's complete_snapshots().
+# Metadata Path: EBS Direct API(s)
+def complete_snapshots_journaled(journal, ebsclient_snaps):
+    if not journal is None:
+        journal.checkpoint()
+    output = complete_snapshots(ebsclient_snaps)
+    if not journal is None:
+        journal.close(True)
+    return output
+
+
+# Merkle tree over the block checksums of [first_block, last_block). The leaves are the block checksums, with the
+# sparse checksum for blocks that aren't listed, and every node is the SHA-256 of its MERKLE_FANOUT children.
+# Returns the levels above the leaves as concatenated 32 byte digests, from the level above the leaves up to the root.
+# Data Path: N/A, operates on checksums and doesn't touch data.
+def merkle_levels(checksums, first_block, last_block):
+    count = max(last_block - first_block, 0)
+    memory_budget.charge(count * 32 // (MERKLE_FANOUT - 1), "the Merkle tree")
+    with memory_budget.reserve(count * 32):
+        level = bytearray(b64decode(KNOWN_SPARSE_CHECKSUM) * count)
+        for index, checksum in checksums.items():
+            if first_block <= index < last_block:
+                offset = (index - first_block) * 32
+                level[offset:offset + 32] = b64decode(checksum)
+        levels = []
+        step = MERKLE_FANOUT * 32
+        while len(level) > 32:
+            level = b"".join(hashlib.sha256(level[i:i + step]).digest() for i in range(0, len(level), step))
+            levels.append(level)
+    return levels
+
+
+# Compare two checksum manifests of the same block range top-down, only descending into the subtrees whose hashes
+# differ. Returns the differing block indices, after visiting O(differences * log(blocks)) nodes instead of all blocks.
+# Data Path: N/A, operates on checksums and doesn't touch data.
+def merkle_diff(manifest_one, manifest_two):
+    first_block, last_block = manifest_one["range"]
+    levels_one, levels_two = manifest_one["merkle"], manifest_two["merkle"]
+    candidates = range(1) if len(levels_one) > 0 else range(last_block - first_block)
+    for depth in range(len(levels_one) - 1, -1, -1):
+        one, two = levels_one[depth], levels_two[depth]
+        below = len(levels_one[depth - 1]) // 32 if depth > 0 else last_block - first_block
+        differing = [node for node in candidates if one[node * 32:(node + 1) * 32] != two[node * 32:(node + 1) * 32]]
+        candidates = [child for node in differing for child in range(node * MERKLE_FANOUT, min((node + 1) * MERKLE_FANOUT, below))]
+    checksums_one, checksums_two = manifest_one["checksums"], manifest_two["checksums"]
+    return [first_block + leaf for leaf in candidates
+            if checksums_one.get(first_block + leaf, KNOWN_SPARSE_CHECKSUM) != checksums_two.get(first_block + leaf, KNOWN_SPARSE_CHECKSUM)]
+
+
+# Block checksum manifest of a download or upload, written with --manifest from the checksum of every block
+# transferred, together with its Merkle tree. verify hashes a local image against it, so checking a download runs at
+# local disk speed, or compares two manifests by their trees. Blocks in the range that aren't listed are zeros.
+# Data Path: Local Memory -> Local File
+def put_checksum_manifest(path, snapshot_id, volume_size, first_block, last_block, checksums):
+    manifest = {
+        "version": 1,
+        "snapshot_id": snapshot_id,
+        "volume_size": volume_size,
+        "chunk_size": CHUNK_SIZE,
+        "range": [first_block, last_block],
+        "checksums": sorted([index, checksum] for index, checksum in checksums.items() if checksum != KNOWN_SPARSE_CHECKSUM),
+        "merkle": {
+            "fanout": MERKLE_FANOUT,
+            "levels": [b64encode(level).decode() for level in merkle_levels(checksums, first_block, last_block)]
+        }
+    }
+    with open(path + ".tmp", "wb") as f:
+        f.write(zstandard.compress(json.dumps(manifest, separators=(",", ":")).encode(), 3))
+    os.replace(path + ".tmp", path)
+
+
+# Load a checksum manifest written by put_checksum_manifest(), with the checksums as {block index: checksum} and
+# the Merkle tree levels as bytes. The tree is rebuilt for manifests written without one or with another fanout.
+# Data Path: Local File -> Local Memory
+def get_checksum_manifest(path):
+    with open(path, "rb") as f:
+        manifest = json.loads(zstandard.decompress(f.read()))
+    if manifest.get("chunk_size") != CHUNK_SIZE:
+        print("ERROR:", path, "is not a checksum manifest of", CHUNK_SIZE, "byte blocks.")
+        raise SystemExit
+    memory_budget.charge(len(manifest["checksums"]) * INDEX_ENTRY_SIZE, "the checksum manifest")
+    manifest["checksums"] = {index: checksum for index, checksum in manifest["checksums"]}
+    merkle = manifest.get("merkle")
+    if merkle is None or merkle["fanout"] != MERKLE_FANOUT:
+        manifest["merkle"] = merkle_levels(manifest["checksums"], *manifest["range"])
+    else:
+        manifest["merkle"] = [b64decode(level) for level in merkle["levels"]]
+    return manifest
+
+
+# Hash the blocks [first_block, last_block) of a local image with large sequential reads, yielding (index, checksum).
+# Reads past the end of a file count as zeros, since a download leaves trailing unallocated blocks unwritten.
+# hashlib releases the GIL, so ranges hash in parallel threads.
+# Data Path: File / Block Device -> Local Memory
+def iterate_image_checksums(file_path, first_block, last_block):
+    with memory_budget.reserve(VERIFY_READ_SIZE), open(file_path, "rb", buffering=0) as f:
+        view = memoryview(bytearray(VERIFY_READ_SIZE))
+        f.seek(first_block * CHUNK_SIZE)
+        block = first_block
+        while block < last_block:
+            count = min(VERIFY_READ_SIZE // CHUNK_SIZE, last_block - block)
+            length = count * CHUNK_SIZE
+            got = 0
+            while got < length:
+                n = f.readinto(view[got:length])
+                if not n:
+                    view[got:length] = bytes(length - got)
+                    break
+                got += n
+            for i in range(count):
+                yield block + i, block_checksum(view[i * CHUNK_SIZE:(i + 1) * CHUNK_SIZE])
+            block += count
+
+
+# Indices of the blocks of a local image range that don't match the checksums of a manifest.
+# Data Path: File / Block Device -> Local Memory
+def hash_image_range(file_path, first_block, last_block, checksums):
+    return [index for index, checksum in iterate_image_checksums(file_path, first_block, last_block)
+            if checksum != checksums.get(index, KNOWN_SPARSE_CHECKSUM)]
+
+
+# The (index, checksum) pairs of the non-zero blocks of a local image range. Zero blocks are left out, like in a manifest.
+# Data Path: File / Block Device -> Local Memory
+def image_range_checksums(file_path, first_block, last_block):
+    return [(index, checksum) for index, checksum in iterate_image_checksums(file_path, first_block, last_block)
+            if checksum != KNOWN_SPARSE_CHECKSUM]
+
+
+# Checksums of the blocks of a local image range as {block index: checksum}, hashed in parallel.
+# Data Path: File / Block Device -> Local Memory
+def image_checksums(file_path, first_block, last_block):
+    split = [array for array in np.array_split(range(first_block, last_block), singleton.NUM_JOBS) if len(array) > 0]
+    with Parallel(n_jobs=singleton.NUM_JOBS, require="sharedmem") as parallel:
+        results = parallel(
+            delayed(image_range_checksums)(file_path, int(array[0]), int(array[-1]) + 1)
+            for array in split
+        )
+    memory_budget.charge(sum(len(result) for result in results) * INDEX_ENTRY_SIZE, "the image checksums")
+    return {index: checksum for result in results for index, checksum in result}
+
+
+# Fetch the block index entries of the given block indices only. A few scattered runs are listed one by one,
+# otherwise the whole range is listed once and filtered.
+# Metadata Path: EBS Snapshot -> Direct API -> Local Memory
+def retrieve_snapshot_blocks_at(snapshot_id, indices, first_block, last_block):
+    runs = block_runs(indices)
+    wanted = set(indices)
+    if len(runs) <= (last_block - first_block) // 10000 + 1:  # Fewer List calls than listing the whole range
+        pages = [page for start, length in runs for page in iterate_snapshot_blocks(snapshot_id, start, start + length)]
+    else:
+        pages = iterate_snapshot_blocks(snapshot_id, first_block, last_block)
+    return [block for page in pages for block in page if block["BlockIndex"] in wanted]
+
+
 # Wrapper around get_block() that parallelizes individual get_block() retrievals.
 # Data Path:
-def get_blocks(array, files, snapshot_id):
+def get_blocks(array, files, snapshot_id, journal=None, checksums=None, verify_stage=None):
     ebs = boto3.client("ebs", region_name=singleton.AWS_ORIGIN_REGION) # we spawn a client per snapshot segment
     with Parallel(n_jobs=singleton.NUM_JOBS) as parallel2:
         parallel2(
             delayed(get_block)(
-                block, ebs, files, snapshot_id
+                block, ebs, files, snapshot_id, journal, checksums, verify_stage=verify_stage
             )
             for block in array
         )
@@ -421,37 +2074,41 @@ def validate_file_paths_read(files):
 
 # Wrapper that parallelizes copying blocks between EBS Snapshots.
 # Data Path: EBS Snapshot -> Direct API -> Local Memory -> Direct API 2 -> EBS Snapshot 2
-def copy_blocks_to_snap(command, snapshot, array, snap, count):
+def copy_blocks_to_snap(command, snapshot, array, snap, count, journal=None):
     ebs = boto3.client("ebs", region_name=singleton.AWS_ORIGIN_REGION) # we spawn a client per snapshot segment
     ebs2 = boto3.client("ebs", region_name=singleton.AWS_DEST_REGION) # Using separate client for upload. This will allow cross-region/account copies.
     with Parallel(n_jobs=singleton.NUM_JOBS) as parallel2:
         parallel2(
             delayed(copy_block_to_snap)(
-                command, snapshot, block, ebs, ebs2, snap, count
+                command, snapshot, block, ebs, ebs2, snap, count, journal
             )
             for block in array
         )
 
 # Copy individual block from Source EBS Snapshot to Destination EBS Snapshot.
 # Data Path: EBS Snaphot -> Direct API -> Local Memory -> Direct API 2 -> EBS Snapshot 2
-def copy_block_to_snap(command, snapshot, block, ebs, ebs2, snap, count):
-    if command == "copy":
-        resp = try_get_block(ebs, snapshot, block["BlockIndex"], block["BlockToken"])
-    elif command == "sync":
-        resp = try_get_block(ebs, snapshot, block["BlockIndex"], block["SecondBlockToken"])
-    if "BlockToken" in resp:
-        data = resp["BlockToken"].read()
-        checksum = b64encode(hashlib.sha256(data).digest()).decode()
-        try_put_block(ebs2, block["BlockIndex"], snap["SnapshotId"], data, checksum, count)
+def copy_block_to_snap(command, snapshot, block, ebs, ebs2, snap, count, journal=None):
+    response = None
+    with block_pool.buffer() as buf:
+        if command == "copy":
+            resp = try_get_block(ebs, snapshot, block["BlockIndex"], block["BlockToken"])
+        elif command == "sync":
+            resp = try_get_block(ebs, snapshot, block["BlockIndex"], block["SecondBlockToken"])
+        if "BlockData" in resp:
+            data = read_block_into(resp, buf)
+            checksum = block_checksum(data)
+            response = try_put_block(ebs2, block["BlockIndex"], snap["SnapshotId"], data, checksum, count)
+    if not journal is None:
+        journal.mark(block["BlockIndex"], not response is None)
 
 # Wrapper around put_block_from_file() that parallelizes individual block uploads.
 # Data path: File / Device -> EBS Direct API -> EBS Snapshot
-def put_blocks(array, snap_id, OUTFILE, count):
+def put_blocks(array, snap_id, OUTFILE, count, journal=None, checksums=None, skip_sparse=True):
     ebs = boto3.client("ebs", region_name=singleton.AWS_DEST_REGION)
     with Parallel(n_jobs=singleton.NUM_JOBS) as parallel2:
         parallel2(
             delayed(put_block_from_file)(
-                block, ebs, snap_id, OUTFILE, count
+                block, ebs, snap_id, OUTFILE, count, journal, checksums, skip_sparse
             ) 
             for block in array
         )
@@ -470,34 +2127,76 @@ def chunk_and_align(array, gap=1, offset=64):
             result.append(segment)
             segment = []
             segment.append(item)
+    if len(segment) > 0:
+        result.append(segment)
     return result
 
-# Get Block Metadata from an EBS snapshot.
+# Builds the StartingBlockIndex / MaxResults arguments for ListSnapshotBlocks and ListChangedBlocks.
+# Restricting the page size to the requested range means a small range costs a single List call.
+# Metadata Path: N/A
+def block_range_params(start_block=None, end_block=None):
+    params = {}
+    if start_block is not None:
+        params["StartingBlockIndex"] = start_block
+    if end_block is not None:
+        params["MaxResults"] = min(max(end_block - (start_block or 0), 100), 10000) # API accepts 100 - 10000
+    return params
+
+
+# Drops blocks at or beyond end_block. The List APIs return blocks in ascending BlockIndex order,
+# so the second return value tells the caller that no further pages are needed.
+# Metadata Path: N/A
+def clip_blocks(blocks, end_block=None):
+    if end_block is None or len(blocks) == 0 or blocks[-1]["BlockIndex"] < end_block:
+        return blocks, False
+    return [block for block in blocks if block["BlockIndex"] < end_block], True
+
+
+# Lazily page through Block Metadata of an EBS snapshot, optionally only for blocks in [start_block, end_block).
+# Yields one list of blocks per ListSnapshotBlocks page, so callers that stream don't have to hold the whole index.
 # Metadata Path: EBS Snapshot -> Direct API -> Local Memory
-def retrieve_snapshot_blocks(snapshot_id):
+def iterate_snapshot_blocks(snapshot_id, start_block=None, end_block=None):
     ebs = boto3.client("ebs", region_name=singleton.AWS_ORIGIN_REGION)
+    params = block_range_params(start_block, end_block)
+    response = ebs.list_snapshot_blocks(SnapshotId=snapshot_id, **params)
+    page, done = clip_blocks(response['Blocks'], end_block)
+    yield page
+    while 'NextToken' in response and not done:
+        params.pop("StartingBlockIndex", None)
+        response = ebs.list_snapshot_blocks(SnapshotId=snapshot_id, NextToken = response['NextToken'], **params)
+        page, done = clip_blocks(response['Blocks'], end_block)
+        yield page
+
+
+# Get Block Metadata from an EBS snapshot, optionally only for blocks in [start_block, end_block).
+# Metadata Path: EBS Snapshot -> Direct API -> Local Memory
+def retrieve_snapshot_blocks(snapshot_id, start_block=None, end_block=None):
     blocks = []
-    response = ebs.list_snapshot_blocks(SnapshotId=snapshot_id)
-    blocks = response['Blocks']
-    while 'NextToken' in response:
-        response = ebs.list_snapshot_blocks(SnapshotId=snapshot_id, NextToken = response['NextToken'])
-        blocks.extend(response['Blocks'])
+    for page in iterate_snapshot_blocks(snapshot_id, start_block, end_block):
+        memory_budget.charge(len(page) * INDEX_ENTRY_SIZE, "the snapshot block index")
+        blocks.extend(page)
     return blocks
 
 
-# Get Block Metadata from a diff of two Snapshots.
+# Get Block Metadata from a diff of two Snapshots, optionally only for blocks in [start_block, end_block).
 # Metadata Path: EBS Snapshot -> EBS Direct API -> Local Memory
-def retrieve_differential_snapshot_blocks(snapshot_id_one, snapshot_id_two):
+def retrieve_differential_snapshot_blocks(snapshot_id_one, snapshot_id_two, start_block=None, end_block=None):
     ebs = boto3.client("ebs", region_name=singleton.AWS_ORIGIN_REGION)
-    response = ebs.list_changed_blocks(FirstSnapshotId=snapshot_id_one, SecondSnapshotId=snapshot_id_two)
-    blocks = response["ChangedBlocks"]
-    while "NextToken" in response:
+    params = block_range_params(start_block, end_block)
+    response = ebs.list_changed_blocks(FirstSnapshotId=snapshot_id_one, SecondSnapshotId=snapshot_id_two, **params)
+    blocks, done = clip_blocks(response["ChangedBlocks"], end_block)
+    memory_budget.charge(len(blocks) * INDEX_ENTRY_SIZE, "the changed block index")
+    while "NextToken" in response and not done:
+        params.pop("StartingBlockIndex", None)
         response = ebs.list_changed_blocks(
             FirstSnapshotId=snapshot_id_one,
             SecondSnapshotId=snapshot_id_two,
-            NextToken=response['NextToken']
+            NextToken=response['NextToken'],
+            **params
         )
-        blocks.extend(response['ChangedBlocks'])
+        page, done = clip_blocks(response['ChangedBlocks'], end_block)
+        memory_budget.charge(len(page) * INDEX_ENTRY_SIZE, "the changed block index")
+        blocks.extend(page)
     return blocks
 
 
@@ -526,7 +2225,7 @@ def validate_s3_bucket(region, check_is_read, check_is_write): #Return if user h
     valid = True
     try:
         session=boto3.Session(profile_name=singleton.AWS_S3_PROFILE)
-        s3 = session.client("s3", region_name=region, endpoint_url=singleton.AWS_S3_ENDPOINT_URL)
+        s3 = metrics.instrument(session.client("s3", region_name=region, endpoint_url=singleton.AWS_S3_ENDPOINT_URL))
         try:
             response = s3.get_bucket_acl(Bucket=singleton.S3_BUCKET)["Grants"]
         except ClientError as e:  # Some S3 implementations don't support GetBucketAcl(), in that case ignore and hope we can continue.
@@ -586,30 +2285,80 @@ def diff(snapshot_id_one, snapshot_id_two):
     blocks = retrieve_differential_snapshot_blocks(snapshot_id_one, snapshot_id_two)
     print('Changes between', snapshot_id_one, 'and', snapshot_id_two, 'contain', len(blocks), 'chunks and', CHUNK_SIZE * len(blocks), 'bytes, took', round (time.perf_counter() - start_time,2), "seconds.")
 
-def download(snapshot_id, file_path):
+def download(snapshot_id, file_path, start_block=None, end_block=None, stream=False, journal_path=None, manifest_path=None):
     validate_snapshot(snapshot_id)
+    if stream or file_path == "-":
+        if not journal_path is None:
+            print("ERROR: a stream can't be resumed, --journal needs a seekable file or device.")
+            raise SystemExit
+        if not manifest_path is None:
+            print("ERROR: a stream can't be verified, --manifest needs a seekable file or device.")
+            raise SystemExit
+        download_stream(snapshot_id, file_path, start_block, end_block)
+        return
+    if not journal_path is None and not manifest_path is None:
+        print("ERROR: --manifest can't be combined with --journal, a resumed download doesn't see the checksums of the blocks it skips.")
+        raise SystemExit
     files = []
     files.append(file_path)
     validate_file_paths(files)
     start_time = time.perf_counter()
-    blocks = retrieve_snapshot_blocks(snapshot_id)
+    checksums = None if manifest_path is None else {}
+    journal, blocks = open_journal(journal_path, snapshot_id, files, start_block, end_block)
     print('Snapshot', snapshot_id, 'contains', len(blocks), 'chunks and', CHUNK_SIZE * len(blocks), 'bytes, took', round (time.perf_counter() - start_time,2), "seconds.")
     split = np.array_split(blocks, singleton.NUM_JOBS)
     start_time = time.perf_counter()
     num_blocks = len(blocks)
     print(files)
-    with Parallel(n_jobs=singleton.NUM_JOBS, require="sharedmem") as parallel:
-        parallel(delayed(get_blocks)(array, files, snapshot_id) for array in split)
+    complete = False
+    verify_stage = VerifyStage(VERIFY_WORKERS, singleton.NUM_JOBS * singleton.NUM_JOBS)
+    try:
+        try:
+            with Parallel(n_jobs=singleton.NUM_JOBS, require="sharedmem") as parallel:
+                parallel(delayed(get_blocks)(array, files, snapshot_id, journal, checksums, verify_stage) for array in split)
+        finally:
+            verify_stage.close()  # Blocks handed over must be written before the journal is closed
+        complete = True
+    finally:
+        if not journal is None:
+            journal.close(complete)
+    if not manifest_path is None:
+        ec2 = boto3.client("ec2", region_name=singleton.AWS_ORIGIN_REGION)
+        gbsize = ec2.describe_snapshots(SnapshotIds=[snapshot_id,],)["Snapshots"][0]["VolumeSize"]
+        volume_blocks = gbsize * GIGABYTE // CHUNK_SIZE
+        first_block = 0 if start_block is None else min(start_block, volume_blocks)
+        last_block = volume_blocks if end_block is None else min(end_block, volume_blocks)
+        put_checksum_manifest(manifest_path, snapshot_id, gbsize, first_block, last_block, checksums)
+        print("Wrote the checksums of", len(checksums), "blocks to", manifest_path)
     print('download took',round(time.perf_counter() - start_time, 2), 'seconds at', round(CHUNK_SIZE * num_blocks / (time.perf_counter() - start_time), 2), 'bytes/sec.')
 
-def deltadownload(snapshot_id_one, snapshot_id_two, file_path):
+def download_stream(snapshot_id, file_path, start_block=None, end_block=None):
+    if file_path == "-":
+        out = sys.__stdout__.buffer  # main.py already routes print() to stderr for this case
+    else:
+        out = open(file_path, "wb")
+    ec2 = boto3.client("ec2", region_name=singleton.AWS_ORIGIN_REGION)
+    gbsize = ec2.describe_snapshots(SnapshotIds=[snapshot_id,],)["Snapshots"][0]["VolumeSize"]
+    first_block = 0 if start_block is None else start_block
+    last_block = gbsize * GIGABYTE // CHUNK_SIZE
+    if not end_block is None:
+        last_block = min(end_block, last_block)
+    start_time = time.perf_counter()
+    pages = iterate_snapshot_blocks(snapshot_id, first_block, last_block)
+    num_blocks = stream_blocks(pages, out, snapshot_id, first_block, last_block)
+    if file_path != "-":
+        out.close()
+    print('Snapshot', snapshot_id, 'contains', num_blocks, 'chunks and', CHUNK_SIZE * num_blocks, 'bytes in the streamed range.')
+    print('download took',round(time.perf_counter() - start_time, 2), 'seconds at', round(CHUNK_SIZE * (last_block - first_block) / (time.perf_counter() - start_time), 2), 'bytes/sec.')
+
+def deltadownload(snapshot_id_one, snapshot_id_two, file_path, start_block=None, end_block=None):
     validate_snapshot(snapshot_id_one)
     validate_snapshot(snapshot_id_two)
     files = []
     files.append(file_path)
     validate_file_paths(files)
     start_time = time.perf_counter()
-    blocks = retrieve_differential_snapshot_blocks(snapshot_id_one, snapshot_id_two)
+    blocks = retrieve_differential_snapshot_blocks(snapshot_id_one, snapshot_id_two, start_block, end_block)
     split = np.array_split(blocks, singleton.NUM_JOBS)
     num_blocks = len(blocks)
     print('Changes between', snapshot_id_one, 'and', snapshot_id_two, 'contain', len(blocks), 'chunks and', CHUNK_SIZE * len(blocks), 'bytes, took', round (time.perf_counter() - start_time,2), "seconds.")
@@ -621,176 +2370,478 @@ def deltadownload(snapshot_id_one, snapshot_id_two, file_path):
         )  # retrieve the blocks of snapshot_one missing in snapshot_two
     print('deltadownload took',round(time.perf_counter() - start_time,2), 'seconds at', round(CHUNK_SIZE * num_blocks / (time.perf_counter() - start_time),2), 'bytes/sec.')
 
-def upload(file_path, parent_snapshot_id):
+def upload(file_path, parent_snapshot_id, start_block=None, end_block=None, size=None, journal_path=None, manifest_path=None, parent_manifest_path=None):
+    if (is_s3_source(file_path) or is_stream_source(file_path)) and not journal_path is None:
+        print("ERROR: --journal needs a seekable file or device to resume from.")
+        raise SystemExit
+    if (is_s3_source(file_path) or is_stream_source(file_path)) and not (manifest_path is None and parent_manifest_path is None):
+        print("ERROR: --manifest and --parent_manifest need a seekable file or device.")
+        raise SystemExit
+    if not journal_path is None and not manifest_path is None and parent_manifest_path is None:
+        print("ERROR: --manifest can't be combined with --journal, a resumed upload doesn't see the checksums of the blocks it skips.")
+        raise SystemExit
+    if is_s3_source(file_path):
+        upload_s3(file_path, parent_snapshot_id, start_block, end_block)
+        return
+    if is_stream_source(file_path):
+        upload_stream(file_path, parent_snapshot_id, start_block, end_block, size)
+        return
     files = []
     files.append(file_path)
     validate_file_paths_read(files)
     start_time = time.perf_counter()
-    ebs = boto3.client("ebs", region_name=singleton.AWS_ORIGIN_REGION)
     with os.fdopen(os.open(file_path, os.O_RDONLY | os.O_NONBLOCK), "rb+") as f: #! Warning: these file permissions could cause problems on windows
         f.seek(0, os.SEEK_END)
         size = f.tell()
         gbsize = math.ceil(size / GIGABYTE)
         chunks = math.ceil(size / CHUNK_SIZE)
-        split = np.array_split(range(chunks), singleton.NUM_JOBS)
-        count = Counter(Manager(), 0)
+        first_chunk = 0 if start_block is None else min(start_block, chunks)
+        last_chunk = chunks if end_block is None else min(end_block, chunks)
         print("Size of", file_path, "is", size, "bytes and", chunks, "chunks")
-        if parent_snapshot_id is None:
-            snap = ebs.start_snapshot(VolumeSize=gbsize, Description="Uploaded by fsp.py from "+file_path)
-        else:
-            snap = ebs.start_snapshot(VolumeSize=gbsize, Description="Uploaded by fsp.py from "+file_path, ParentSnapshotId=parent_snapshot_id)
+        if first_chunk != 0 or last_chunk != chunks:
+            print("Uploading chunks", first_chunk, "to", last_chunk, "only")
+        checksums = None if manifest_path is None else {}
+        changed = None
+        if not parent_manifest_path is None:
+            parent = get_checksum_manifest(parent_manifest_path)
+            if parent_snapshot_id is None:
+                parent_snapshot_id = parent["snapshot_id"]
+            if parent["snapshot_id"] != parent_snapshot_id or parent["range"] != [first_chunk, last_chunk]:
+                print("ERROR:", parent_manifest_path, "describes blocks", parent["range"][0], "to", parent["range"][1], "of", parent["snapshot_id"] + ", not blocks", first_chunk, "to", last_chunk, "of", parent_snapshot_id + ".")
+                raise SystemExit
+            checksums = image_checksums(file_path, first_chunk, last_chunk)
+            current = {"range": [first_chunk, last_chunk], "checksums": checksums, "merkle": merkle_levels(checksums, first_chunk, last_chunk)}
+            changed = merkle_diff(current, parent)
+            print(len(changed), "of", last_chunk - first_chunk, "chunks differ from", parent_snapshot_id, "and will be uploaded, took", round(time.perf_counter() - start_time,2), "seconds.")
+        identity = ["upload", os.path.abspath(file_path), str(size), str(parent_snapshot_id), str(first_chunk), str(last_chunk)]
+        journal, ebsclient_snaps = start_snapshots_journaled(journal_path, identity, [singleton.AWS_ORIGIN_REGION], gbsize, "Uploaded by fsp.py from "+file_path, parent_snapshot_id)
+        snap = ebsclient_snaps[singleton.AWS_ORIGIN_REGION]["snapshot"]
+        count = ebsclient_snaps[singleton.AWS_ORIGIN_REGION]["count"]
+        chunk_range = range(first_chunk, last_chunk) if changed is None else changed
+        if not journal is None:
+            chunk_range = journal.pending(chunk_range, key=int)
+        split = np.array_split(chunk_range, singleton.NUM_JOBS)
         with Parallel(n_jobs=singleton.NUM_JOBS, require="sharedmem") as parallel:
             parallel(
-                delayed(put_blocks)(array, snap["SnapshotId"], file_path, count) 
+                # Changed blocks that are now zeros have to overwrite the parent's data, so they can't be skipped
+                delayed(put_blocks)(array, snap["SnapshotId"], file_path, count, journal, checksums if changed is None else None, changed is None)
                 for array in split
             )
-        ebs.complete_snapshot(SnapshotId=snap["SnapshotId"], ChangedBlocksCount=count.value())
+        complete_snapshots_journaled(journal, ebsclient_snaps)
+        if not manifest_path is None:
+            put_checksum_manifest(manifest_path, snap["SnapshotId"], gbsize, first_chunk, last_chunk, checksums)
+            print("Wrote the checksums of", len(checksums), "blocks to", manifest_path)
         print(file_path,'took',round(time.perf_counter() - start_time,2), 'seconds at', round(CHUNK_SIZE * count.value() / (time.perf_counter() - start_time),2), 'bytes/sec.')
         print('Total chunks uploaded', count.value())
         print('Use the upload functionality at your own risk. Works on my machine...')
         print(snap["SnapshotId"]) # Always print Snapshot ID last, for easy | tail -1
 
-def copy(snapshot_id):
+def upload_stream(file_path, parent_snapshot_id, start_block=None, end_block=None, size=None):
+    source = open_stream_source(file_path, size)
+    start_time = time.perf_counter()
+    gbsize = math.ceil(size / GIGABYTE)
+    print("Streaming", file_path, "into a", gbsize, "GiB snapshot")
+    ebsclient_snaps = start_snapshots([singleton.AWS_ORIGIN_REGION], gbsize, "Uploaded by fsp.py from "+file_path, parent_snapshot_id)
+    ebs = ebsclient_snaps[singleton.AWS_ORIGIN_REGION]["client"]
+    snap = ebsclient_snaps[singleton.AWS_ORIGIN_REGION]["snapshot"]
+    count = ebsclient_snaps[singleton.AWS_ORIGIN_REGION]["count"]
+    chunks = stream_put_blocks(source, ebsclient_snaps, gbsize * GIGABYTE // CHUNK_SIZE, start_block, end_block)
+    ebs.complete_snapshot(SnapshotId=snap["SnapshotId"], ChangedBlocksCount=count.value())
+    print(file_path,'took',round(time.perf_counter() - start_time,2), 'seconds at', round(CHUNK_SIZE * chunks / (time.perf_counter() - start_time),2), 'bytes/sec.')
+    print('Total chunks read', chunks, 'and uploaded', count.value())
+    print(snap["SnapshotId"]) # Always print Snapshot ID last, for easy | tail -1
+
+def upload_s3(file_path, parent_snapshot_id, start_block=None, end_block=None):
+    bucket, key = parse_s3_url(file_path)
+    session=boto3.Session(profile_name=singleton.AWS_S3_PROFILE)
+    s3 = metrics.instrument(session.client("s3", region_name=singleton.AWS_ORIGIN_REGION, endpoint_url=singleton.AWS_S3_ENDPOINT_URL))
+    start_time = time.perf_counter()
+    size = s3.head_object(Bucket=bucket, Key=key)["ContentLength"]
+    gbsize = math.ceil(size / GIGABYTE)
+    chunks = math.ceil(size / CHUNK_SIZE)
+    first_chunk = 0 if start_block is None else min(start_block, chunks)
+    last_chunk = chunks if end_block is None else min(end_block, chunks)
+    print("Size of", file_path, "is", size, "bytes and", chunks, "chunks")
+    if first_chunk != 0 or last_chunk != chunks:
+        print("Uploading chunks", first_chunk, "to", last_chunk, "only")
+    ebsclient_snaps = start_snapshots([singleton.AWS_ORIGIN_REGION], gbsize, "Uploaded by fsp.py from "+file_path, parent_snapshot_id)
+    ebs = ebsclient_snaps[singleton.AWS_ORIGIN_REGION]["client"]
+    snap = ebsclient_snaps[singleton.AWS_ORIGIN_REGION]["snapshot"]
+    count = ebsclient_snaps[singleton.AWS_ORIGIN_REGION]["count"]
+    put_stage = PutStage(singleton.NUM_JOBS * singleton.NUM_JOBS, 2 * singleton.NUM_JOBS * singleton.NUM_JOBS)
+    with Parallel(n_jobs=singleton.NUM_JOBS, require="sharedmem") as parallel:
+        parallel(
+            delayed(get_range_from_s3)(s3, bucket, key, size, first, min(first + S3_RANGE_BLOCKS, last_chunk), put_stage, ebsclient_snaps)
+            for first in range(first_chunk, last_chunk, S3_RANGE_BLOCKS)
+        )
+    put_stage.close()
+    ebs.complete_snapshot(SnapshotId=snap["SnapshotId"], ChangedBlocksCount=count.value())
+    print(file_path,'took',round(time.perf_counter() - start_time,2), 'seconds at', round(CHUNK_SIZE * (last_chunk - first_chunk) / (time.perf_counter() - start_time),2), 'bytes/sec.')
+    print('Total chunks read', last_chunk - first_chunk, 'and uploaded', count.value())
+    print(snap["SnapshotId"]) # Always print Snapshot ID last, for easy | tail -1
+
+def copy(snapshot_id, start_block=None, end_block=None, journal_path=None):
     validate_snapshot(snapshot_id)
     start_time = time.perf_counter()
-    blocks = retrieve_snapshot_blocks(snapshot_id)
+    ec2 = boto3.client("ec2", region_name=singleton.AWS_ORIGIN_REGION)
+    gbsize = ec2.describe_snapshots(SnapshotIds=[snapshot_id,],)["Snapshots"][0]["VolumeSize"]
+    identity = ["copy", snapshot_id, str(start_block), str(end_block)]
+    # The destination snapshot is in AWS_DEST_REGION, using a separate client for upload. This will allow cross-region/account copies.
+    journal, ebsclient_snaps = start_snapshots_journaled(journal_path, identity, [singleton.AWS_DEST_REGION], gbsize, 'Copied by fsp.py from '+snapshot_id)
+    snap = ebsclient_snaps[singleton.AWS_DEST_REGION]["snapshot"]
+    count = ebsclient_snaps[singleton.AWS_DEST_REGION]["count"]
+    if journal is None:
+        blocks = retrieve_snapshot_blocks(snapshot_id, start_block, end_block)
+    else:
+        blocks = journal.pending(retrieve_snapshot_blocks_cached(snapshot_id, start_block, end_block, journal_path + ".index"))
     print('Snapshot', snapshot_id, 'contains', len(blocks), 'chunks and', CHUNK_SIZE * len(blocks), 'bytes, took', round (time.perf_counter() - start_time,2), "seconds.")
     split = np.array_split(blocks, singleton.NUM_JOBS)
     start_time = time.perf_counter()
     num_blocks = len(blocks)
-    ec2 = boto3.client("ec2", region_name=singleton.AWS_ORIGIN_REGION)
-    ebs2 = boto3.client("ebs", region_name=singleton.AWS_DEST_REGION) # Using separate client for upload. This will allow cross-region/account copies.
-    gbsize = ec2.describe_snapshots(SnapshotIds=[snapshot_id,],)["Snapshots"][0]["VolumeSize"]
-    count = Counter(Manager(), 0)
-    snap = ebs2.start_snapshot(VolumeSize=gbsize, Description='Copied by fsp.py from '+snapshot_id)
     with Parallel(n_jobs=singleton.NUM_JOBS, require="sharedmem") as parallel:
         parallel(
-            delayed(copy_blocks_to_snap)('copy', snapshot_id, array, snap, count)
+            delayed(copy_blocks_to_snap)('copy', snapshot_id, array, snap, count, journal)
             for array in split
         )
     print('copy took',round(time.perf_counter() - start_time,2), 'seconds at', round(CHUNK_SIZE * num_blocks / (time.perf_counter() - start_time),2), 'bytes/sec.')
-    ebs2.complete_snapshot(SnapshotId=snap["SnapshotId"], ChangedBlocksCount=count.value())
+    complete_snapshots_journaled(journal, ebsclient_snaps)
     print(snap["SnapshotId"])
 
-def sync(snapshot_id_one, snapshot_id_two, destination_snapshot):
+def sync(snapshot_id_one, snapshot_id_two, destination_snapshot, journal_path=None):
     validate_snapshot(snapshot_id_one)
     validate_snapshot(snapshot_id_two)
     validate_snapshot(destination_snapshot, region=singleton.AWS_DEST_REGION)
     start_time = time.perf_counter()
     blocks = retrieve_differential_snapshot_blocks(snapshot_id_one, snapshot_id_two)
+    ec2 = boto3.client("ec2", region_name=singleton.AWS_ORIGIN_REGION)
+    gbsize = ec2.describe_snapshots(SnapshotIds=[snapshot_id_one,],)["Snapshots"][0]["VolumeSize"]
+    identity = ["sync", snapshot_id_one, snapshot_id_two, destination_snapshot]
+    journal, ebsclient_snaps = start_snapshots_journaled(journal_path, identity, [singleton.AWS_DEST_REGION], gbsize, 'Copied delta by fsp.py from '+snapshot_id_one+'to'+snapshot_id_two, destination_snapshot)
+    snap = ebsclient_snaps[singleton.AWS_DEST_REGION]["snapshot"]
+    count = ebsclient_snaps[singleton.AWS_DEST_REGION]["count"]
+    if not journal is None:
+        blocks = journal.pending(blocks)
     print('Changes between', snapshot_id_one, 'and', snapshot_id_two, 'contain', len(blocks), 'chunks and', CHUNK_SIZE * len(blocks), 'bytes, took', round (time.perf_counter() - start_time,2), "seconds.")
     split = np.array_split(blocks, singleton.NUM_JOBS)
     start_time = time.perf_counter()
     num_blocks = len(blocks)
-    ec2 = boto3.client("ec2", region_name=singleton.AWS_ORIGIN_REGION)
-    ebs = boto3.client("ebs", region_name=singleton.AWS_DEST_REGION)
-    gbsize = ec2.describe_snapshots(SnapshotIds=[snapshot_id_one,],)["Snapshots"][0]["VolumeSize"]
-    count = Counter(Manager(), 0)
-    snap = ebs.start_snapshot(ParentSnapshotId=destination_snapshot, VolumeSize=gbsize, Description='Copied delta by fsp.py from '+snapshot_id_one+'to'+snapshot_id_two)
     print(snap["SnapshotId"])
     with Parallel(n_jobs=singleton.NUM_JOBS, require="sharedmem") as parallel:
         parallel(
-            delayed(copy_blocks_to_snap)('sync', snapshot_id_two, array, snap, count)
+            delayed(copy_blocks_to_snap)('sync', snapshot_id_two, array, snap, count, journal)
             for array in split
         )
     print('sync took',round(time.perf_counter() - start_time,2), 'seconds at', round(CHUNK_SIZE * num_blocks / (time.perf_counter() - start_time),2), 'bytes/sec.')
-    ebs.complete_snapshot(SnapshotId=snap["SnapshotId"], ChangedBlocksCount=count.value())
+    complete_snapshots_journaled(journal, ebsclient_snaps)
 
-def movetos3(snapshot_id):
+def movetos3(snapshot_id, start_block=None, end_block=None, pack_size=None, base_snapshot_id=None, dedup=False, codec="auto", level=None, dictionary=False, threads=0, raw=False):
     validate_snapshot(snapshot_id)
     validate_s3_bucket(singleton.AWS_DEST_REGION, False, True)
+    session=boto3.Session(profile_name=singleton.AWS_S3_PROFILE)
+    s3 = metrics.instrument(session.client("s3", region_name=singleton.AWS_DEST_REGION, endpoint_url=singleton.AWS_S3_ENDPOINT_URL))
     start_time = time.perf_counter()
-    blocks = retrieve_snapshot_blocks(snapshot_id)
-    print('Snapshot', snapshot_id, 'contains', len(blocks), 'chunks and', CHUNK_SIZE * len(blocks), 'bytes, took', round (time.perf_counter() - start_time,2), "seconds.")
+    base = None
+    zeroed = None
+    if raw and not base_snapshot_id is None:
+        print("ERROR: a raw image is always a full image, --base can't be used with --raw.")
+        raise SystemExit
+    if base_snapshot_id is None:
+        blocks = retrieve_snapshot_blocks(snapshot_id, start_block, end_block)
+        print('Snapshot', snapshot_id, 'contains', len(blocks), 'chunks and', CHUNK_SIZE * len(blocks), 'bytes, took', round (time.perf_counter() - start_time,2), "seconds.")
+    else:
+        validate_snapshot(base_snapshot_id)
+        base = find_export_prefix(s3, base_snapshot_id + ".")
+        if base is None or get_manifest(s3, base) is None:
+            print("ERROR: no complete export of base snapshot", base_snapshot_id, "in bucket", singleton.S3_BUCKET + ". Export it with movetos3 first.")
+            raise SystemExit
+        changed = retrieve_differential_snapshot_blocks(base_snapshot_id, snapshot_id, start_block, end_block)
+        # Blocks without a SecondBlockToken were removed since the base and read back as zeroes.
+        blocks = [{"BlockIndex": block["BlockIndex"], "BlockToken": block["SecondBlockToken"]} for block in changed if "SecondBlockToken" in block]
+        zeroed = block_runs([block["BlockIndex"] for block in changed if not "SecondBlockToken" in block])
+        print('Snapshot', snapshot_id, 'changed', len(blocks), 'chunks and', CHUNK_SIZE * len(blocks), 'bytes since', base_snapshot_id + ',', 'and removed', len(changed) - len(blocks), 'chunks, took', round (time.perf_counter() - start_time,2), "seconds.")
     start_time = time.perf_counter()
     num_blocks = len(blocks)
     ec2 = boto3.client("ec2", region_name=singleton.AWS_ORIGIN_REGION)
     gbsize = ec2.describe_snapshots(SnapshotIds=[snapshot_id,],)["Snapshots"][0]["VolumeSize"]
-    with Parallel(n_jobs=128, require="sharedmem") as parallel:
-        #parallel(delayed(get_blocks_s3)(array, snapshot_id) for array in split)
-        parallel(
-            delayed(put_segments_to_s3)(snapshot_id, array, gbsize, singleton.S3_BUCKET)
-            for array in chunk_and_align(blocks, 1, 64)
-        )
+    prefix = export_prefix(snapshot_id, gbsize)
+    trained = None
+    if dictionary and not dedup and not raw and codec in ("auto", "zstd"):
+        trained = get_dictionary(s3, prefix)  # An interrupted export keeps the dictionary its segments were written with
+        if trained is None:
+            trained = train_dictionary(snapshot_id, blocks)
+            if not trained is None:
+                put_dictionary(s3, prefix, trained)
+                print("Trained a", len(trained.as_bytes()), "byte compression dictionary on", min(len(blocks), DICTIONARY_SAMPLE_BLOCKS), "blocks.")
+    policy = CodecPolicy(codec, level, trained, threads)
+    if raw:
+        first_block = 0 if start_block is None else start_block
+        last_block = gbsize * GIGABYTE // CHUNK_SIZE if end_block is None else min(end_block, gbsize * GIGABYTE // CHUNK_SIZE)
+        put_raw_image(s3, snapshot_id, blocks, gbsize, first_block, last_block)
+    elif dedup:
+        chunk_store = ChunkStore(s3)
+        print("Chunk store in bucket", singleton.S3_BUCKET, "holds", len(chunk_store.known), "chunks.")
+        with Parallel(n_jobs=128, require="sharedmem") as parallel:
+            segments = parallel(
+                delayed(put_segment_dedup)(snapshot_id, array, chunk_store)
+                for array in chunk_and_align(blocks, 1, 64)
+            )
+        print("Uploaded", chunk_store.uploaded, "new chunks, skipped", chunk_store.skipped, "chunks already in the store.")
+        put_manifest(s3, prefix, snapshot_id, gbsize, segments, layout="dedup", base=base, zeroed=zeroed)
+    elif pack_size is None:
+        stored = stored_segments(s3, prefix)
+        segments = []
+        arrays = []
+        for array in chunk_and_align(blocks, 1, 64):
+            if len(stored.get(resume_key(array), [])) == 4:
+                segments.append(stored[resume_key(array)])
+            else:
+                arrays.append(array)
+        if len(segments) > 0:
+            print("Resuming export,", len(segments), "segments are already in the bucket.")
+        with Parallel(n_jobs=128, require="sharedmem") as parallel:
+            #parallel(delayed(get_blocks_s3)(array, snapshot_id) for array in split)
+            segments += parallel(
+                delayed(put_segments_to_s3)(snapshot_id, array, gbsize, singleton.S3_BUCKET, policy)
+                for array in arrays
+            )
+        put_manifest(s3, prefix, snapshot_id, gbsize, segments, base=base, zeroed=zeroed, codec=policy.setting)
+    else:
+        if pack_size > PART_SIZE * 10000:
+            print("ERROR: --packed is limited to", PART_SIZE * 10000, "bytes per object (10000 parts of", PART_SIZE, "bytes).")
+            raise SystemExit
+        packs = group_segments(chunk_and_align(blocks, 1, 64), pack_size)
+        stored = stored_segments(s3, prefix)
+        segments = []
+        assignments = []
+        writers = []
+        for n, pack in enumerate(packs):
+            name = "pack.{}".format(n)
+            # Grouping is deterministic, so a completed pack of an interrupted run holds exactly these segments.
+            entries = [stored.get(resume_key(array), []) for array in pack]
+            if all(len(entry) == 7 and entry[4] == name for entry in entries):
+                segments += entries
+                continue
+            writer = PackWriter(s3, prefix, name, len(pack))
+            writers.append(writer)
+            assignments.extend((array, writer) for array in pack)
+        print("Packing segments into", len(packs), "objects of up to", pack_size, "bytes before compression.")
+        if len(segments) > 0:
+            print("Resuming export,", len(segments), "segments are already in the bucket.")
+        try:
+            with Parallel(n_jobs=128, require="sharedmem") as parallel:
+                segments += parallel(
+                    delayed(put_segment_to_pack)(snapshot_id, array, writer, policy)
+                    for array, writer in assignments
+                )
+        except BaseException:
+            for writer in writers:
+                writer.abort()
+            raise
+        put_manifest(s3, prefix, snapshot_id, gbsize, segments, layout="packed", base=base, zeroed=zeroed, codec=policy.setting)
+    if len(policy.used) > 0:
+        print("Segments per codec:", ", ".join("{}: {}".format(name, count) for name, count in sorted(policy.used.items())))
     print('movetos3 took',round(time.perf_counter() - start_time,2), 'seconds at', round(CHUNK_SIZE * num_blocks / (time.perf_counter() - start_time),2), 'bytes/sec.')
 
-def getfroms3(snapshot_prefix):
+def getfroms3(snapshot_prefix, file_path=None, parent_snapshot_id=None, parent_export=None, destination_regions=None):
     validate_s3_bucket(singleton.AWS_DEST_REGION, True, False)
     start_time = time.perf_counter()
     session=boto3.Session(profile_name=singleton.AWS_S3_PROFILE)
-    s3 = session.client("s3", region_name=singleton.AWS_ORIGIN_REGION, endpoint_url=singleton.AWS_S3_ENDPOINT_URL)
-    ebs = boto3.client("ebs", region_name=singleton.AWS_DEST_REGION)
-    response = s3.list_objects_v2(Bucket=singleton.S3_BUCKET, Prefix=snapshot_prefix)
-    objects = response["Contents"]
-    count = Counter(Manager(), 0)
-    while "NextContinuationToken" in response:
-        response = s3.list_objects_v2(Bucket=singleton.S3_BUCKET, Prefix=snapshot_prefix, ContinuationToken = response["NextContinuationToken"])
-        objects.extend(response["Contents"])
-    if len(objects) == 0:
+    s3 = metrics.instrument(session.client("s3", region_name=singleton.AWS_ORIGIN_REGION, endpoint_url=singleton.AWS_S3_ENDPOINT_URL))
+    prefix = find_export_prefix(s3, snapshot_prefix)
+    if prefix is None:
         print("No snapshots found for prefix %s in bucket %s" % (snapshot_prefix, singleton.S3_BUCKET))
-    snap = ebs.start_snapshot(VolumeSize=int(objects[0]["Key"].split("/")[0].split(".")[1]), Description='Restored by fsp.py from S3://'+singleton.S3_BUCKET+'/'+objects[0]["Key"].split("/")[0])
+        return
+    if not destination_regions:
+        destination_regions = [singleton.AWS_DEST_REGION]
+    if len(destination_regions) > 1 and not (parent_snapshot_id is None and file_path is None):
+        print("ERROR: --destinations can't be combined with --parent or --to_file.")
+        raise SystemExit
+    layers, volume_size = load_layers(s3, prefix)
+    zero_blocks = []
+    if parent_snapshot_id is None:
+        plan = overlay_layers(layers, volume_size * GIGABYTE // CHUNK_SIZE)
+    else:
+        if not file_path is None:
+            print("ERROR: --parent restores onto a snapshot and can't be used with --to_file.")
+            raise SystemExit
+        validate_snapshot(parent_snapshot_id, singleton.AWS_DEST_REGION)
+        base_prefix = find_export_prefix(s3, (parent_snapshot_id if parent_export is None else parent_export) + ".")
+        if base_prefix is None:
+            print("ERROR: no export of the parent's data found in bucket", singleton.S3_BUCKET + ". Name it with --parent_export.")
+            raise SystemExit
+        base_layers, base_volume_size = load_layers(s3, base_prefix)
+        volume_size = max(volume_size, base_volume_size)  # A child snapshot can't be smaller than its parent
+        volume_blocks = volume_size * GIGABYTE // CHUNK_SIZE
+        plan = overlay_layers(layers, volume_blocks)
+        full = len(plan)
+        plan, zero_blocks = diff_plan(plan, overlay_layers(base_layers, volume_blocks), volume_blocks)
+        print("Parent", parent_snapshot_id, "holds", base_prefix + ":", full - len(plan), "of", full, "segments are unchanged,", len(zero_blocks), "blocks were removed.")
+    if len(layers) > 1:
+        print("Restoring", len(plan), "segments from", prefix, "and", len(layers) - 1, "base layers")
+    else:
+        print("Restoring", len(plan), "segments from", prefix)
+    if not file_path is None:
+        getfroms3_file(plan, file_path, volume_size, start_time)
+        return
+    ebsclient_snaps = start_snapshots(
+        destination_regions,
+        volume_size,
+        'Restored by fsp.py from S3://'+singleton.S3_BUCKET+'/'+prefix,
+        parent_snapshot_id
+    )
+    if len(ebsclient_snaps) > 1:
+        print("Started a snapshot in each of", len(ebsclient_snaps), "regions, every segment is read and decompressed once.")
+    count = ebsclient_snaps[destination_regions[0]]["count"]
+    put_stage = PutStage(singleton.NUM_JOBS * singleton.NUM_JOBS, 2 * singleton.NUM_JOBS * singleton.NUM_JOBS, parent_snapshot_id is None)
     with Parallel(n_jobs=singleton.NUM_JOBS, require="sharedmem") as parallel:
         parallel(
-            delayed(get_segment_from_s3)(object, snap["SnapshotId"], count) 
-            for object in objects
+            delayed(get_segment_from_s3)(segment, segment_prefix, put_stage, ebsclient_snaps, needed)
+            for segment, segment_prefix, needed in plan
         )
+    for block in zero_blocks:
+        put_stage.submit(block, ZERO_BLOCK, ebsclient_snaps)
+    put_stage.close()
     print('getfroms3 took',round(time.perf_counter() - start_time,2), 'seconds at', round(CHUNK_SIZE * count.value() / (time.perf_counter() - start_time),2), 'bytes/sec.')
-    ebs.complete_snapshot(SnapshotId=snap["SnapshotId"], ChangedBlocksCount=count.value())
-    print(snap["SnapshotId"])
+    output = complete_snapshots(ebsclient_snaps)
+    if len(output) > 1:
+        print(json.dumps(output)) #record all regions and their snapshots in a key-value pair format for easy log tail
+    else:
+        print(output[destination_regions[0]])
+
+def getfroms3_file(plan, file_path, volume_size, start_time):
+    sink = FileSink(file_path, volume_size * GIGABYTE)
+    with Parallel(n_jobs=singleton.NUM_JOBS, require="sharedmem") as parallel:
+        parallel(
+            delayed(get_segment_from_s3)(segment, segment_prefix, sink, {}, needed)
+            for segment, segment_prefix, needed in plan
+        )
+    sink.close()
+    print('getfroms3 took',round(time.perf_counter() - start_time,2), 'seconds at', round(CHUNK_SIZE * sink.written / (time.perf_counter() - start_time),2), 'bytes/sec.')
+    print(file_path)
 
-def multiclone(snapshot_id, infile):
+def multiclone(snapshot_id, infile, journal_path=None):
     validate_snapshot(snapshot_id)
     files = []
     with open(infile, "r") as f:
         files = f.read().splitlines()
     validate_file_paths(files)
     start_time = time.perf_counter()
-    blocks = retrieve_snapshot_blocks(snapshot_id)
+    journal, blocks = open_journal(journal_path, snapshot_id, files)
     print('Snapshot', snapshot_id, 'contains', len(blocks), 'chunks and', CHUNK_SIZE * len(blocks), 'bytes, took', round (time.perf_counter() - start_time,2), "seconds.")
     split = np.array_split(blocks, singleton.NUM_JOBS)  # Separate the snapshot into segments to be processed in parallel
     start_time = time.perf_counter()
     num_blocks = len(blocks)
     print(files)
-    with Parallel(n_jobs=singleton.NUM_JOBS, require="sharedmem") as parallel:
-        parallel(
-            delayed(get_blocks)(array, files, snapshot_id) for array in split
-        )
+    complete = False
+    verify_stage = VerifyStage(VERIFY_WORKERS, singleton.NUM_JOBS * singleton.NUM_JOBS)
+    try:
+        try:
+            with Parallel(n_jobs=singleton.NUM_JOBS, require="sharedmem") as parallel:
+                parallel(
+                    delayed(get_blocks)(array, files, snapshot_id, journal, verify_stage=verify_stage) for array in split
+                )
+        finally:
+            verify_stage.close()  # Blocks handed over must be written before the journal is closed
+        complete = True
+    finally:
+        if not journal is None:
+            journal.close(complete)
     print('multiclone took',round(time.perf_counter() - start_time,2), 'seconds at', round(CHUNK_SIZE * num_blocks / (time.perf_counter() - start_time),2), 'bytes/sec.')
 
-def fanout(device_path, destination_regions):
+def verify(manifest_path, file_path=None, repair=False, against_path=None):
+    manifest = get_checksum_manifest(manifest_path)
+    snapshot_id = manifest["snapshot_id"]
+    first_block, last_block = manifest["range"]
+    if not against_path is None:
+        if repair:
+            print("ERROR: --repair needs a file to repair, not a manifest.")
+            raise SystemExit
+        verify_manifests(manifest, against_path)
+        return
+    files = []
+    files.append(file_path)
+    validate_file_paths_read(files)
+    start_time = time.perf_counter()
+    split = [array for array in np.array_split(range(first_block, last_block), singleton.NUM_JOBS) if len(array) > 0]
+    with Parallel(n_jobs=singleton.NUM_JOBS, require="sharedmem") as parallel:
+        results = parallel(
+            delayed(hash_image_range)(file_path, int(array[0]), int(array[-1]) + 1, manifest["checksums"])
+            for array in split
+        )
+    mismatched = sorted(index for result in results for index in result)
+    print('verify took',round(time.perf_counter() - start_time,2), 'seconds at', round(CHUNK_SIZE * (last_block - first_block) / (time.perf_counter() - start_time),2), 'bytes/sec.')
+    if len(mismatched) == 0:
+        print(file_path, "matches", snapshot_id, "in blocks", first_block, "to", last_block)
+        return
+    for start, length in block_runs(mismatched):
+        print("Mismatch in blocks", start, "to", start + length, "(bytes", start * CHUNK_SIZE, "to", str((start + length) * CHUNK_SIZE) + ")")
+    print(len(mismatched), "of", last_block - first_block, "blocks of", file_path, "don't match", snapshot_id)
+    if not repair:
+        sys.exit(1)
+    validate_snapshot(snapshot_id)
+    validate_file_paths(files)
+    start_time = time.perf_counter()
+    blocks = retrieve_snapshot_blocks_at(snapshot_id, mismatched, first_block, last_block)
+    listed = set(block["BlockIndex"] for block in blocks)
+    ebs = boto3.client("ebs", region_name=singleton.AWS_ORIGIN_REGION)
+    with Parallel(n_jobs=singleton.NUM_JOBS, require="sharedmem") as parallel:
+        parallel(delayed(get_block)(block, ebs, files, snapshot_id, skip_sparse=False) for block in blocks)
+    for index in mismatched:
+        if not index in listed:  # Not allocated in the snapshot, so it must read as zeros
+            write_block_to_file(file_path, {"BlockIndex": index}, ZERO_BLOCK)
+    print("Repaired", len(mismatched), "blocks,", len(blocks), "fetched from", snapshot_id, "and", len(mismatched) - len(blocks), "zeroed, took", round(time.perf_counter() - start_time,2), "seconds.")
+
+def verify_manifests(manifest, against_path):
+    against = get_checksum_manifest(against_path)
+    if against["range"] != manifest["range"]:
+        print("ERROR: the manifests cover different block ranges,", manifest["range"], "and", against["range"])
+        raise SystemExit
+    start_time = time.perf_counter()
+    differing = merkle_diff(manifest, against)
+    print('verify took',round(time.perf_counter() - start_time,2), 'seconds.')
+    if len(differing) == 0:
+        print(manifest["snapshot_id"], "and", against["snapshot_id"], "match in blocks", manifest["range"][0], "to", manifest["range"][1])
+        return
+    for start, length in block_runs(differing):
+        print("Mismatch in blocks", start, "to", start + length, "(bytes", start * CHUNK_SIZE, "to", str((start + length) * CHUNK_SIZE) + ")")
+    print(len(differing), "of", manifest["range"][1] - manifest["range"][0], "blocks of", manifest["snapshot_id"], "don't match", against["snapshot_id"])
+    sys.exit(1)
+
+def fanout(device_path, destination_regions, size=None, journal_path=None):
+    if is_stream_source(device_path):
+        if not journal_path is None:
+            print("ERROR: --journal needs a seekable file or device to resume from.")
+            raise SystemExit
+        fanout_stream(device_path, destination_regions, size)
+        return
     files = []
     files.append(device_path)
     validate_file_paths_read(files)
     # Note destination_regions was validated while singleton was being configured (Near origin and destination regions validation)
-    ebs_clients = {}
-    snaps = {}
-    ebsclient_snaps = {}
     with os.fdopen(os.open(device_path, os.O_RDONLY | os.O_NONBLOCK), "rb+") as f: #! Warning: these file permissions could cause problems on windows
         f.seek(0, os.SEEK_END)
         size = f.tell()
         gbsize = math.ceil(size / GIGABYTE)
         chunks = size // CHUNK_SIZE
-        split = np.array_split(range(chunks), singleton.NUM_JOBS)
         print("Size of", device_path, "is", size, "bytes and", chunks, "chunks. Aligning snapshot to", gbsize, "GiB boundary.")
-        for region in destination_regions:
-            ebs_clients[region] = boto3.client("ebs", region_name=region)
-            snaps[region] = ebs_clients[region].start_snapshot(VolumeSize=gbsize, Description="Uploaded by fsp.py from "+ device_path)
-            ebsclient_snaps[region]={
-                "client":ebs_clients[region],
-                "snapshot":snaps[region],
-                "count":Counter(Manager(), 0)
-            }
+        identity = ["fanout", os.path.abspath(device_path), str(size)]
+        journal, ebsclient_snaps = start_snapshots_journaled(journal_path, identity, destination_regions, gbsize, "Uploaded by fsp.py from "+ device_path)
         print("Spawned", len(ebsclient_snaps), "EBS Clients and started a snapshot in each region.")
+        split = np.array_split(range(chunks) if journal is None else journal.pending(range(chunks), key=int), singleton.NUM_JOBS)
         with Parallel(n_jobs=singleton.NUM_JOBS, require="sharedmem") as parallel:
             parallel(
-                delayed(put_segments_fanout)(array, device_path, f, ebsclient_snaps) 
+                delayed(put_segments_fanout)(array, device_path, f, ebsclient_snaps, journal) 
                 for array in split
             )
-        output = {}
-        for region in ebsclient_snaps:
-            ebs = ebsclient_snaps[region]["client"]
-            snapshot_id = ebsclient_snaps[region]["snapshot"]["SnapshotId"]
-            count = ebsclient_snaps[region]["count"]
-            ebs.complete_snapshot(SnapshotId=snapshot_id, ChangedBlocksCount=count.value())
-            output[region] = snapshot_id
+        output = complete_snapshots_journaled(journal, ebsclient_snaps)
         print(json.dumps(output)) #record all regions and their snapshots in a key-value pair format for easy log tail
+
+def fanout_stream(device_path, destination_regions, size=None):
+    source = open_stream_source(device_path, size)
+    gbsize = math.ceil(size / GIGABYTE)
+    print("Streaming", device_path, "into", gbsize, "GiB snapshots")
+    ebsclient_snaps = start_snapshots(destination_regions, gbsize, "Uploaded by fsp.py from "+device_path)
+    print("Spawned", len(ebsclient_snaps), "EBS Clients and started a snapshot in each region.")
+    stream_put_blocks(source, ebsclient_snaps, gbsize * GIGABYTE // CHUNK_SIZE)
+    output = complete_snapshots(ebsclient_snaps)
+    print(json.dumps(output)) #record all regions and their snapshots in a key-value pair format for easy log tail
@@ -15,6 +15,7 @@
 """
 
 import argparse
+import atexit
 import os.path
 import subprocess
 import sys
@@ -22,6 +23,7 @@ from os.path import exists
 from datetime import datetime, timedelta
 
 from singleton import SingletonClass  #Project Scoped Global Vars
+import metrics  # Hot-path instrumentation, standard library only
 
 """
 Works like java comparator
@@ -185,6 +187,60 @@ def install_dependencies(needs_install, needs_version_adjustment):
     return True
 
 
+BLOCK_SIZE = 512 * 1024  # Must match CHUNK_SIZE in fsp.py
+SEGMENT_BLOCKS = 64  # Must match the largest segment of chunk_and_align() in fsp.py
+CODEC_LEVELS = {"auto": range(1, 23), "zstd": range(1, 23), "lz4": range(0, 17)}  # --level of each movetos3 --codec
+BYTE_UNITS = {"B": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+
+"""
+Splits a size such as 512K, 4G or 1TiB into its number and its multiplier (powers of 1024).
+The multiplier is None when no unit is given, so callers can choose how to interpret bare numbers.
+"""
+def split_size_unit(value):
+    value = value.strip()
+    unit = value.lstrip("0123456789")
+    number = value[:len(value) - len(unit)]
+    unit = unit.strip().upper()
+    if unit.endswith("IB"):
+        unit = unit[:-2]
+    if number == "" or (unit != "" and not unit in BYTE_UNITS):
+        raise ValueError(f"Invalid size or offset: {value}")
+    if unit == "":
+        return int(number), None
+    return int(number), BYTE_UNITS[unit]
+
+"""
+Converts a --start/--end range bound into a block index.
+
+A plain integer is a block index. A number followed by a unit (B, K, KiB, M, MiB, G, GiB, T, TiB; all powers of 1024)
+is a byte offset. Byte offsets that do not fall on a block boundary are widened to include the whole block:
+start bounds are rounded down and end bounds are rounded up.
+"""
+def parse_block_offset(value, round_up=False):
+    number, multiplier = split_size_unit(value)
+    if multiplier is None:
+        return number
+    offset = number * multiplier
+    if round_up:
+        return (offset + BLOCK_SIZE - 1) // BLOCK_SIZE
+    return offset // BLOCK_SIZE
+
+"""Converts a size such as 8G or 1TiB into bytes. A plain integer is a number of bytes."""
+def parse_byte_size(value):
+    number, multiplier = split_size_unit(value)
+    if multiplier is None:
+        return number
+    return number * multiplier
+
+"""
+Smallest --max_memory budget that num_jobs parallel workers can share without stalling each other:
+every worker must be able to hold a block buffer and a whole segment at the same time, which is what
+a movetos3 worker reserves. The block index comes on top of it.
+"""
+def minimum_memory(num_jobs):
+    return num_jobs * (SEGMENT_BLOCKS + 1) * BLOCK_SIZE
+
+
 # Creates parsers and enforces valid global parameter choices. Returns None if FSP should abort
 
 def arg_parse(args):
@@ -198,6 +254,8 @@ def arg_parse(args):
     parser.add_argument("-vvv", default=False, action="store_true", dest="vvv", help="Maximum output verbosity. (All individual block retries will be recorded)")
     parser.add_argument("--nodeps", default=False, action="store_true", dest="nodeps", help="Do not verify/install dependencies.")
     parser.add_argument("--suppress_writes", default=False, action="store_true", help="Intended for underpowered devices. Will not write log files or check dependencies")
+    parser.add_argument("--max_memory", default=None, help="Memory budget for buffered block data and the block index, e.g. 6G. Concurrency is throttled to stay within it. (default: unlimited)")
+    parser.add_argument("--metrics", default=None, help="Record per-operation latency histograms, throttles and throughput, and write them to METRICS.prom (Prometheus text format) and METRICS.json at the end of the run. (default: off)")
 
     # sub_parser for each CLI action
     subparsers = parser.add_subparsers(dest='command', title='Flexible Snapshot Proxy (FSP) Commands', description='First Positional Arguments. Additional help pages (-h or --help) for each command is available')
@@ -212,6 +270,7 @@ def arg_parse(args):
     getfroms3_parser = subparsers.add_parser('getfroms3', help='Transfers a Snapshot stored in a customer-owned S3 Bucket to a new EBS snapshot')
     multiclone_parser = subparsers.add_parser('multiclone', help='Same functionality as “download”, but writing to multiple destinations in parallel')
     fanout_parser = subparsers.add_parser('fanout', help='Upload from file to multiple snapshot(s), provided a list of regions')
+    verify_parser = subparsers.add_parser('verify', help='Checks a downloaded file or block device against the checksum manifest written by download --manifest')
 
     # add CLI argument options for each command
     list_parser.add_argument('snapshot', help='Snapshot ID to list size of')
@@ -220,14 +279,21 @@ def arg_parse(args):
     diff_parser.add_argument('snapshot_two', help='Second snapshot ID to used in comparison')
 
     download_parser.add_argument('snapshot', help='Snapshot ID to download')
-    download_parser.add_argument('file_path', help='File path of download location. (Absolute path preferred)')
+    download_parser.add_argument('file_path', help='File path of download location. (Absolute path preferred). Use - to stream the volume to stdout')
+    download_parser.add_argument("-s", "--stream", default=False, action="store_true", help="Write the volume sequentially, in order, for pipes, FIFOs and sockets that cannot seek. Implied when file_path is -")
+    download_parser.add_argument("-m", "--manifest", default=None, help="Also write the checksum of every block received to this file, for a later verify. (default: none)")
 
     deltadownload_parser.add_argument('snapshot_one', help='First snapshot ID to used in comparison')
     deltadownload_parser.add_argument('snapshot_two', help='Second snapshot ID to used in comparison')
     deltadownload_parser.add_argument('file_path', default=None, help='File path of download location. (Absolute path preferred)')
 
-    upload_parser.add_argument('file_path', help='File path of file or raw device to upload as snapshot')
+    upload_parser.add_argument('file_path', help='File path of file or raw device to upload as snapshot, - for stdin, or s3://bucket/key of a raw image in S3')
     upload_parser.add_argument("--parent_snapshot_id", help="Parent Snapshot ID of the snapshot to be created and uploaded")
+    upload_parser.add_argument("--size", default=None, help="Size of the volume when file_path is - (stdin) or a pipe, e.g. 100G. Sets the snapshot VolumeSize.")
+    upload_parser.add_argument("-e", "--endpoint_url", default=None, help="S3 Endpoint URL when file_path is an s3://bucket/key raw image, for custom sources such as Snowball Edge. (default: none)")
+    upload_parser.add_argument("-p", "--profile", default="default", help="AWS CLI profile for reading an s3://bucket/key raw image, for custom sources such as Snowball Edge.")
+    upload_parser.add_argument("-m", "--manifest", default=None, help="Also write the checksum manifest of the uploaded blocks to this file, for verify or a later incremental upload. (default: none)")
+    upload_parser.add_argument("--parent_manifest", default=None, help="Checksum manifest of the parent snapshot. The file is hashed locally and only the blocks that differ from the parent are uploaded. Implies --parent_snapshot_id")
 
     copy_parser.add_argument('snapshot', help='Snapshot ID to be copied')
     copy_parser.add_argument("-d", "--destination_region", default=None, help="AWS Destination Region. Where snapshot will copied to. (default: source region)")
@@ -244,6 +310,15 @@ def arg_parse(args):
     movetos3_parser.add_argument("-e", "--endpoint_url", default=None, help="S3 Endpoint URL, for custom destinations such as Snowball Edge. (default: none)")
     movetos3_parser.add_argument("-f", "--full_copy", default=False, action="store_true", help="Does not make an size optimizations")
     movetos3_parser.add_argument("-p", "--profile", default="default", help="Use a different AWS CLI profile, for custom destinations such as Snowball Edge.")
+    movetos3_layout = movetos3_parser.add_mutually_exclusive_group()
+    movetos3_layout.add_argument("--packed", nargs="?", const="4G", default=None, help="Pack segments into large objects of about this much uncompressed data, restored with ranged GETs. Fewer PUT requests and objects. (default when given: 4G)")
+    movetos3_layout.add_argument("--raw", default=False, action="store_true", help="Export a plain, uncompressed raw disk image as a single object (snapshot_id.volsize.img) for image importers and forensics tools. Unallocated blocks are written as zeros.")
+    movetos3_layout.add_argument("--dedup", default=False, action="store_true", help="Store blocks as content-addressed chunks shared by all deduplicated exports in the bucket, uploading only chunks the bucket doesn't hold yet.")
+    movetos3_parser.add_argument("--codec", default="auto", choices=["auto", "none", "zstd", "lz4"], help="Segment compression. auto samples each segment, stores incompressible data as is and uses zstd otherwise. lz4 needs the optional lz4 package, on the hosts that restore the export too. (default: auto)")
+    movetos3_parser.add_argument("--level", default=None, type=int, help="Compression level, 1-22 for zstd and auto, 0-16 for lz4. (default: zstd 1, or 3 for highly compressible segments with --codec auto)")
+    movetos3_parser.add_argument("--dictionary", default=False, action="store_true", help="Train a zstd dictionary on a sample of the snapshot's blocks, store it with the export and compress segments with it. Improves the ratio for small or similar segments.")
+    movetos3_parser.add_argument("--zstd_threads", default=0, type=int, help="zstd compression threads per segment, for segments of 8 MiB and more. Helps on CPU-bound instances with few segments in flight. (default: 0, single-threaded)")
+    movetos3_parser.add_argument("--base", default=None, help="Snapshot ID of an earlier snapshot in the same lineage that is already exported to the bucket. Only blocks changed since it are exported, as a delta layer on top of its export.")
 
     getfroms3_parser.add_argument('snapshot_prefix', help='The snapshot prefix specifying which snapshot to retrieve from s3 bucket')
     getfroms3_parser.add_argument("s3Bucket", help='The s3 bucket source. Must be created within your AWS account')
@@ -251,14 +326,77 @@ def arg_parse(args):
     getfroms3_parser.add_argument("-e", "--endpoint_url", default=None, help="S3 Endpoint URL, for custom destinations such as Snowball Edge. (default: none)")
     getfroms3_parser.add_argument("-f", "--full_copy", default=False, action="store_true", help="Does not make an size optimizations")
     getfroms3_parser.add_argument("-p", "--profile", default="default", help="Use a different AWS CLI profile, for custom destinations such as Snowball Edge.")
+    getfroms3_parser.add_argument("--parent", default=None, help="Snapshot ID of an earlier snapshot of the same lineage in the destination region. The restore is created on top of it and only segments that differ from its export are PUT.")
+    getfroms3_parser.add_argument("--parent_export", default=None, help="Snapshot prefix of the export in the bucket that --parent holds, when --parent was itself restored from S3 under a new ID. (default: the --parent snapshot ID)")
+    getfroms3_parser.add_argument("--destinations", default=None, help="File path to a .txt file listing regions on separate lines. Restores one snapshot per region while reading and decompressing the export once. (default: destination region)")
+    getfroms3_parser.add_argument("--to_file", default=None, help="Restore into this file or block device instead of a new EBS snapshot, e.g. /dev/nvme1n1 or volume.img.")
 
     multiclone_parser.add_argument('snapshot', help='Snapshot ID to multiclone')
     multiclone_parser.add_argument('file_path', help='File path to a .txt file containing list of multiclone destinations')
 
     fanout_parser.add_argument('device_path', help='File path to raw device for fanout snapshot distributution')
     fanout_parser.add_argument('destinations', help='File path to a .txt file listing all regions the snapshot distributution on separate lines')
+    fanout_parser.add_argument("--size", default=None, help="Size of the volume when device_path is - (stdin) or a pipe, e.g. 100G. Sets the snapshot VolumeSize.")
+
+    verify_parser.add_argument('manifest', help='Checksum manifest written by download --manifest')
+    verify_parser.add_argument('file_path', nargs='?', default=None, help='File path of the downloaded file or block device to verify')
+    verify_parser.add_argument("-a", "--against", default=None, help="Compare with another checksum manifest of the same block range instead of a file, using their Merkle trees")
+    verify_parser.add_argument("-r", "--repair", default=False, action="store_true", help="Fetch the mismatched blocks from the snapshot again and rewrite them. (default: only report them)")
+
+    for range_parser in [download_parser, deltadownload_parser, upload_parser, copy_parser, movetos3_parser]:
+        range_parser.add_argument("--start", default=None, help="First block of the range to transfer. Block index, or byte offset with a unit suffix such as 512K, 4G or 1TiB. (default: start of volume)")
+        range_parser.add_argument("--end", default=None, help="End of the range to transfer (exclusive). Block index, or byte offset with a unit suffix. (default: end of volume)")
+
+    for journal_parser in [download_parser, multiclone_parser, upload_parser, copy_parser, sync_parser, fanout_parser]:
+        journal_parser.add_argument("-j", "--journal", default=None, help="Checkpoint journal file. An interrupted transfer run again with the same journal only transfers the blocks not yet done, into the same pending snapshot. (default: none)")
 
     args = parser.parse_args(args)
+
+    if "start" in args:
+        try:
+            args.start = None if args.start is None else parse_block_offset(args.start)
+            args.end = None if args.end is None else parse_block_offset(args.end, round_up=True)
+        except ValueError as e:
+            print(e)
+            return None
+        if not args.start is None and not args.end is None and args.start >= args.end:
+            print("Invalid range: --start must be before --end")
+            return None
+
+    if not args.max_memory is None:
+        try:
+            args.max_memory = parse_byte_size(args.max_memory)
+        except ValueError as e:
+            print(e)
+            return None
+
+    if "packed" in args and not args.packed is None:
+        try:
+            args.packed = parse_byte_size(args.packed)
+        except ValueError as e:
+            print(e)
+            return None
+
+    if "level" in args and not args.level is None:
+        if not args.codec in CODEC_LEVELS:
+            print("--level can't be used with --codec", args.codec)
+            return None
+        if not args.level in CODEC_LEVELS[args.codec]:
+            levels = CODEC_LEVELS[args.codec]
+            print(f"--level for --codec {args.codec} must be between {levels[0]} and {levels[-1]}")
+            return None
+
+    if args.command == "verify" and (args.file_path is None) == (args.against is None):
+        print("verify needs either a file_path or --against, but not both")
+        return None
+
+    if "size" in args and not args.size is None:
+        try:
+            args.size = parse_byte_size(args.size)
+        except ValueError as e:
+            print(e)
+            return None
+
     return args
 
 def setup_singleton(args):
@@ -322,6 +460,11 @@ def setup_singleton(args):
     elif args.v == True:
         verbosity = 1
 
+    min_memory = minimum_memory(num_jobs)
+    if not args.max_memory is None and args.max_memory < min_memory:
+        print("--max_memory must be at least", min_memory, "bytes for", num_jobs, "parallel jobs, plus room for the block index.")
+        sys.exit(1)  # Exit code for invalid parameters. Script cannot run
+
     nodeps = args.nodeps
     suppress_writes = args.suppress_writes
     dry_run = args.dry_run
@@ -354,7 +497,7 @@ def setup_singleton(args):
 
     # Validate fanout regions
     aws_regions_fanout = []
-    if args.command == "fanout":
+    if args.command == "fanout" or (args.command == "getfroms3" and not args.destinations is None):
         f = open(args.destinations, 'r')
         for region in f:
             region = region.strip()
@@ -381,6 +524,8 @@ def setup_singleton(args):
     singleton.DRY_RUN = dry_run
     singleton.NODEPS = nodeps
     singleton.SUPPRESS_WRITES = suppress_writes
+    singleton.MAX_MEMORY = args.max_memory
+    singleton.MIN_MEMORY = min_memory
 
 
 if __name__ == "__main__":
@@ -392,6 +537,9 @@ if __name__ == "__main__":
         print("\nExiting")
         sys.exit(1) # Exit code for invalid parameters. Script cannot run
 
+    if args.command == "download" and args.file_path == "-":
+        sys.stdout = sys.stderr  # stdout carries the snapshot data, so all messages go to stderr
+
     timestamp_file = f"{os.path.dirname(os.path.realpath(__file__))}/../.fsp_deps_timestamp"
     if exists(timestamp_file):
         ctime = os.path.getctime(timestamp_file)
@@ -456,6 +604,10 @@ if __name__ == "__main__":
 
     setup_singleton(args)
 
+    if not args.metrics is None:
+        metrics.enable()
+        atexit.register(metrics.write, args.metrics, args.command)  # Also runs when a command exits early
+
     # Placing these imports earlier creates a circular dependency with the installer
     from fsp import (
         list,
@@ -468,7 +620,8 @@ if __name__ == "__main__":
         movetos3,
         getfroms3,
         multiclone,
-        fanout
+        fanout,
+        verify
     )
 
     command = args.command
@@ -479,39 +632,45 @@ if __name__ == "__main__":
         diff(snapshot_id_one=args.snapshot_one, snapshot_id_two=args.snapshot_two)
 
     elif command == "download":
-        download(snapshot_id=args.snapshot, file_path=args.file_path)
+        download(snapshot_id=args.snapshot, file_path=args.file_path, start_block=args.start, end_block=args.end, stream=args.stream, journal_path=args.journal, manifest_path=args.manifest)
 
     elif command == "deltadownload":
-        deltadownload(snapshot_id_one=args.snapshot_one, snapshot_id_two=args.snapshot_two, file_path=args.file_path)
+        deltadownload(snapshot_id_one=args.snapshot_one, snapshot_id_two=args.snapshot_two, file_path=args.file_path, start_block=args.start, end_block=args.end)
 
     elif command == "upload":
-        upload(file_path=args.file_path, parent_snapshot_id=args.parent_snapshot_id)
+        if args.file_path.startswith("s3://"):
+            singleton.AWS_S3_ENDPOINT_URL = args.endpoint_url
+            singleton.AWS_S3_PROFILE = args.profile
+        upload(file_path=args.file_path, parent_snapshot_id=args.parent_snapshot_id, start_block=args.start, end_block=args.end, size=args.size, journal_path=args.journal, manifest_path=args.manifest, parent_manifest_path=args.parent_manifest)
 
     elif command == "copy":
-        copy(snapshot_id=args.snapshot)
+        copy(snapshot_id=args.snapshot, start_block=args.start, end_block=args.end, journal_path=args.journal)
 
     elif command == "sync":
-        sync(snapshot_id_one=args.snapshot_one, snapshot_id_two=args.snapshot_two, destination_snapshot=args.destination_snapshot)
+        sync(snapshot_id_one=args.snapshot_one, snapshot_id_two=args.snapshot_two, destination_snapshot=args.destination_snapshot, journal_path=args.journal)
 
     elif command == "movetos3":
         if not args.endpoint_url is None:
             singleton.AWS_S3_ENDPOINT_URL = args.endpoint_url
         if not args.endpoint_url is None:
             singleton.AWS_S3_PROFILE = args.profile
-        movetos3(snapshot_id=args.snapshot)
+        movetos3(snapshot_id=args.snapshot, start_block=args.start, end_block=args.end, pack_size=args.packed, base_snapshot_id=args.base, dedup=args.dedup, codec=args.codec, level=args.level, dictionary=args.dictionary, threads=args.zstd_threads, raw=args.raw)
 
     elif command == "getfroms3":
         if not args.endpoint_url is None:
             singleton.AWS_S3_ENDPOINT_URL = args.endpoint_url
         if not args.endpoint_url is None:
             singleton.AWS_S3_PROFILE = args.profile
-        getfroms3(snapshot_prefix=args.snapshot_prefix)
+        getfroms3(snapshot_prefix=args.snapshot_prefix, file_path=args.to_file, parent_snapshot_id=args.parent, parent_export=args.parent_export, destination_regions=args.destinations)
 
     elif command == "multiclone":
-        multiclone(snapshot_id=args.snapshot, infile=args.file_path)
+        multiclone(snapshot_id=args.snapshot, infile=args.file_path, journal_path=args.journal)
 
     elif command == "fanout":
-        fanout(device_path=args.device_path, destination_regions=args.destinations)
+        fanout(device_path=args.device_path, destination_regions=args.destinations, size=args.size, journal_path=args.journal)
+
+    elif command == "verify":
+        verify(manifest_path=args.manifest, file_path=args.file_path, repair=args.repair, against_path=args.against)
     else:
         print("Unknown command: %s" % command)
         sys.exit(127) # Exit code for command not found. Script cannot run
@@ -0,0 +1,261 @@
+"""
+  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+  Licensed under the Apache License, Version 2.0 (the "License").
+  You may not use this file except in compliance with the License.
+  You may obtain a copy of the License at
+
+      http://www.apache.org/licenses/LICENSE-2.0
+
+  Unless required by applicable law or agreed to in writing, software
+  distributed under the License is distributed on an "AS IS" BASIS,
+  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+  See the License for the specific language governing permissions and
+  limitations under the License.
+"""
+
+# Instrumentation of the transfer hot paths, enabled with --metrics. Every thread records into its own histograms and
+# counters, so workers never contend on a lock, and the per-thread data is only merged when the run is exported.
+# Exported at the end of each run as a Prometheus text file (for the node_exporter textfile collector) and as JSON.
+# While disabled, every call returns right away.
+
+import bisect
+import json
+import os
+import threading
+import time
+from datetime import datetime, timezone
+
+# Upper bounds in seconds of the latency histogram buckets, the last bucket is +Inf
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+# Latency histogram of one operation in one thread.
+class Histogram(object):
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.sum += seconds
+        self.count += 1
+
+    def merge(self, other):
+        for i, count in enumerate(other.counts):
+            self.counts[i] += count
+        self.sum += other.sum
+        self.count += other.count
+
+
+# Everything one thread has recorded. timeline maps (stream, second since the start of the run) to [bytes, blocks].
+class ThreadMetrics(object):
+    def __init__(self):
+        self.histograms = {}
+        self.counters = {}
+        self.timeline = {}
+
+
+# Times the block of a with statement into the histogram of an operation.
+class Timer(object):
+    __slots__ = ("registry", "operation", "start")
+
+    def __init__(self, registry, operation):
+        self.registry = registry
+        self.operation = operation
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.registry.observe(self.operation, time.perf_counter() - self.start)
+        return False
+
+
+class NoTimer(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+NO_TIMER = NoTimer()
+
+
+class Registry(object):
+    def __init__(self):
+        self.enabled = False
+        self.local = threading.local()
+        self.threads = []
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.start = time.perf_counter()
+
+    def enable(self):
+        self.enabled = True
+        self.started = time.time()
+        self.start = time.perf_counter()
+
+    # The calling thread's metrics, registered on first use so they outlive the thread until the export.
+    def mine(self):
+        try:
+            return self.local.metrics
+        except AttributeError:
+            self.local.metrics = ThreadMetrics()
+            with self.lock:
+                self.threads.append(self.local.metrics)
+            return self.local.metrics
+
+    def timer(self, operation):
+        if not self.enabled:
+            return NO_TIMER
+        return Timer(self, operation)
+
+    def observe(self, operation, seconds):
+        if not self.enabled:
+            return
+        histograms = self.mine().histograms
+        if not operation in histograms:
+            histograms[operation] = Histogram()
+        histograms[operation].observe(seconds)
+
+    # Adds value to the counter name{labels}, e.g. count("throttles", operation="GetSnapshotBlock", quota="L-C125AE42")
+    def count(self, name, value=1, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        counters = self.mine().counters
+        counters[key] = counters.get(key, 0) + value
+
+    # Bytes and blocks moved by a stream such as "ebs_get" or "disk_write", in total and per second of the run.
+    def transferred(self, stream, nbytes, blocks=1):
+        if not self.enabled:
+            return
+        self.count("bytes", nbytes, stream=stream)
+        self.count("blocks", blocks, stream=stream)
+        key = (stream, int(time.perf_counter() - self.start))
+        timeline = self.mine().timeline
+        if not key in timeline:
+            timeline[key] = [0, 0]
+        timeline[key][0] += nbytes
+        timeline[key][1] += blocks
+
+    # Times every call of a boto3 client through its event hooks, and counts the bytes of object GETs and PUTs,
+    # so S3 call sites don't need their own timers. Returns the client.
+    def instrument(self, client):
+        if not self.enabled:
+            return client
+        service = client.meta.service_model.service_name
+        client.meta.events.register("before-call." + service, self.before_call)
+        client.meta.events.register("after-call." + service, self.after_call)
+        return client
+
+    def before_call(self, model, params, context, **kwargs):
+        context["metrics_start"] = time.perf_counter()
+        body = params.get("body")
+        if isinstance(body, (bytes, bytearray, memoryview)):
+            context["metrics_bytes"] = len(body)
+        elif hasattr(body, "getbuffer"):
+            context["metrics_bytes"] = body.getbuffer().nbytes
+        else:
+            context["metrics_bytes"] = 0
+
+    def after_call(self, http_response, parsed, model, context, **kwargs):
+        if not "metrics_start" in context:
+            return
+        operation = "s3." + model.name
+        self.observe(operation, time.perf_counter() - context["metrics_start"])
+        error = parsed.get("Error", {}).get("Code")
+        if not error is None:
+            self.count("errors", operation=operation, error=error)
+        elif model.name in ("GetObject",):
+            self.transferred("s3_get", parsed.get("ContentLength", 0))
+        elif model.name in ("PutObject", "UploadPart"):
+            self.transferred("s3_put", context["metrics_bytes"])
+
+    # Merges the data of every thread. Returns (histograms, counters, timeline) like ThreadMetrics.
+    def merged(self):
+        histograms, counters, timeline = {}, {}, {}
+        with self.lock:
+            threads = list(self.threads)
+        for thread in threads:
+            for operation, histogram in list(thread.histograms.items()):
+                if not operation in histograms:
+                    histograms[operation] = Histogram()
+                histograms[operation].merge(histogram)
+            for key, value in list(thread.counters.items()):
+                counters[key] = counters.get(key, 0) + value
+            for key, (nbytes, blocks) in list(thread.timeline.items()):
+                if not key in timeline:
+                    timeline[key] = [0, 0]
+                timeline[key][0] += nbytes
+                timeline[key][1] += blocks
+        return histograms, counters, timeline
+
+    def to_json(self, command):
+        histograms, counters, timeline = self.merged()
+        streams = {}
+        for (stream, second), (nbytes, blocks) in sorted(timeline.items()):
+            streams.setdefault(stream, []).append([second, nbytes, blocks])
+        return {
+            "command": command,
+            "started": datetime.fromtimestamp(self.started, timezone.utc).isoformat(),
+            "duration": round(time.perf_counter() - self.start, 3),
+            "buckets": list(BUCKETS),
+            "operations": {
+                operation: {
+                    "count": histogram.count,
+                    "sum": round(histogram.sum, 6),
+                    "mean": round(histogram.sum / histogram.count, 6) if histogram.count > 0 else 0,
+                    "counts": histogram.counts
+                }
+                for operation, histogram in sorted(histograms.items())
+            },
+            "counters": [{"name": name, "labels": dict(labels), "value": value} for (name, labels), value in sorted(counters.items())],
+            "timeline": streams  # [second since start, bytes, blocks] per stream
+        }
+
+    def to_prometheus(self, command):
+        histograms, counters, timeline = self.merged()
+        lines = [
+            "# HELP fsp_run_duration_seconds Duration of the FSP run.",
+            "# TYPE fsp_run_duration_seconds gauge",
+            'fsp_run_duration_seconds{command="%s"} %f' % (command, time.perf_counter() - self.start),
+            "# HELP fsp_operation_seconds Latency of FSP hot-path operations.",
+            "# TYPE fsp_operation_seconds histogram"
+        ]
+        for operation, histogram in sorted(histograms.items()):
+            cumulative = 0
+            for bound, count in zip([str(bound) for bound in BUCKETS] + ["+Inf"], histogram.counts):
+                cumulative += count
+                lines.append('fsp_operation_seconds_bucket{command="%s",operation="%s",le="%s"} %d' % (command, operation, bound, cumulative))
+            lines.append('fsp_operation_seconds_sum{command="%s",operation="%s"} %f' % (command, operation, histogram.sum))
+            lines.append('fsp_operation_seconds_count{command="%s",operation="%s"} %d' % (command, operation, histogram.count))
+        for name in sorted(set(name for name, labels in counters)):
+            lines.append("# TYPE fsp_%s_total counter" % name)
+            for (counter, labels), value in sorted(counters.items()):
+                if counter == name:
+                    labels = ",".join(['command="%s"' % command] + ['%s="%s"' % (key, value) for key, value in labels])
+                    lines.append("fsp_%s_total{%s} %d" % (name, labels, value))
+        return "\n".join(lines) + "\n"
+
+    # Writes path.prom and path.json, each through a temporary file so a collector never reads half a file.
+    def write(self, path, command):
+        for suffix, text in [(".prom", self.to_prometheus(command)), (".json", json.dumps(self.to_json(command), indent=1))]:
+            with open(path + suffix + ".tmp", "w") as f:
+                f.write(text)
+            os.replace(path + suffix + ".tmp", path + suffix)
+
+
+registry = Registry()
+enable = registry.enable
+timer = registry.timer
+observe = registry.observe
+count = registry.count
+transferred = registry.transferred
+instrument = registry.instrument
+write = registry.write
@@ -31,6 +31,8 @@ class SingletonClass(object):
     DRY_RUN = None  # Run a FSP Action, only checking permissions
     NODEPS = None  # Skip Dependency Checks
     SUPPRESS_WRITES = None  # Script will not produce log files
+    MAX_MEMORY = None  # Budget in bytes for buffered block data and the block index. None is unlimited
+    MIN_MEMORY = None  # Part of MAX_MEMORY kept for the workers' buffers, that the block index may not use
 
     """"Some Project Scoped Constants"""
     RETRY_BLOCK_COUNT = 10
@@ -120,6 +120,12 @@ def parse_args(args):
     parser.add_argument('--all_tests', default=False, action='store_true', help='Run all tests listed below.')
     parser.add_argument('--small_canary', default=False, action='store_true', help='Run tests on small data size for a sanity check that script is functional')
     parser.add_argument('--dependency_checker', default=False, action='store_true', help="Run tests to ensure that script dependency checker and installer is working correctly")
+    parser.add_argument('--range_parser', default=False, action='store_true', help="Run tests to ensure that --start/--end block and byte ranges are parsed correctly")
+    parser.add_argument('--metrics', default=False, action='store_true', help="Run tests to ensure that the --metrics histograms, counters and exports are recorded correctly")
+    parser.add_argument('--segments', default=False, action='store_true', help="Run tests to ensure that blocks are grouped into S3 export segments correctly")
+    parser.add_argument('--journal', default=False, action='store_true', help="Run tests to ensure that the checkpoint journal of resumable transfers survives a restart")
+    parser.add_argument('--merkle', default=False, action='store_true', help="Run tests to ensure that checksum manifests are compared correctly by their Merkle trees")
+    parser.add_argument('--stages', default=False, action='store_true', help="Run tests to ensure that the concurrent transfer stages keep order, bound memory and report errors")
     parser.add_argument('--snapshot_factory_checker', default=False, action='store_true', help="Run tests to ensure that script to generate and check test snapshots is working correctly")
 
     return parser.parse_args(args)
@@ -145,6 +151,36 @@ if __name__ == '__main__':
         result = runner.run(test_unit.DependencyCheckerSuite())
         print(f"{result.testsRun} tests were run - {len(result.skipped)} tests skipped.") 
         print(f"{len(result.errors)} Errors. {len(result.failures)} Failures")
+    if to_test.all_tests or to_test.range_parser:
+        print("\nTesting Range Parser:")
+        result = runner.run(test_unit.RangeParserSuite())
+        print(f"{result.testsRun} tests were run - {len(result.skipped)} tests skipped.")
+        print(f"{len(result.errors)} Errors. {len(result.failures)} Failures")
+    if to_test.all_tests or to_test.metrics:
+        print("\nTesting Metrics:")
+        result = runner.run(test_unit.MetricsSuite())
+        print(f"{result.testsRun} tests were run - {len(result.skipped)} tests skipped.")
+        print(f"{len(result.errors)} Errors. {len(result.failures)} Failures")
+    if to_test.all_tests or to_test.segments:
+        print("\nTesting Segments:")
+        result = runner.run(test_unit.SegmentSuite())
+        print(f"{result.testsRun} tests were run - {len(result.skipped)} tests skipped.")
+        print(f"{len(result.errors)} Errors. {len(result.failures)} Failures")
+    if to_test.all_tests or to_test.journal:
+        print("\nTesting Journal:")
+        result = runner.run(test_unit.JournalSuite())
+        print(f"{result.testsRun} tests were run - {len(result.skipped)} tests skipped.")
+        print(f"{len(result.errors)} Errors. {len(result.failures)} Failures")
+    if to_test.all_tests or to_test.merkle:
+        print("\nTesting Merkle Trees:")
+        result = runner.run(test_unit.MerkleSuite())
+        print(f"{result.testsRun} tests were run - {len(result.skipped)} tests skipped.")
+        print(f"{len(result.errors)} Errors. {len(result.failures)} Failures")
+    if to_test.all_tests or to_test.stages:
+        print("\nTesting Transfer Stages:")
+        result = runner.run(test_unit.StageSuite())
+        print(f"{result.testsRun} tests were run - {len(result.skipped)} tests skipped.")
+        print(f"{len(result.errors)} Errors. {len(result.failures)} Failures")
     if to_test.all_tests or to_test.snapshot_factory_checker:
         print("\nTesting FSP with Small Canary Tests:")
         result = runner.run(test_unit.SnapshotFactorySuite())
@@ -19,11 +19,20 @@ import unittest
 import sys
 import os
 import subprocess
+import threading
+import time
+import io
+import hashlib
+import tempfile
+from base64 import b64encode, urlsafe_b64encode
+from unittest import mock
 
 sys.path.insert(1, f'{os.path.dirname(os.path.realpath(__file__))}/../src') #makes source code testable
 
-from main import install_dependencies, dependency_checker, version_cmp
+from main import install_dependencies, dependency_checker, version_cmp, parse_block_offset, parse_byte_size, arg_parse
 from snapshot_factory import generate_pattern_snapshot, check_pattern
+import metrics
+import fsp
 
 """Method to expose test cases for dependency checker and installer to test runner via a test suite."""
 def DependencyCheckerSuite():
@@ -345,4 +354,577 @@ class TestSnapshotFactory(unittest.TestCase):
       }
       TEST_MATRIX.append(test_case)
 
-    self.run_test_matrix(TEST_MATRIX)
\ No newline at end of file
+    self.run_test_matrix(TEST_MATRIX)
+
+
+"""Method to expose test cases for the --start/--end range parser to test runner via a test suite."""
+def RangeParserSuite():
+  suite = unittest.TestSuite()
+
+  suite.addTest(BlockOffsetParsing('block_indices'))
+  suite.addTest(BlockOffsetParsing('byte_offsets'))
+  suite.addTest(BlockOffsetParsing('unaligned_byte_offsets'))
+  suite.addTest(BlockOffsetParsing('invalid_offsets'))
+  suite.addTest(BlockOffsetParsing('range_arguments'))
+  suite.addTest(BlockOffsetParsing('byte_sizes'))
+  suite.addTest(BlockOffsetParsing('pack_sizes'))
+  suite.addTest(BlockOffsetParsing('codec_levels'))
+
+  return suite
+
+'''Unit tests for the block range parser in src/main.py
+'''
+class BlockOffsetParsing(unittest.TestCase):
+  def block_indices(self):
+    self.assertEqual(parse_block_offset("0"), 0)
+    self.assertEqual(parse_block_offset("2048"), 2048)
+    self.assertEqual(parse_block_offset("2048", round_up=True), 2048, "Block indices are never rounded")
+
+  def byte_offsets(self):
+    self.assertEqual(parse_block_offset("512K"), 1)
+    self.assertEqual(parse_block_offset("1G"), 2048)
+    self.assertEqual(parse_block_offset("1GiB"), 2048)
+    self.assertEqual(parse_block_offset("1tib"), 2097152)
+    self.assertEqual(parse_block_offset("1048576B"), 2)
+
+  def unaligned_byte_offsets(self):
+    self.assertEqual(parse_block_offset("1000B"), 0, "Start offsets should round down to the containing block")
+    self.assertEqual(parse_block_offset("1000B", round_up=True), 1, "End offsets should round up to include the containing block")
+
+  def invalid_offsets(self):
+    for value in ["", "G", "1X", "-5", "1.5G"]:
+      with self.assertRaises(ValueError, msg=f"{value} should not parse"):
+        parse_block_offset(value)
+
+  def range_arguments(self):
+    args = arg_parse(["download", "snap-0123456789abcdef0", "/tmp/out", "--start", "1G", "--end", "2G"])
+    self.assertEqual((args.start, args.end), (2048, 4096))
+
+    args = arg_parse(["upload", "/tmp/in"])
+    self.assertEqual((args.start, args.end), (None, None), "Ranges should default to the whole volume")
+
+    self.assertIsNone(arg_parse(["copy", "snap-0123456789abcdef0", "--start", "10", "--end", "10"]), "Empty ranges should be rejected")
+
+  def byte_sizes(self):
+    self.assertEqual(parse_byte_size("4096"), 4096, "Plain sizes are bytes, not blocks")
+    self.assertEqual(parse_byte_size("100G"), 100 * 1024 ** 3)
+    self.assertEqual(arg_parse(["upload", "-", "--size", "8GiB"]).size, 8 * 1024 ** 3)
+    self.assertIsNone(arg_parse(["fanout", "-", "regions.txt", "--size", "8X"]), "Invalid sizes should be rejected")
+
+  def pack_sizes(self):
+    self.assertIsNone(arg_parse(["movetos3", "snap-0123456789abcdef0", "bucket"]).packed, "Exports should not be packed by default")
+    self.assertEqual(arg_parse(["movetos3", "snap-0123456789abcdef0", "bucket", "--packed"]).packed, 4 * 1024 ** 3)
+    self.assertEqual(arg_parse(["movetos3", "snap-0123456789abcdef0", "bucket", "--packed", "512M"]).packed, 512 * 1024 ** 2)
+
+  def codec_levels(self):
+    self.assertEqual(arg_parse(["movetos3", "snap-0123456789abcdef0", "bucket", "--level", "19"]).level, 19, "auto compresses with zstd")
+    self.assertEqual(arg_parse(["movetos3", "snap-0123456789abcdef0", "bucket", "--codec", "lz4", "--level", "0"]).level, 0)
+    self.assertIsNone(arg_parse(["movetos3", "snap-0123456789abcdef0", "bucket", "--codec", "none", "--level", "3"]), "Storing takes no level")
+    self.assertIsNone(arg_parse(["movetos3", "snap-0123456789abcdef0", "bucket", "--codec", "lz4", "--level", "19"]), "lz4 levels end at 16")
+    self.assertIsNone(arg_parse(["movetos3", "snap-0123456789abcdef0", "bucket", "--codec", "zstd", "--level", "0"]))
+
+
+"""Method to expose test cases for the --metrics instrumentation to test runner via a test suite."""
+def MetricsSuite():
+  suite = unittest.TestSuite()
+
+  suite.addTest(MetricsRegistry('disabled_is_noop'))
+  suite.addTest(MetricsRegistry('threads_are_merged'))
+  suite.addTest(MetricsRegistry('prometheus_and_json'))
+
+  return suite
+
+'''Unit tests for the hot-path metrics in src/metrics.py
+'''
+class MetricsRegistry(unittest.TestCase):
+  def disabled_is_noop(self):
+    registry = metrics.Registry()
+    with registry.timer("checksum"):
+      pass
+    registry.count("throttles", operation="GetSnapshotBlock", quota="L-C125AE42")
+    self.assertEqual(registry.merged(), ({}, {}, {}), "Nothing should be recorded unless --metrics is set")
+
+  def threads_are_merged(self):
+    registry = metrics.Registry()
+    registry.enable()
+    def work():
+      for i in range(100):
+        registry.observe("ebs.GetSnapshotBlock", 0.003)
+        registry.transferred("ebs_get", 512 * 1024)
+    threads = [threading.Thread(target=work) for i in range(4)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    histograms, counters, timeline = registry.merged()
+    self.assertEqual(histograms["ebs.GetSnapshotBlock"].count, 400)
+    self.assertEqual(histograms["ebs.GetSnapshotBlock"].counts[metrics.BUCKETS.index(0.005)], 400, "3 ms falls in the 5 ms bucket")
+    self.assertEqual(counters[("blocks", (("stream", "ebs_get"),))], 400)
+    self.assertEqual(sum(entry[0] for entry in timeline.values()), 400 * 512 * 1024)
+
+  def prometheus_and_json(self):
+    registry = metrics.Registry()
+    registry.enable()
+    registry.observe("checksum", 0.0002)
+    registry.observe("checksum", 60)
+    registry.count("throttles", operation="PutSnapshotBlock", quota="L-AFAE1BE8")
+    text = registry.to_prometheus("upload")
+    self.assertIn('fsp_operation_seconds_bucket{command="upload",operation="checksum",le="0.00025"} 1', text)
+    self.assertIn('fsp_operation_seconds_bucket{command="upload",operation="checksum",le="+Inf"} 2', text, "Buckets are cumulative")
+    self.assertIn('fsp_throttles_total{command="upload",operation="PutSnapshotBlock",quota="L-AFAE1BE8"} 1', text)
+    report = json.loads(json.dumps(registry.to_json("upload")))
+    self.assertEqual(report["operations"]["checksum"]["count"], 2)
+    self.assertEqual(report["counters"], [{"name": "throttles", "labels": {"operation": "PutSnapshotBlock", "quota": "L-AFAE1BE8"}, "value": 1}])
+
+
+"""Method to expose test cases for the segment layout of S3 exports to test runner via a test suite."""
+def SegmentSuite():
+  suite = unittest.TestSuite()
+
+  suite.addTest(SegmentLayout('final_segment_is_emitted'))
+  suite.addTest(SegmentLayout('segments_are_aligned'))
+  suite.addTest(SegmentRestore('corrupt_read_is_rewritten'))
+  suite.addTest(SegmentRestore('corrupt_segment_fails'))
+  suite.addTest(SegmentRestore('truncated_read_is_not_put'))
+  suite.addTest(SegmentRestore('export_prefix_is_resolved'))
+  suite.addTest(LayerPlanning('single_layer'))
+  suite.addTest(LayerPlanning('newer_layers_override_older'))
+  suite.addTest(LayerPlanning('parent_diff'))
+
+  return suite
+
+'''Unit tests for how src/fsp.py groups blocks into segments
+'''
+class SegmentLayout(unittest.TestCase):
+  def segments(self, indices):
+    return [[block["BlockIndex"] for block in segment] for segment in fsp.chunk_and_align([{"BlockIndex": index} for index in indices])]
+
+  def final_segment_is_emitted(self):
+    self.assertEqual(self.segments([0, 1, 2, 5, 6, 63, 64, 65, 200]), [[0, 1, 2], [5, 6], [63], [64, 65], [200]], "The last partial segment must not be dropped")
+    self.assertEqual(self.segments([7]), [[7]])
+    self.assertEqual(self.segments([]), [])
+
+  def segments_are_aligned(self):
+    segments = self.segments(range(130))
+    self.assertEqual([(segment[0], len(segment)) for segment in segments], [(0, 64), (64, 64), (128, 2)], "Segments never cross a 64 block boundary")
+
+
+'''Fake S3 client that serves a queue of bodies for every GET, one per call
+'''
+class FakeS3(object):
+  def __init__(self, bodies, keys=()):
+    self.bodies = list(bodies)
+    self.keys = sorted(keys)
+
+  def get_object(self, **kwargs):
+    return {"Body": io.BytesIO(self.bodies.pop(0))}
+
+  def list_objects_v2(self, Bucket, Prefix, Delimiter):
+    prefixes = sorted(set(key[:key.index(Delimiter, len(Prefix)) + 1] for key in self.keys if key.startswith(Prefix) and Delimiter in key[len(Prefix):]))
+    return {"CommonPrefixes": [{"Prefix": prefix} for prefix in prefixes]} if prefixes else {}
+
+'''Fake S3 session handing out one client
+'''
+class FakeSession(object):
+  def __init__(self, client):
+    self.s3 = client
+
+  def __call__(self, **kwargs):
+    return self
+
+  def client(self, *args, **kwargs):
+    return self.s3
+
+'''Fake EBS client that serves GetSnapshotBlock from blocks and records every PutSnapshotBlock once it has finished.
+Calls for block data in slow take a while.
+'''
+class FakeEBS(object):
+  def __init__(self, slow=(), blocks=None, gate=None, error=None):
+    self.slow = set(slow)
+    self.blocks = {} if blocks is None else blocks
+    self.gate = gate  # PUTs wait for this Event
+    self.error = error  # PUTs of this block fail
+    self.lock = threading.Lock()
+    self.puts = []
+    self.gets = 0
+
+  def get_snapshot_block(self, SnapshotId, BlockIndex, BlockToken):
+    data = self.blocks[BlockIndex]
+    with self.lock:
+      self.gets += 1
+    if data in self.slow:
+      time.sleep(0.3)
+    return {"BlockData": io.BytesIO(data), "Checksum": b64encode(hashlib.sha256(data).digest()).decode()}
+
+  def put_snapshot_block(self, SnapshotId, BlockIndex, BlockData, **kwargs):
+    if not self.gate is None:
+      self.gate.wait()
+    if BlockIndex == self.error:
+      raise RuntimeError("connection reset")  # Not a ClientError, so it isn't retried
+    data = bytes(BlockData)
+    if data in self.slow:
+      time.sleep(0.2)
+    with self.lock:
+      self.puts.append((BlockIndex, data))
+    return {}
+
+def fake_destinations(ebs):
+  return {"us-east-1": {"client": ebs, "snapshot": {"SnapshotId": "snap-0123456789abcdef0"}, "count": None}}
+
+def fake_block(i):
+  return bytes([i + 1]) * fsp.CHUNK_SIZE
+
+'''Unit tests for restoring S3 export segments in src/fsp.py
+'''
+class SegmentRestore(unittest.TestCase):
+  def corrupt_read_is_rewritten(self):
+    good = [fake_block(i) for i in range(4)]
+    bad = [fake_block(i + 100) for i in range(4)]
+    segment = ["10", urlsafe_b64encode(hashlib.sha256(b"".join(good)).digest()).decode(), "4", "none"]
+    ebs = FakeEBS(slow=bad)  # The PUTs of the corrupt read finish last, unless the retry waits for them
+    put_stage = fsp.PutStage(4, 16)
+    with mock.patch.object(fsp.boto3, "Session", FakeSession(FakeS3([b"".join(bad), b"".join(good)]))):
+      fsp.get_segment_from_s3(segment, "snap-0123456789abcdef0.1", put_stage, fake_destinations(ebs))
+    put_stage.close()
+    last = {}
+    for block, data in ebs.puts:
+      last[block] = hashlib.sha256(data).hexdigest()
+    self.assertEqual(last, {10 + i: hashlib.sha256(good[i]).hexdigest() for i in range(4)}, "The last PUT of every block must be the verified data")
+
+  def corrupt_segment_fails(self):
+    good = [fake_block(i) for i in range(2)]
+    segment = ["0", urlsafe_b64encode(hashlib.sha256(b"".join(good)).digest()).decode(), "2", "none"]
+    ebs = FakeEBS()
+    put_stage = fsp.PutStage(2, 8)
+    with mock.patch.object(fsp.boto3, "Session", FakeSession(FakeS3([fake_block(7) * 2] * fsp.singleton.RETRY_BLOCK_COUNT))):
+      with self.assertRaises(SystemExit, msg="A segment that is corrupt in the bucket must not be retried forever"):
+        fsp.get_segment_from_s3(segment, "snap-0123456789abcdef0.1", put_stage, fake_destinations(ebs))
+    put_stage.close()
+    self.assertEqual(len(ebs.puts), 2 * fsp.singleton.RETRY_BLOCK_COUNT)
+
+  def truncated_read_is_not_put(self):
+    good = [fake_block(i) for i in range(2)]
+    segment = ["0", urlsafe_b64encode(hashlib.sha256(b"".join(good)).digest()).decode(), "2", "none"]
+    ebs = FakeEBS()
+    put_stage = fsp.PutStage(2, 8)
+    truncated = good[0] + good[1][:1000]
+    with mock.patch.object(fsp.boto3, "Session", FakeSession(FakeS3([truncated, b"".join(good)]))):
+      fsp.get_segment_from_s3(segment, "snap-0123456789abcdef0.1", put_stage, fake_destinations(ebs))
+    put_stage.close()
+    self.assertEqual(sorted(block for block, data in ebs.puts), [0, 0, 1], "The partial block must not be PUT")
+    self.assertTrue(all(hashlib.sha256(data).digest() == hashlib.sha256(good[block]).digest() for block, data in ebs.puts))
+
+  def export_prefix_is_resolved(self):
+    s3 = FakeS3([], ["snap-0123456789abcdef0.8/0.abc.64.zstd", "snap-0123456789abcdef0.8/manifest.json.zst"])
+    for prefix in ["snap-0123456789abcdef0", "snap-0123456789abcdef0.8", "snap-0123456789abcdef0.8/", "snap-0123456789abcdef0.8/0."]:
+      self.assertEqual(fsp.find_export_prefix(s3, prefix), "snap-0123456789abcdef0.8", "Prefixes inside the export directory must still resolve")
+    self.assertIsNone(fsp.find_export_prefix(s3, "snap-1"))
+
+
+def fake_segment(offset, checksum, length):
+  return [str(offset), checksum, str(length), "zstd"]
+
+'''Unit tests for the restore plan of layered (delta) S3 exports in src/fsp.py
+'''
+class LayerPlanning(unittest.TestCase):
+  def single_layer(self):
+    segments = [fake_segment(0, "a", 4), fake_segment(8, "b", 2)]
+    plan = fsp.overlay_layers([("snap-base.1", segments, {"segments": segments})], 16)
+    self.assertEqual(plan, [(segment, "snap-base.1", None) for segment in segments], "A full export restores every segment whole")
+
+  def newer_layers_override_older(self):
+    base = [fake_segment(0, "a", 4), fake_segment(8, "b", 2), fake_segment(12, "c", 2)]
+    delta = [fake_segment(2, "d", 4)]
+    layers = [
+      ("snap-delta.1", delta, {"segments": delta, "base": "snap-base.1", "zeroed": [[9, 1], [12, 2]]}),
+      ("snap-base.1", base, {"segments": base})
+    ]
+    plan = fsp.overlay_layers(layers, 16)
+    self.assertEqual(plan, [
+      (delta[0], "snap-delta.1", None),
+      (base[0], "snap-base.1", [True, True, False, False]),  # Blocks 2 and 3 come from the delta
+      (base[1], "snap-base.1", [True, False])  # Block 9 was removed by the delta
+    ], "Segments fully overridden or removed by a newer layer are not restored")
+
+  def parent_diff(self):
+    unchanged = fake_segment(0, "a", 4)
+    base_plan = [(unchanged, "snap-parent.1", None), (fake_segment(4, "b", 4), "snap-parent.1", None), (fake_segment(8, "c", 2), "snap-parent.1", None)]
+    changed = (fake_segment(4, "b2", 4), "snap-child.1", [True, True, False, True])  # Block 6 was removed in the child
+    added = (fake_segment(12, "d", 2), "snap-child.1", None)
+    plan, zero_blocks = fsp.diff_plan([(unchanged, "snap-child.1", None), changed, added], base_plan, 16)
+    self.assertEqual(plan, [changed, added], "Only segments that differ from the parent's export are restored")
+    self.assertEqual(zero_blocks, [6, 8, 9], "Blocks the parent holds but the child doesn't must be zeroed")
+
+
+"""Method to expose test cases for the checkpoint journal of resumable transfers to test runner via a test suite."""
+def JournalSuite():
+  suite = unittest.TestSuite()
+
+  suite.addTest(CheckpointJournal('reopen_after_crash'))
+  suite.addTest(CheckpointJournal('mismatch_is_rejected'))
+  suite.addTest(CheckpointJournal('complete_removes_journal'))
+  suite.addTest(CheckpointJournal('put_count_survives_reopen'))
+
+  return suite
+
+'''Unit tests for the BlockJournal of src/fsp.py, against temporary files
+'''
+class CheckpointJournal(unittest.TestCase):
+  def setUp(self):
+    self.directory = tempfile.TemporaryDirectory()
+    self.path = os.path.join(self.directory.name, "journal")
+    self.target = os.path.join(self.directory.name, "volume.img")
+    open(self.target, "w").close()
+
+  def tearDown(self):
+    self.directory.cleanup()
+
+  def journal(self, identity="download snap-0123456789abcdef0", volume_blocks=100):
+    return fsp.BlockJournal(self.path, identity, volume_blocks, [self.target])
+
+  def reopen_after_crash(self):
+    journal = self.journal()
+    for block in [0, 7, 8, 99]:
+      journal.mark(block)
+    journal.checkpoint()
+    journal.mark(50)  # Not checkpointed yet when the transfer dies
+    journal = self.journal()
+    self.assertEqual([block for block in range(100) if journal.is_done(block)], [0, 7, 8, 99])
+    self.assertEqual(journal.pending([{"BlockIndex": block} for block in [7, 9, 50]]), [{"BlockIndex": 9}, {"BlockIndex": 50}], "Blocks not checkpointed must be transferred again")
+    journal.close(False)
+    self.assertTrue(os.path.exists(self.path), "An incomplete transfer keeps its journal")
+
+  def mismatch_is_rejected(self):
+    self.journal().close(False)
+    with self.assertRaises(SystemExit, msg="A journal of a different volume size must not be reused"):
+      self.journal(volume_blocks=200)
+    with self.assertRaises(SystemExit, msg="A journal of a different transfer must not be reused"):
+      self.journal(identity="download snap-0fedcba9876543210")
+
+  def complete_removes_journal(self):
+    open(self.path + ".index", "w").close()
+    journal = self.journal()
+    journal.mark(1)
+    journal.close(True)
+    self.assertFalse(os.path.exists(self.path))
+    self.assertFalse(os.path.exists(self.path + ".index"), "The block index cache goes with the journal")
+
+  def put_count_survives_reopen(self):
+    journal = self.journal("upload volume.img")
+    for block, put in [(3, True), (4, False), (5, True)]:  # Zero blocks are done without a PUT
+      journal.mark(block, put)
+    journal.close(False)
+    journal = self.journal("upload volume.img")
+    self.assertEqual(journal.put_count(), 2, "A resumed upload must complete its snapshot with the blocks PUT before the restart")
+    self.assertEqual(journal.pending([2, 3, 4, 5, 6], key=int), [2, 6])
+    journal.mark(6, True)
+    journal.checkpoint()
+    self.assertEqual(journal.put_count(), 3)
+    journal.close(False)
+
+
+"""Method to expose test cases for the Merkle trees of checksum manifests to test runner via a test suite."""
+def MerkleSuite():
+  suite = unittest.TestSuite()
+
+  suite.addTest(MerkleTree('identical_manifests'))
+  suite.addTest(MerkleTree('single_differing_leaf'))
+  suite.addTest(MerkleTree('odd_leaf_count'))
+  suite.addTest(MerkleTree('different_lengths'))
+
+  return suite
+
+def fake_checksum(value):
+  return b64encode(hashlib.sha256(str(value).encode()).digest()).decode()
+
+def fake_manifest(checksums, first_block, last_block):
+  return {"snapshot_id": "snap-0123456789abcdef0", "range": [first_block, last_block], "checksums": checksums, "merkle": fsp.merkle_levels(checksums, first_block, last_block)}
+
+'''Unit tests for merkle_levels and merkle_diff in src/fsp.py
+'''
+class MerkleTree(unittest.TestCase):
+  def identical_manifests(self):
+    checksums = {index: fake_checksum(index) for index in range(100, 5000, 3)}
+    one = fake_manifest(checksums, 100, 5000)
+    self.assertEqual([len(level) // 32 for level in one["merkle"]], [77, 2, 1], "4900 leaves under 64-way nodes")
+    self.assertEqual(fsp.merkle_diff(one, fake_manifest(dict(checksums), 100, 5000)), [])
+    sparse = dict(checksums)
+    sparse[101] = fsp.KNOWN_SPARSE_CHECKSUM
+    self.assertEqual(fsp.merkle_diff(one, fake_manifest(sparse, 100, 5000)), [], "Unlisted blocks are zeros")
+
+  def single_differing_leaf(self):
+    checksums = {index: fake_checksum(index) for index in range(5000)}
+    changed = dict(checksums)
+    changed[4321] = fake_checksum("changed")
+    self.assertEqual(fsp.merkle_diff(fake_manifest(checksums, 0, 5000), fake_manifest(changed, 0, 5000)), [4321])
+    del changed[4321]
+    self.assertEqual(fsp.merkle_diff(fake_manifest(changed, 0, 5000), fake_manifest(checksums, 0, 5000)), [4321], "A block removed on one side differs too")
+
+  def odd_leaf_count(self):
+    checksums = {index: fake_checksum(index) for index in range(65)}
+    levels = fsp.merkle_levels(checksums, 0, 65)
+    self.assertEqual([len(level) // 32 for level in levels], [2, 1], "The last node of a level covers the leaves left over")
+    self.assertEqual(levels[1], hashlib.sha256(levels[0]).digest())
+    changed = dict(checksums)
+    changed[64] = fake_checksum("changed")
+    self.assertEqual(fsp.merkle_diff(fake_manifest(checksums, 0, 65), fake_manifest(changed, 0, 65)), [64])
+    single = fake_manifest({7: fake_checksum(7)}, 7, 8)
+    self.assertEqual(single["merkle"], [], "A single leaf is its own root")
+    self.assertEqual(fsp.merkle_diff(single, fake_manifest({7: fake_checksum(8)}, 7, 8)), [7])
+
+  def different_lengths(self):
+    with tempfile.TemporaryDirectory() as directory:
+      short = os.path.join(directory, "short.manifest")
+      long = os.path.join(directory, "long.manifest")
+      fsp.put_checksum_manifest(short, "snap-0123456789abcdef0", 1, 0, 1000, {index: fake_checksum(index) for index in range(1000)})
+      fsp.put_checksum_manifest(long, "snap-0123456789abcdef0", 1, 0, 2000, {index: fake_checksum(index) for index in range(1000)})
+      with self.assertRaises(SystemExit, msg="Trees of different block ranges can't be compared"):
+        fsp.verify_manifests(fsp.get_checksum_manifest(short), long)
+
+
+"""Method to expose test cases for the concurrent transfer stages to test runner via a test suite."""
+def StageSuite():
+  suite = unittest.TestSuite()
+
+  suite.addTest(TransferStages('stream_is_in_order'))
+  suite.addTest(TransferStages('stream_window_is_bounded'))
+  suite.addTest(TransferStages('stream_uses_block_pool'))
+  suite.addTest(TransferStages('stream_upload_uses_block_pool'))
+  suite.addTest(TransferStages('verify_retries_bad_blocks'))
+  suite.addTest(TransferStages('verify_errors_from_close'))
+  suite.addTest(TransferStages('verify_window_is_bounded'))
+  suite.addTest(TransferStages('put_releases_after_every_destination'))
+  suite.addTest(TransferStages('put_errors_from_close'))
+  suite.addTest(TransferStages('put_window_is_bounded'))
+
+  return suite
+
+def fake_pages(indices, page_size=3):
+  blocks = [{"BlockIndex": index, "BlockToken": "token-" + str(index)} for index in indices]
+  return [blocks[i:i + page_size] for i in range(0, len(blocks), page_size)]
+
+'''Unit tests for the concurrent stages of src/fsp.py, with fake clients
+'''
+class TransferStages(unittest.TestCase):
+  # Runs call on a new thread and returns it, still running if call blocked for longer than timeout
+  def blocked(self, call, timeout=0.2):
+    thread = threading.Thread(target=call)
+    thread.start()
+    thread.join(timeout)
+    return thread
+
+  def stream_is_in_order(self):
+    indices = [1, 3, 4, 10]
+    ebs = FakeEBS(slow=[fake_block(1), fake_block(3)], blocks={index: fake_block(index) for index in indices})  # Later blocks finish first
+    out = io.BytesIO()
+    with mock.patch.object(fsp.boto3, "client", lambda *args, **kwargs: ebs):
+      self.assertEqual(fsp.stream_blocks(fake_pages(indices), out, "snap-0123456789abcdef0", 0, 12), 4)
+    expected = b"".join(fake_block(index) if index in indices else fsp.ZERO_BLOCK for index in range(12))
+    self.assertEqual(len(out.getvalue()), 12 * fsp.CHUNK_SIZE, "Unallocated blocks in the range are written as zeros")
+    self.assertEqual(hashlib.sha256(out.getvalue()).hexdigest(), hashlib.sha256(expected).hexdigest(), "Blocks must be written in BlockIndex order")
+
+  def stream_window_is_bounded(self):
+    indices = range(40)
+    ebs = FakeEBS(slow=[fake_block(0)], blocks={index: fake_block(index) for index in indices})
+    started = []
+    class Out(io.BytesIO):
+      def write(self, data):
+        if len(started) == 0:  # Block 0 is written first, after its slow GET
+          started.append(ebs.gets)
+        return super().write(data)
+    with mock.patch.object(fsp.boto3, "client", lambda *args, **kwargs: ebs), mock.patch.object(fsp, "STREAM_WINDOW", 4):
+      fsp.stream_blocks(fake_pages(indices), Out(), "snap-0123456789abcdef0", 0, 40)
+    self.assertLessEqual(started[0], 5, "No more than STREAM_WINDOW blocks may wait behind a slow block")
+
+  def stream_uses_block_pool(self):
+    indices = range(20)
+    ebs = FakeEBS(blocks={index: fake_block(index) for index in indices})
+    pool = fsp.BlockBufferPool(fsp.MemoryBudget(3 * fsp.CHUNK_SIZE, 0))
+    out = io.BytesIO()
+    with mock.patch.object(fsp.boto3, "client", lambda *args, **kwargs: ebs), mock.patch.object(fsp, "block_pool", pool):
+      fsp.stream_blocks(fake_pages(indices), out, "snap-0123456789abcdef0", 0, 20)
+    expected = b"".join(fake_block(index) for index in indices)
+    self.assertEqual(hashlib.sha256(out.getvalue()).hexdigest(), hashlib.sha256(expected).hexdigest(), "A budget smaller than the window must not reorder or stall the stream")
+    self.assertEqual(len(pool.free) * fsp.CHUNK_SIZE, pool.budget.used, "Every buffer goes back to the pool once written")
+
+  def stream_upload_uses_block_pool(self):
+    class Pipe(io.BytesIO):
+      def readinto(self, buf):  # Pipes hand out a little at a time
+        return super().readinto(memoryview(buf)[:100000])
+    blocks = [fake_block(0), fsp.ZERO_BLOCK, fake_block(2), fake_block(3)[:1000]]
+    ebs = FakeEBS()
+    pool = fsp.BlockBufferPool(fsp.MemoryBudget(3 * fsp.CHUNK_SIZE, 0))
+    with mock.patch.object(fsp, "block_pool", pool):
+      self.assertEqual(fsp.stream_put_blocks(Pipe(b"".join(blocks)), fake_destinations(ebs), 8), 4)
+    expected = {0: fake_block(0), 2: fake_block(2), 3: fake_block(3)[:1000].ljust(fsp.CHUNK_SIZE, b"\0")}
+    self.assertEqual({block: hashlib.sha256(data).hexdigest() for block, data in ebs.puts}, {block: hashlib.sha256(data).hexdigest() for block, data in expected.items()}, "Short reads are completed, zero blocks skipped and the last block zero-filled")
+    self.assertEqual(len(pool.free) * fsp.CHUNK_SIZE, pool.budget.used, "Every buffer goes back to the pool once PUT")
+
+  def fetched(self, data, released, checksum=None):
+    return data, b64encode(hashlib.sha256(data).digest()).decode() if checksum is None else checksum, lambda: released.append(data)
+
+  def verify_retries_bad_blocks(self):
+    delivered, released = [], []
+    stage = fsp.VerifyStage(2, 8)
+    for index in range(4):
+      block = {"BlockIndex": index}
+      fetched = self.fetched(fake_block(index), released, None if index != 2 else fsp.KNOWN_SPARSE_CHECKSUM)  # Block 2 arrives garbled
+      stage.submit(block, fetched, lambda index=index: self.fetched(fake_block(index), released), lambda data, index=index: delivered.append((index, bytes(data) == fake_block(index))))
+    stage.close()
+    self.assertEqual(sorted(delivered), [(index, True) for index in range(4)], "Every block is delivered once, after it verified")
+    self.assertEqual(len(released), 5, "Every fetched buffer is released, the garbled one too")
+
+  def verify_errors_from_close(self):
+    def deliver(data):
+      if data == fake_block(1):
+        raise IOError("disk full")
+    stage = fsp.VerifyStage(2, 8)
+    for index in range(3):
+      stage.submit({"BlockIndex": index}, self.fetched(fake_block(index), []), None, deliver)
+    with self.assertRaises(SystemExit, msg="A block that can't be written must fail the transfer"):
+      stage.close()
+
+  def verify_window_is_bounded(self):
+    gate = threading.Event()
+    stage = fsp.VerifyStage(2, 2)
+    for index in range(2):
+      stage.submit({"BlockIndex": index}, self.fetched(fake_block(index), []), None, lambda data: gate.wait())
+    thread = self.blocked(lambda: stage.submit({"BlockIndex": 2}, self.fetched(fake_block(2), []), None, lambda data: None))
+    self.assertTrue(thread.is_alive(), "submit() must wait while window blocks are in the stage")
+    gate.set()
+    thread.join(5)
+    self.assertFalse(thread.is_alive())
+    stage.close()
+
+  def put_releases_after_every_destination(self):
+    one, two = FakeEBS(), FakeEBS()
+    destinations = {"us-east-1": fake_destinations(one)["us-east-1"], "eu-west-1": fake_destinations(two)["us-east-1"]}
+    released = []
+    stage = fsp.PutStage(2, 8)
+    finished = [stage.submit(index, fake_block(index), destinations, release=lambda data: released.append((len(one.puts), len(two.puts)))) for index in range(4)]
+    stage.close()
+    self.assertTrue(all(event.is_set() for event in finished))
+    self.assertEqual(sorted(block for block, data in one.puts), [0, 1, 2, 3])
+    self.assertEqual(sorted(block for block, data in two.puts), [0, 1, 2, 3])
+    self.assertEqual(len(released), 4, "Every block is released once")
+
+  def put_errors_from_close(self):
+    stage = fsp.PutStage(2, 8)
+    for index in range(3):
+      stage.submit(index, fake_block(index), fake_destinations(FakeEBS(error=1)))
+    with self.assertRaises(SystemExit, msg="A block that can't be PUT must keep the snapshot from completing"):
+      stage.close()
+
+  def put_window_is_bounded(self):
+    gate = threading.Event()
+    ebs = FakeEBS(gate=gate)
+    stage = fsp.PutStage(4, 2)
+    for index in range(2):
+      stage.submit(index, fake_block(index), fake_destinations(ebs))
+    thread = self.blocked(lambda: stage.submit(2, fake_block(2), fake_destinations(ebs)))
+    self.assertTrue(thread.is_alive(), "submit() must wait while window blocks are queued or in flight")
+    gate.set()
+    thread.join(5)
+    self.assertFalse(thread.is_alive())
+    stage.close()
+    self.assertEqual(len(ebs.puts), 3)